@@ -0,0 +1,77 @@
+"""
+benchmarks.cache_codec
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+比较 ``pyape.cache.ValueSerializer`` 不同编码器和压缩配置的
+编码时间、解码时间和存储字节数。
+
+    python benchmarks/cache_codec.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).parent.parent.resolve().as_posix())
+
+from pyape.cache import ValueSerializer, CODECS, msgpack, lz4frame
+
+
+def make_payloads() -> dict:
+    """ 模拟 vofun 中常见的 VO 值。"""
+    token = {'access_token': 'x' * 128, 'expires_in': 7200, 'createtime': 1700000000}
+    regional = {
+        'name': '正式服 5001',
+        'r': 5001,
+        'kindtype': 0,
+        'status': 1,
+        'bind_key_db': 'db5001',
+        'bind_key_redis': 'cache',
+        'ips': [f'10.0.{i}.{i}' for i in range(20)],
+        'WECHAT_MINIAPP': {'appid': 'wx' + '0' * 16, 'secret': 's' * 32},
+    }
+    items = [
+        {
+            'vid': i,
+            'name': f'r5001_item{i}',
+            'index': i % 10,
+            'status': 1,
+            'votype': 306,
+            'price': i * 100,
+            'desc': f'道具 {i} 的描述，用于测试较长的中文文本。',
+            'tags': ['hot', 'new'] if i % 3 else ['normal'],
+        }
+        for i in range(500)
+    ]
+    return {'token': token, 'regional': regional, 'items_500': items}
+
+
+def make_serializers() -> dict:
+    serializers = {}
+    for name in CODECS:
+        if name == 'msgpack' and msgpack is None:
+            continue
+        serializers[name] = ValueSerializer(name)
+        serializers[f'{name}+zlib'] = ValueSerializer(name, compression='zlib')
+        if lz4frame is not None:
+            serializers[f'{name}+lz4'] = ValueSerializer(name, compression='lz4')
+    return serializers
+
+
+def main(number: int = 200):
+    payloads = make_payloads()
+    serializers = make_serializers()
+    print(f'{"payload":<12}{"serializer":<16}{"bytes":>10}{"dumps us":>12}{"loads us":>12}')
+    for pname, value in payloads.items():
+        for sname, vs in serializers.items():
+            raw = vs.dumps(value)
+            assert vs.loads(raw) == value
+            dumps_t = timeit.timeit(lambda: vs.dumps(value), number=number) / number
+            loads_t = timeit.timeit(lambda: vs.loads(raw), number=number) / number
+            print(
+                f'{pname:<12}{sname:<16}{len(raw):>10}'
+                f'{dumps_t * 1e6:>12.1f}{loads_t * 1e6:>12.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
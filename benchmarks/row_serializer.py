@@ -0,0 +1,89 @@
+"""
+benchmarks.row_serializer
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+比较逐行逐键判断类型的 ``result2dict`` 与 ``pyape.serializer`` 生成的转换函数，
+将 10k/100k 行查询结果转换为 dict 列表的耗时。只计算转换，不包含查询。
+
+    python benchmarks/row_serializer.py
+"""
+import sys
+import time
+from pathlib import Path
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, Path(__file__).parent.parent.resolve().as_posix())
+
+from sqlalchemy import Column, Integer, VARCHAR, DateTime, Numeric, create_engine, select
+from sqlalchemy.orm import declarative_base
+
+from pyape.serializer import serialize_rows, result_types
+
+Base = declarative_base()
+
+
+class Action(Base):
+    __tablename__ = 'action'
+    id = Column(Integer, primary_key=True)
+    uid = Column(Integer, nullable=False)
+    name = Column(VARCHAR(32), nullable=False)
+    amount = Column(Numeric(10, 2), nullable=False)
+    note = Column(VARCHAR(64), nullable=True)
+    createtime = Column(DateTime, nullable=False)
+
+
+REPLACEOBJ = {'uid': 'userid', 'createtime': 'ctime'}
+
+
+def legacy_result2dict(result, keys, replaceobj=None, replaceobj_key_only=False):
+    """ PyapeDB.result2dict 之前的实现。"""
+    result_dict = {}
+    for key in keys:
+        value = result.get(key) if isinstance(result, dict) else getattr(result, key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Decimal):
+            value = int(value)
+        newkey = key
+        if replaceobj:
+            if replaceobj_key_only:
+                newkey = replaceobj.get(key, None)
+            else:
+                newkey = replaceobj.get(key, key)
+        if newkey:
+            result_dict[newkey] = value
+    return result_dict
+
+
+def fetch(engine, count: int):
+    with engine.connect() as conn:
+        result = conn.execute(select(Action).where(Action.id <= count))
+        return result.all(), list(result.keys()), result_types(result)
+
+
+def main():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    start_time = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(Action.__table__.insert(), [
+            dict(id=i, uid=i % 1000, name=f'action{i % 20}', amount=Decimal(i % 500) / 4,
+                 note=None if i % 3 else 'note', createtime=start_time + timedelta(seconds=i))
+            for i in range(1, 100001)
+        ])
+    print(f'{"rows":<10}{"legacy ms":>12}{"compiled ms":>14}{"speedup":>10}')
+    for count in (10000, 100000):
+        rows, keys, types = fetch(engine, count)
+        start = time.perf_counter()
+        legacy = [legacy_result2dict(row, keys, REPLACEOBJ) for row in rows]
+        legacy_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        compiled = serialize_rows(rows, keys, REPLACEOBJ, types=types)
+        compiled_ms = (time.perf_counter() - start) * 1000
+        assert legacy == compiled
+        print(f'{count:<10}{legacy_ms:>12.1f}{compiled_ms:>14.1f}{legacy_ms / compiled_ms:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
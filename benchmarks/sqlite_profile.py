@@ -0,0 +1,83 @@
+"""
+benchmarks.sqlite_profile
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+比较默认的 sqlite 引擎（NullPool，仅开启外键）与 ``ENGINE_OPTIONS.sqlite`` 性能配置
+（WAL、synchronous=NORMAL、连接池等）的每秒插入数和每秒读取数。
+
+每次插入和读取都使用一个新的 Session 并提交，模拟 web 请求。
+
+    python benchmarks/sqlite_profile.py
+"""
+import sys
+import time
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, Path(__file__).parent.parent.resolve().as_posix())
+
+from sqlalchemy import Column, Integer, VARCHAR, select
+
+from pyape.db import SQLAlchemy
+
+INSERTS = 2000
+READS = 5000
+THREADS = 4
+
+
+def make_db(work_dir: Path, name: str, engine_options: dict) -> tuple:
+    sql = SQLAlchemy(
+        URI=f'sqlite:///{work_dir.joinpath(name).as_posix()}',
+        ENGINE_OPTIONS=engine_options,
+        is_scoped=True,
+    )
+
+    class Item(sql.Model()):
+        __tablename__ = 'item'
+        id = Column(Integer, primary_key=True)
+        name = Column(VARCHAR(64), nullable=False)
+
+    sql.create_all()
+    return sql, Item
+
+
+def run(sql: SQLAlchemy, Item) -> dict:
+    start = time.perf_counter()
+    for i in range(INSERTS):
+        s = sql.session()
+        s.add(Item(id=i, name=f'item{i}'))
+        s.commit()
+        sql.Session.remove()
+    insert_seconds = time.perf_counter() - start
+
+    def read(i):
+        s = sql.session()
+        s.scalar(select(Item.name).where(Item.id == i % INSERTS))
+        sql.Session.remove()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as executor:
+        list(executor.map(read, range(READS)))
+    read_seconds = time.perf_counter() - start
+    return {
+        'inserts/s': INSERTS / insert_seconds,
+        'reads/s': READS / read_seconds,
+    }
+
+
+def main():
+    profiles = {
+        'default': {},
+        'profile': {'sqlite': {}},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        print(f'{"profile":<10}{"inserts/s":>12}{"reads/s":>12}')
+        for name, options in profiles.items():
+            result = run(*make_db(work_dir, f'{name}.sqlite', options))
+            print(f'{name:<10}{result["inserts/s"]:>12.0f}{result["reads/s"]:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+benchmarks.statement_template
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+比较每次请求重新构建语句与使用 ``pyape.db.statement_template`` 缓存的语句模板，
+在 Python 端构建语句的开销。
+
+- build: 构建语句并计算 SQLAlchemy 编译缓存使用的缓存键，不访问数据库。
+- execute: 在内存 sqlite 中执行语句并取得第一行。
+
+    python benchmarks/statement_template.py
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).parent.parent.resolve().as_posix())
+
+from sqlalchemy import Column, Integer, SMALLINT, VARCHAR, select, bindparam
+
+from pyape.db import SQLAlchemy, statement_template
+
+ROUNDS = 20000
+
+sql = SQLAlchemy(URI='sqlite://')
+
+
+class Vo(sql.Model()):
+    __tablename__ = 'vo'
+    vid = Column(Integer, primary_key=True)
+    r = Column(SMALLINT, nullable=False)
+    name = Column(VARCHAR(32), nullable=False, unique=True)
+    votype = Column(SMALLINT, nullable=False)
+    index = Column(SMALLINT, nullable=False)
+    status = Column(SMALLINT, nullable=False)
+    createtime = Column(Integer, nullable=False)
+
+
+def rebuild(i: int) -> tuple:
+    stmt = select(Vo).where(Vo.r == 1000, Vo.votype == 307, Vo.name == f'r1000_{i % 100}', Vo.status == 1).\
+        order_by(Vo.status, Vo.index, Vo.createtime.desc()).limit(1)
+    return stmt, None
+
+
+@statement_template
+def vo_stmt(vo_cls):
+    return select(vo_cls).where(
+        vo_cls.r == bindparam('r'),
+        vo_cls.votype == bindparam('votype'),
+        vo_cls.name == bindparam('name'),
+        vo_cls.status == 1,
+    ).order_by(vo_cls.status, vo_cls.index, vo_cls.createtime.desc()).limit(1)
+
+
+def template(i: int) -> tuple:
+    return vo_stmt(Vo), {'r': 1000, 'votype': 307, 'name': f'r1000_{i % 100}'}
+
+
+def bench_build(make) -> float:
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        stmt, _ = make(i)
+        stmt._generate_cache_key()
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def bench_execute(make) -> float:
+    session = sql.session()
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        stmt, params = make(i)
+        session.execute(stmt, params).first()
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def main():
+    sql.create_all()
+    s = sql.session()
+    s.add_all(
+        Vo(vid=i, r=1000, name=f'r1000_{i}', votype=307, index=0, status=1, createtime=i)
+        for i in range(100)
+    )
+    s.commit()
+    print(f'{"":<10}{"build us":>12}{"execute us":>12}')
+    for name, make in (('rebuild', rebuild), ('template', template)):
+        print(f'{name:<10}{bench_build(make):>12.1f}{bench_execute(make):>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -58,6 +58,17 @@ def init_db(pyape_app: PyapeFlask, create_args: dict = None):
     dbinst = None if create_args is None else create_args.get('dbinst')
     gdb = PyapeDB(app=pyape_app, dbinst=dbinst)
     pyape_app._gdb = gdb
+    # 调试模式下或者配置了 endpoint 时提供查看连接池统计的接口
+    endpoint = pyape_app._gconf.getcfg('SQLALCHEMY', 'POOL_STATS_ENDPOINT')
+    if endpoint is None and pyape_app.debug:
+        endpoint = '/_pyape/pool_stats'
+    if endpoint:
+        pyape_app.add_url_rule(endpoint, 'pyape_pool_stats', _pool_stats_view)
+
+
+def _pool_stats_view():
+    """返回当前 worker 中所有数据库连接池的统计数据。"""
+    return flask.jsonify({str(bind_key): stats for bind_key, stats in gdb.dbm.pool_stats().items()})
 
 
 def init_redis(pyape_app: PyapeFlask, create_args: dict = None):
@@ -107,18 +118,46 @@ def init_cache(pyape_app: PyapeFlask, create_args: dict = None):
     global gcache
     if gcache is not None:
         raise ValueError('global cache 不能重复定义！')
-    cache_type = None
+    # 优先使用配置中指定的缓存类型，否则根据运行环境选择
+    cache_type = pyape_app._gconf.getcfg('CACHE', 'TYPE')
     kwargs = {}
-    if grc is None:
-        if uwsgiproxy.in_uwsgi:
+    if cache_type is None:
+        if grc is not None:
+            cache_type = 'redis'
+        elif uwsgiproxy.in_uwsgi:
             cache_type = 'uwsgi'
         else:
             cache_type = 'file'
-            kwargs['fpath'] = pyape_app._gconf.getdir('cache.toml')
-    else:
-        cache_type = 'redis'
+    if cache_type == 'redis':
         kwargs['grc'] = grc
+    elif cache_type == 'file':
+        kwargs['fpath'] = pyape_app._gconf.getdir('cache.toml')
+    elif cache_type == 'shm':
+        shm_cfg = pyape_app._gconf.getcfg('CACHE', 'SHM') or {}
+        kwargs['fpath'] = pyape_app._gconf.getdir(shm_cfg.get('path', 'cache.shm'))
+        kwargs['shm'] = shm_cfg
+    # 一级缓存配置，提供后在每个 worker 中启用进程内缓存
+    kwargs['local'] = pyape_app._gconf.getcfg('CACHE', 'LOCAL')
+    kwargs['codec'] = pyape_app._gconf.getcfg('CACHE', 'CODEC')
+    stats_cfg = pyape_app._gconf.getcfg('CACHE', 'STATS')
+    if isinstance(stats_cfg, dict) and stats_cfg.get('dir'):
+        stats_cfg = dict(stats_cfg, dir=pyape_app._gconf.getdir(stats_cfg['dir']))
+    kwargs['stats'] = stats_cfg
     gcache = GlobalCache.from_config(cache_type, **kwargs)
+    if gcache.cache_stats is None:
+        return
+    # 调试模式下或者配置了 endpoint 时提供查看统计数据的接口
+    endpoint = stats_cfg.get('endpoint')
+    if endpoint is None and pyape_app.debug:
+        endpoint = '/_pyape/cache_stats'
+    if endpoint:
+        pyape_app.add_url_rule(endpoint, 'pyape_cache_stats', _cache_stats_view)
+
+
+def _cache_stats_view():
+    """返回全局缓存的统计数据，?aggregate=1 汇总所有 worker。"""
+    aggregate = flask.request.args.get('aggregate') in ('1', 'true')
+    return flask.jsonify(gcache.stats(aggregate=aggregate))
 
 
 def register_blueprint(pyape_app, rest_package, rest_package_names) -> None:
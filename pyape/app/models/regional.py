@@ -9,9 +9,10 @@ import tomli as tomllib
 from sqlalchemy.orm import Query, Session
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.types import Enum, SMALLINT, VARCHAR, INTEGER, FLOAT, TEXT, TIMESTAMP
-from sqlalchemy import  Column, ForeignKey
+from sqlalchemy import  Column, ForeignKey, select, bindparam
 
 from pyape.app import gdb, logger
+from pyape.db import statement_template
 from pyape.config import RegionalConfig
 from pyape.util.func import parse_int
 
@@ -28,6 +29,22 @@ def r2type(r):
     return None
 
 
+# rtype 对应的 r 值范围
+RTYPE_RANGES = {1000: (1000, 1999), 2000: (2000, 2999)}
+
+
+@statement_template
+def _regional_qry_clauses(regional_cls, has_kindtype: bool, has_rtype: bool, has_status: bool) -> tuple:
+    cause = []
+    if has_kindtype:
+        cause.append(regional_cls.kindtype == bindparam('regional_kindtype'))
+    if has_status:
+        cause.append(regional_cls.status == bindparam('regional_status'))
+    if has_rtype:
+        cause.append(regional_cls.r.between(bindparam('regional_rlow'), bindparam('regional_rhigh')))
+    return tuple(cause), (regional_cls.status, regional_cls.createtime.desc())
+
+
 def get_regional_qry(regional_cls, kindtype=None, rtype=None, status=None) -> Query:
     """ 获取排序过的 Regional 项目，可以根据 kindtype/rtype/status 筛选
     :param kindtype:
@@ -35,21 +52,18 @@ def get_regional_qry(regional_cls, kindtype=None, rtype=None, status=None) -> Qu
     :param status:
     :return:
     """
-    cause = []
+    cause, order = _regional_qry_clauses(
+        regional_cls, kindtype is not None, rtype is not None, status is not None
+    )
+    params = {}
     if kindtype is not None:
-        cause.append(regional_cls.kindtype == kindtype)
+        params['regional_kindtype'] = kindtype
     if status is not None:
-        cause.append(regional_cls.status == status)
+        params['regional_status'] = status
     if rtype is not None:
-        if rtype == 1000:
-            cause.append(regional_cls.r.between(1000, 1999))
-        elif rtype == 2000:
-            cause.append(regional_cls.r.between(2000, 2999))
-        else:
-            cause.append(regional_cls.r.between(5000, 5999))
-    return gdb.query(regional_cls).\
-            filter(*cause).\
-            order_by(regional_cls.status, regional_cls.createtime.desc())
+        params['regional_rlow'], params['regional_rhigh'] = RTYPE_RANGES.get(rtype, (5000, 5999))
+    qry = gdb.query(regional_cls).filter(*cause).order_by(*order)
+    return qry.params(params) if params else qry
 
 
 def make_regional_table_cls(table_name: str='regional', bind_key: str=None):
@@ -109,20 +123,25 @@ def get_regional_config(regional_cls, status=None):
     return RegionalConfig(regional_list)
 
 
+@statement_template
+def _enabled_regional_stmt(regional_cls):
+    return select(regional_cls).where(
+        regional_cls.status == 1, regional_cls.r == bindparam('r')
+    ).limit(1)
+
+
 def check_regional(regional_cls, r: int, ignore_zero: bool=False):
     """ 检查 regional 是否有效，同时返回数据库中查询到的 regional 配置
     :param ignore_zero: 值为真，则允许 r 值为 0。0 是一个特殊的 r 值，代表全局 r
     :return: 已经转换成整数的 regional 值，以及数据库中查到的 regional 配置
     """
-    qry = gdb.query(regional_cls)
     r = parse_int(r)
     if r is None:
         return None, None
-    if ignore_zero:
-        if r == 0:
-            return 0, qry.filter_by(status=1, r=0).first()
     # 从数据库中的启用的 regional 中查找
-    regional = qry.filter_by(status=1, r=r).first()
+    regional = gdb.session().scalars(_enabled_regional_stmt(regional_cls), {'r': r}).first()
+    if ignore_zero and r == 0:
+        return 0, regional
     if regional is None:
         return None, None
     return r, regional
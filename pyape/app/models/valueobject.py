@@ -14,9 +14,10 @@ import tomli_w
 from sqlalchemy.sql.expression import or_
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.types import Enum, SMALLINT, VARCHAR, INTEGER, FLOAT, TEXT, TIMESTAMP
-from sqlalchemy import  Column, ForeignKey
+from sqlalchemy import  Column, ForeignKey, select, bindparam
 
 from pyape.app import gdb, logger
+from pyape.db import statement_template
 
 
 def dump_value(value, type_='json'):
@@ -163,10 +164,15 @@ def get_vo_fullname(r, name):
     return 'r%s_%s' % (r, name)
 
 
+@statement_template
+def _enabled_vo_stmt(vo_cls):
+    return select(vo_cls).where(vo_cls.name == bindparam('name'), vo_cls.status == 1).limit(1)
+
+
 def get_vo_by_fullname(vo_cls, fullname: str, type_=None, merge=None, bind_key: str=None):
     """ 获取一个 vo，此处提供的 name 完整名称
     """
-    vo = gdb.query(vo_cls).filter_by(name=fullname, status=1).first()
+    vo = gdb.session().scalars(_enabled_vo_stmt(vo_cls), {'name': fullname}).first()
     if vo is not None:
         if isinstance(merge, list):
             return vo.merge(merge, type_)
@@ -181,19 +187,29 @@ def get_vo_by_name(vo_cls, r:int, name: str, type_=None, merge=None, bind_key: s
     return get_vo_by_fullname(vo_cls, fullname, type_, merge, bind_key=bind_key)
 
 
+@statement_template
+def _vo_query_clauses(vo_cls, has_votype: bool, has_status: bool) -> tuple:
+    cause = [vo_cls.r == bindparam('vo_r')]
+    if has_votype:
+        cause.append(vo_cls.votype == bindparam('vo_votype'))
+    if has_status:
+        cause.append(vo_cls.status == bindparam('vo_status'))
+    return tuple(cause), (vo_cls.status, vo_cls.index, vo_cls.createtime.desc())
+
+
 def get_vo_query(vo_cls, r: int, votype: int=None, status=None):
     """ 获取排序过的 ValueObject 项目，可以根据 usertype 和 status 筛选
     :param votype:
     :param status:
     :return:
     """
-    cause = [vo_cls.r == r]
+    cause, order = _vo_query_clauses(vo_cls, votype is not None, status is not None)
+    params = {'vo_r': r}
     if votype is not None:
-        cause.append(vo_cls.votype == votype)
+        params['vo_votype'] = votype
     if status is not None:
-        cause.append(vo_cls.status == status)
-    return gdb.query(vo_cls).filter(*cause).\
-            order_by(vo_cls.status, vo_cls.index, vo_cls.createtime.desc())
+        params['vo_status'] = status
+    return gdb.query(vo_cls).filter(*cause).order_by(*order).params(params)
 
 
 def get_vos_vidname(vo_cls, votype: int):
@@ -6,15 +6,18 @@ pyape.app.re2fun
 re2 = request + response
 """
 
+import io
+import csv
+import json
 from pathlib import Path
 from datetime import datetime
 from typing import Union
 
-from flask import request, jsonify, make_response, send_file
+from flask import request, jsonify, make_response, send_file, Response, stream_with_context
 from sqlalchemy.orm import Query
 
-from pyape.app import gdb, logger
-from pyape.db import Pagination
+from pyape.app import gdb, gcache, logger
+from pyape.db import Pagination, KeysetPagination, CachedTotal, EstimatedTotal, WindowTotal
 from pyape.util.func import parse_float, parse_date, daydt
 
 
@@ -182,6 +185,9 @@ def get_page_response(
     return_method=None,
     replaceobj=None,
     replaceobj_key_only=False,
+    cursor: str = None,
+    total: str = 'window',
+    total_ttl: int = 60,
     **kwargs
 ):
     """ 获取一个多页响应对象
@@ -194,25 +200,58 @@ def get_page_response(
         若值不为 None 根据特定的方式转换 pages.items，返回 data 对象而非 Response 对象，同时会 ignore ``**kwargs`` 参数。
     :param replaceobj: 见 re2fun.responseto
     :param replaceobj_key_only:  见 re2fun.responseto
+    :param cursor: 若不为 None 则使用游标分页，忽略 page，第一页传递空字符串。
+        游标分页不返回总数和页码，使用返回的 next_cursor/prev_cursor 获取下一页和上一页。
+    :param total: 获取总数的方式。window 使用 COUNT(*) OVER() 在同一个查询中获取总数，
+        数据库不支持窗口函数时与 exact 相同；exact 每次执行 COUNT；
+        cached 将 COUNT 结果在 gcache 中缓存 total_ttl 秒；
+        estimated 对没有筛选条件的单表查询使用数据库的统计信息估算。
+    :param total_ttl: total 为 cached 时的缓存秒数。
     :param kwargs: 见 re2fun.responseto
     :return: 一个多页响应对象
     """
     data = None
     if isinstance(query, Query):
         try:
-            pagi: Pagination = Pagination.paginate(query, int(page), int(per_page))
-            data = dict(
-                page=pagi.page,
-                prev_num=pagi.prev_num,
-                next_num=pagi.next_num,
-                has_next=pagi.has_next,
-                has_prev=pagi.has_prev,
-                pages=pagi.pages,
-                total=pagi.total,
-                per_page=pagi.per_page,
-                error=False,
-                code=200,
-            )
+            if cursor is not None:
+                pagi: KeysetPagination = KeysetPagination.paginate(query, cursor, int(per_page))
+                data = dict(
+                    page=None,
+                    prev_num=None,
+                    next_num=None,
+                    has_next=pagi.has_next,
+                    has_prev=pagi.has_prev,
+                    pages=None,
+                    total=None,
+                    per_page=pagi.per_page,
+                    next_cursor=pagi.next_cursor,
+                    prev_cursor=pagi.prev_cursor,
+                    error=False,
+                    code=200,
+                )
+            else:
+                total_strategy = None
+                if total == 'window':
+                    total_strategy = WindowTotal()
+                elif total == 'cached' and gcache is not None:
+                    total_strategy = CachedTotal(gcache, total_ttl)
+                elif total == 'estimated':
+                    total_strategy = EstimatedTotal()
+                pagi: Pagination = Pagination.paginate(
+                    query, int(page), int(per_page), total_strategy=total_strategy
+                )
+                data = dict(
+                    page=pagi.page,
+                    prev_num=pagi.prev_num,
+                    next_num=pagi.next_num,
+                    has_next=pagi.has_next,
+                    has_prev=pagi.has_prev,
+                    pages=pagi.pages,
+                    total=pagi.total,
+                    per_page=pagi.per_page,
+                    error=False,
+                    code=200,
+                )
             if callable(return_method):
                 data[itemskey] = return_method(pagi.items)
                 return data
@@ -277,3 +316,42 @@ def get_download_response(
         response.headers['Content-Type'] = content_type
     return response
 
+
+def get_stream_response(
+    stmt,
+    filename: str = None,
+    fmt: str = 'csv',
+    batch_size: int = 1000,
+    bind_key: str = None,
+):
+    """ 流式导出查询结果，边从数据库读取边发送，内存占用与结果总数无关。
+
+    :param stmt: select 语句，应选择具体的列而非 Model。
+    :param filename: 提供则作为附件下载。
+    :param fmt: csv 或者 ndjson（每行一个 json 对象）。
+    :param batch_size: 每次从数据库读取并发送的行数。
+    """
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError(f'get_stream_response does not support {fmt}!')
+
+    def generate():
+        first = True
+        for partition in gdb.stream(stmt, batch_size, bind_key, partitions=True):
+            buf = io.StringIO()
+            if fmt == 'csv':
+                writer = csv.writer(buf)
+                if first:
+                    writer.writerow(partition[0]._fields)
+                writer.writerows(partition)
+            else:
+                for row in partition:
+                    buf.write(json.dumps(row._asdict(), default=str, ensure_ascii=False))
+                    buf.write('\n')
+            first = False
+            yield buf.getvalue()
+
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(generate()), content_type=content_type)
+    if filename is not None:
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
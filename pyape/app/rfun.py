@@ -21,15 +21,17 @@ from pyape.util.func import parse_int
 from pyape.app.models.regional import get_regional_qry
 
 
-def regional_get_more(regional_cls, page, per_page, kindtype, status, merge):
+def regional_get_more(regional_cls, page, per_page, kindtype, status, merge, cursor=None):
     """ 分页获取指定 votype 下的 ValueObject 信息
+
+    :param cursor: 若不为 None 则使用游标分页，见 re2fun.get_page_response
     """
     if merge > 0:
         return_method = lambda vos: [vo.merge() for vo in vos] 
     else:
         return_method = 'model'
     qry = get_regional_qry(regional_cls, kindtype=kindtype, status=status)
-    rdata = get_page_response(qry, page, per_page, 'regionals', return_method)
+    rdata = get_page_response(qry, page, per_page, 'regionals', return_method, cursor=cursor)
     return responseto(data=rdata)
 
 
@@ -19,15 +19,17 @@ from pyape.app.re2fun import responseto, get_page_response
 
 
 # @checker.request_checker('votype', 'status', 'merge', defaultvalue={'merge': 1, 'status': 1}, request_key='args', parse_int_params=['merge', 'status', 'votype'])
-def valueobject_get_more(r, page, per_page, votype, status, merge, return_dict=False):
+def valueobject_get_more(r, page, per_page, votype, status, merge, return_dict=False, cursor=None):
     """ 分页获取指定 votype 下的 ValueObject 信息
+
+    :param cursor: 若不为 None 则使用游标分页，见 re2fun.get_page_response
     """
     if merge > 0:
         return_method = lambda vos: [vo.merge() for vo in vos] 
     else:
         return_method = 'model'
     qry = get_vo_query(r, votype, status)
-    rdata = get_page_response(qry, page, per_page, 'vos', return_method)
+    rdata = get_page_response(qry, page, per_page, 'vos', return_method, cursor=cursor)
     return responseto(data=rdata, return_dict=return_dict)
 
 
@@ -44,14 +46,28 @@ def valueobject_get_all(r, votype, status, merge, return_dict=False):
 def _get_vo_by_cache(r, name):
     """ 从缓存中查询 vo 的 value
     若缓存中不存在，则从数据库中查询并将其写入缓存
+    多个 worker 同时未命中时，只有一个会查询数据库
     """
-    valueobj = gcache.getg(name, r)
-    if valueobj is None:
+    def loader():
         vo = gdb.session().scalar(select(ValueObject).filter_by(name=name))
-        if vo is not None:
-            valueobj = vo.get_value()
-            gcache.setg(name, valueobj, r)
-    return valueobj
+        return None if vo is None else vo.get_value()
+    return gcache.get_or_set(name, loader, r)
+
+
+def _get_vos_by_cache(r, names):
+    """ 批量从缓存中查询 vo 的 value，返回以 name 为键的 dict
+    缓存中不存在的 vo 使用一次数据库查询获取，并批量写入缓存
+    """
+    valueobjs = gcache.mgetg(names, r)
+    misses = [name for name, valueobj in valueobjs.items() if valueobj is None]
+    if misses:
+        newvalues = {}
+        for vo in gdb.session().scalars(select(ValueObject).filter(ValueObject.name.in_(misses))):
+            newvalues[vo.name] = vo.get_value()
+        if newvalues:
+            gcache.msetg(newvalues, r)
+            valueobjs.update(newvalues)
+    return valueobjs
 
 
 def valueobject_check_value(value, valuetype):
@@ -252,4 +268,4 @@ def update_cache(votype, r):
         if vo.value is not None:
             # logger.info('vofun.update_cache %s', vo.get_value())
             allcache[vo.name] = vo.get_value()
-    gcache.mset(allcache, r)
+    gcache.msetg(allcache, r)
@@ -0,0 +1,186 @@
+"""
+pyape.asyncdb
+-------------------
+
+基于 asyncio 的数据库支持，与 ``pyape.db`` 共享配置、Model 和 bind_key。
+
+需要安装 greenlet 和对应数据库的异步驱动，例如 aiosqlite/aiomysql/asyncpg。
+"""
+import asyncio
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_scoped_session,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from pyape.db import DBManager, RoutingSession, SQLAlchemy
+
+
+class AsyncDBManager(object):
+    """ 管理异步 Engine 和 AsyncSession。
+
+    使用 ``DBManager`` 中的 URI 和 Model，根据 Model 的 bind_key 选择数据库。
+    Engine 在第一次使用时创建。
+
+    :param dbm: ``DBManager`` 实例。
+    """
+
+    ASYNC_DRIVERS: dict = {
+        'sqlite': 'sqlite+aiosqlite',
+        'mysql': 'mysql+aiomysql',
+        'mysql+pymysql': 'mysql+aiomysql',
+        'postgresql': 'postgresql+asyncpg',
+        'postgresql+psycopg2': 'postgresql+asyncpg',
+    }
+    """ 同步驱动到异步驱动的映射，URI 中已经使用异步驱动时保持不变。"""
+
+    dbm: DBManager = None
+
+    Session_Factory: async_sessionmaker = None
+    """ AsyncSession 工厂，使用 async_sessionmaker 生成。"""
+
+    def __init__(self, dbm: DBManager) -> None:
+        self.dbm = dbm
+        self.__engines: dict = {}
+        self.__engine_lock = Lock()
+        # 同步的 RoutingSession 通过 dbm 参数调用本对象的 get_engine_for
+        self.Session_Factory = async_sessionmaker(
+            autoflush=False,
+            expire_on_commit=False,
+            sync_session_class=RoutingSession,
+            dbm=self,
+        )
+
+    @property
+    def default_bind_key(self) -> str:
+        return self.dbm.default_bind_key
+
+    def async_url(self, uri: str) -> URL:
+        """ 将同步驱动的地址转换为异步驱动的地址。"""
+        sa_url: URL = make_url(uri)
+        drivername = self.ASYNC_DRIVERS.get(sa_url.drivername, sa_url.drivername)
+        sa_url = sa_url.set(drivername=drivername)
+        if sa_url.drivername.startswith('mysql'):
+            query = dict(sa_url.query)
+            query.setdefault('charset', 'utf8')
+            sa_url = sa_url.set(query=query)
+        return sa_url
+
+    def __create_engine(self, uri: str, bind_key: str = None) -> AsyncEngine:
+        sa_url = self.async_url(uri)
+        options: dict = self.dbm.engine_options(bind_key)
+        # 以下配置仅用于同步 Engine
+        options.pop('sqlite', None)
+        options.pop('future', None)
+        options.pop('warmup', None)
+        if sa_url.drivername.startswith('mysql'):
+            options.setdefault('pool_recycle', 7200)
+        engine = create_async_engine(sa_url, **options)
+
+        if sa_url.drivername.startswith('sqlite'):
+            # 与同步 Engine 相同，强制 SQLITE 支持外键
+            @event.listens_for(engine.sync_engine, 'connect')
+            def set_sqlite_pragma(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute('PRAGMA foreign_keys=ON;')
+                cursor.close()
+
+        if self.dbm.instrument is not None:
+            self.dbm.instrument.attach(engine.sync_engine)
+        return engine
+
+    def get_engine(self, bind_key: str = None) -> AsyncEngine:
+        """ 获取一个 AsyncEngine 对象，第一次获取时创建。"""
+        bind_key = bind_key or self.default_bind_key
+        engine = self.__engines.get(bind_key)
+        if engine is not None:
+            return engine
+        uri = self.dbm.get_uri(bind_key)
+        if uri is None:
+            return None
+        with self.__engine_lock:
+            engine = self.__engines.get(bind_key)
+            if engine is None:
+                engine = self.__create_engine(uri, bind_key)
+                self.__engines[bind_key] = engine
+        return engine
+
+    def get_engine_for(self, mapper=None, clause=None):
+        """ 供 RoutingSession 调用，返回 AsyncEngine 对应的同步 Engine。"""
+        found, bind_key = self.dbm.get_bind_key_for(mapper, clause)
+        if not found:
+            return None
+        return self.get_engine(bind_key).sync_engine
+
+    def replica_set_for(self, engine):
+        # 异步 Session 不使用副本
+        return None
+
+    def create_new_session(self) -> AsyncSession:
+        """ 创建一个 AsyncSession 对象。"""
+        return self.Session_Factory()
+
+    def create_scoped_session(self) -> async_scoped_session:
+        """ 创建一个以当前 asyncio task 为作用域的 AsyncSession 代理。"""
+        return async_scoped_session(self.Session_Factory, scopefunc=asyncio.current_task)
+
+    async def dispose_engines(self) -> None:
+        """ 关闭所有异步 Engine 的连接池。"""
+        for engine in list(self.__engines.values()):
+            await engine.dispose()
+
+
+class AsyncSQLAlchemy(object):
+    """ ``SQLAlchemy`` 的异步版本，与其共享 Model 和 bind_key。
+
+    在 Flask 的 async view 中，每个请求运行在新的事件循环中，
+    而连接不能跨事件循环使用，此时应在 ENGINE_OPTIONS 中使用 NullPool。
+    在 ASGI 服务中可以正常使用连接池。
+
+    :param sql: ``SQLAlchemy`` 或者 ``DBManager`` 的实例，例如 ``pyape.app.gdb`` 。
+    """
+
+    dbm: AsyncDBManager = None
+
+    Session: async_scoped_session = None
+    """ 以当前 asyncio task 为作用域的 AsyncSession 代理。"""
+
+    def __init__(self, sql: SQLAlchemy | DBManager) -> None:
+        if isinstance(sql, SQLAlchemy):
+            sql = sql.dbm
+        self.dbm = AsyncDBManager(sql)
+        self.Session = self.dbm.create_scoped_session()
+
+    def Model(self, bind_key: str = None):
+        """ 获取对应的 Model Factory class，与同步的 ``SQLAlchemy.Model`` 相同。"""
+        return self.dbm.dbm.get_Model(bind_key)
+
+    def engine(self, bind_key: str = None) -> AsyncEngine:
+        return self.dbm.get_engine(bind_key)
+
+    def async_session(self) -> AsyncSession:
+        """ 获取当前 asyncio task 的 AsyncSession。
+        task 结束前应调用 ``await remove()`` 。
+        """
+        return self.Session()
+
+    async def remove(self) -> None:
+        """ 关闭并移除当前 asyncio task 的 AsyncSession。"""
+        await self.Session.remove()
+
+    async def create_all(self) -> None:
+        """ 创建所有数据库中的所有表。"""
+        for bind_key in self.dbm.dbm.bind_keys:
+            metadata = self.Model(bind_key).metadata
+            async with self.engine(bind_key).begin() as conn:
+                await conn.run_sync(metadata.create_all, checkfirst=True)
+
+    async def dispose(self) -> None:
+        """ 关闭所有连接，应在事件循环结束前调用。"""
+        await self.dbm.dispose_engines()
@@ -3,99 +3,688 @@ pyape.cache
 ~~~~~~~~~~~~~~~~~~~
 提供全局缓存的读取和写入
 """
+import os
+import abc
+import atexit
+import bisect
+import socket
 import warnings
 import pickle
-from typing import Any
+import random
+import re
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable
 from redis.client import Redis
+from redis.exceptions import RedisError
 from pyape import uwsgiproxy
+from pyape.shm import SharedHashTable
+from pyape.util.func import register_after_fork
 from pathlib import Path
 import tomllib, tomli_w
 import json
+import math
 import time
+import zlib
 
+try:
+    import fcntl
+except ImportError:
+    # 非 POSIX 平台不支持 fcntl，此时仅使用线程锁
+    fcntl = None
 
-class Cache(object):
-    """ 处理缓存。
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+def _default_file_mode() -> int:
+    """ 按照 umask 计算新建文件的权限，与 open 创建的文件相同。"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# 在导入时计算，避免在多线程中临时修改 umask
+DEFAULT_FILE_MODE = _default_file_mode()
+
+
+class Codec(abc.ABC):
+    """ 缓存值的编解码器，将 Python 对象转换为 bytes。
+    """
+    name: str = None
+    cid: int = 0
+    """ 编码器编号，写入头字节的低 4 位，范围 1-15。"""
+
+    @abc.abstractmethod
+    def dumps(self, value: Any) -> bytes:
+        """ 将 value 编码为 bytes。"""
+
+    @abc.abstractmethod
+    def loads(self, raw: bytes) -> Any:
+        """ 将 dumps 的结果解码为 Python 对象。"""
+
+
+class PickleCodec(Codec):
+    """ 支持所有的 Python 对象，但只能被 Python 读取。"""
+    name = 'pickle'
+    cid = 1
+
+    def dumps(self, value: Any) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, raw: bytes) -> Any:
+        return pickle.loads(raw, encoding='utf8')
+
+
+class JSONCodec(Codec):
+    """ 可以被非 Python 服务读取，安装了 orjson 时使用 orjson。"""
+    name = 'json'
+    cid = 2
+
+    def dumps(self, value: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(value)
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, raw: bytes) -> Any:
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw)
+
+
+class MsgpackCodec(Codec):
+    """ 二进制格式，体积和速度都优于 JSON，需要安装 msgpack。"""
+    name = 'msgpack'
+    cid = 3
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('MsgpackCodec requires msgpack!')
+
+    def dumps(self, value: Any) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, raw: bytes) -> Any:
+        return msgpack.unpackb(raw, raw=False)
+
+
+CODECS: dict[str, type[Codec]] = {
+    c.name: c for c in (PickleCodec, JSONCodec, MsgpackCodec)
+}
+""" 可用的编码器，以名称为键。"""
+
+COMPRESSIONS: tuple[str] = ('zlib', 'lz4')
+""" 可用的压缩算法，序号加 1 写入头字节的高 4 位。"""
+
+
+class ValueSerializer(object):
+    """ 缓存后端使用的序列化器，由一个 Codec 和可选的压缩组成。
+
+    序列化后的值以一个头字节开始，低 4 位是 Codec 编号，高 4 位是压缩算法，
+    因此不同的格式可以在迁移期间共存。
+    pickle 的输出总是以 0x80 开始，为了兼容旧的缓存值，
+    未压缩的 pickle 值不加头字节，解码时以 0x80 开头的值直接使用 pickle 解码。
+
+    :param codec: Codec 名称，见 ``CODECS``。
+    :param compression: 压缩算法名称，见 ``COMPRESSIONS``，None 代表不压缩。
+    :param threshold: 编码后的字节数超过该值时才压缩。
+    :param level: 压缩级别，仅用于 zlib。
+    :param header: 是否写入头字节。
+        若缓存需要被非 Python 服务直接读取，可设置为 False，此时不能压缩，也不能混用格式。
+    """
+
+    codec: Codec = None
+    compression: str = None
+    threshold: int = 1024
+    level: int = 1
+    header: bool = True
+
+    def __init__(
+        self,
+        codec: str = 'pickle',
+        compression: str = None,
+        threshold: int = 1024,
+        level: int = 1,
+        header: bool = True,
+    ):
+        codec_cls = CODECS.get(codec)
+        if codec_cls is None:
+            raise ValueError(f'ValueSerializer codec only supports {tuple(CODECS)}!')
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f'ValueSerializer compression only supports {COMPRESSIONS}!')
+        if compression == 'lz4' and lz4frame is None:
+            raise ImportError('lz4 compression requires lz4!')
+        if compression is not None and not header:
+            raise ValueError('ValueSerializer compression requires header!')
+        self.codec = codec_cls()
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
+        self.header = header
+        # 按编号保存已经实例化的 Codec，用于解码其他格式的值
+        self.__codecs = {self.codec.cid: self.codec}
+
+    @classmethod
+    def from_config(cls, config: dict = None) -> 'ValueSerializer':
+        """ 使用 ``[CACHE.CODEC]`` 配置创建序列化器，未配置时使用 pickle。"""
+        if not config:
+            return cls()
+        return cls(
+            codec=config.get('name', 'pickle'),
+            compression=config.get('compression'),
+            threshold=config.get('threshold', cls.threshold),
+            level=config.get('level', cls.level),
+            header=config.get('header', cls.header),
+        )
+
+    def _get_codec(self, cid: int) -> Codec:
+        codec = self.__codecs.get(cid)
+        if codec is None:
+            for codec_cls in CODECS.values():
+                if codec_cls.cid == cid:
+                    codec = codec_cls()
+                    self.__codecs[cid] = codec
+                    break
+            else:
+                raise ValueError(f'{self!s} unknown codec {cid}!')
+        return codec
+
+    def dumps(self, value: Any) -> bytes:
+        raw = self.codec.dumps(value)
+        if not self.header:
+            return raw
+        ctype = 0
+        if self.compression is not None and len(raw) > self.threshold:
+            if self.compression == 'zlib':
+                raw = zlib.compress(raw, self.level)
+            else:
+                raw = lz4frame.compress(raw)
+            ctype = COMPRESSIONS.index(self.compression) + 1
+        elif self.codec.cid == PickleCodec.cid:
+            return raw
+        return bytes(((ctype << 4) | self.codec.cid,)) + raw
+
+    def loads(self, raw: bytes) -> Any:
+        if not self.header:
+            return self.codec.loads(raw)
+        head = raw[0]
+        if head == 0x80:
+            return pickle.loads(raw, encoding='utf8')
+        ctype = head >> 4
+        body = memoryview(raw)[1:]
+        if ctype == 1:
+            body = zlib.decompress(body)
+        elif ctype == 2:
+            if lz4frame is None:
+                raise ImportError('lz4 compression requires lz4!')
+            body = lz4frame.decompress(body)
+        elif ctype != 0:
+            raise ValueError(f'{self!s} unknown compression {ctype}!')
+        return self._get_codec(head & 0x0F).loads(bytes(body))
+
+    def __str__(self) -> str:
+        return f'{self.__class__.__name__} {self.codec.name} compression: {self.compression}'
+
+
+class Cache(abc.ABC):
+    """ 处理缓存。子类需要实现 ``__getitem__`` 、 ``set`` 、 ``delete`` 和 ``delete_prefix`` 。
     """
     ctype: str = None
-    """ 保存缓存的类型，目前支持三种缓存： uwsgi/dict/redis。"""
+    """ 保存缓存的类型，目前支持五种缓存： uwsgi/dict/file/shm/redis。"""
     def __init__(self, ctype: str):
         self.ctype = ctype
+        # 记录当前线程最近一次操作读写的序列化字节数，供 CacheStats 使用
+        self._io = threading.local()
+
+    def _count_io(self, read: int = 0, written: int = 0) -> None:
+        self._io.read = getattr(self._io, 'read', 0) + read
+        self._io.written = getattr(self._io, 'written', 0) + written
+
+    def take_io(self) -> tuple[int, int]:
+        """ 返回并清零当前线程读写的字节数 (read, written)。"""
+        read = getattr(self._io, 'read', 0)
+        written = getattr(self._io, 'written', 0)
+        self._io.read = self._io.written = 0
+        return read, written
+
+    @abc.abstractmethod
+    def __getitem__(self, name: str) -> Any:
+        """ 获取缓存，不存在时返回 None。"""
+
+    @abc.abstractmethod
+    def set(self, name: str, value: Any, ttl: int = None):
+        """ 设置缓存。
+
+        :param ttl: 过期秒数，None 或 0 代表永不过期。
+        """
+
+    def __setitem__(self, name: str, value: Any):
+        if value is None:
+            self.delete(name)
+            return
+        self.set(name, value)
+
+    def __delitem__(self, name: str):
+        self.delete(name)
+
+    @abc.abstractmethod
+    def delete(self, name: str) -> None:
+        """ 删除一个键，键不存在时不报错。
+        """
+
+    @abc.abstractmethod
+    def delete_prefix(self, prefix: str) -> int:
+        """ 删除所有以 prefix 开头的键，返回删除的数量。
+        """
+
+    def mset(self, nvs: dict, ttl: int = None):
+        """ 批量设置，子类可以使用后端的批量命令覆盖它。
+        """
+        for name, value in nvs.items():
+            self.set(name, value, ttl)
+
+    def mget(self, names: list[str]) -> list:
+        """ 批量获取，按 names 的顺序返回值，不存在的键值为 None。
+        子类可以使用后端的批量命令覆盖它。
+        """
+        return [self[name] for name in names]
+
+    def mget_ttl(self, names: list[str]) -> list[tuple]:
+        """ 批量获取值和剩余的过期秒数，用于确定值在一级缓存中的保存时间。
+
+        :return: (值, 剩余秒数) 的列表，剩余秒数为 None 代表永不过期。
+            默认实现无法获取剩余时间，返回 0，这些值不会写入一级缓存。
+        """
+        return [(value, 0) for value in self.mget(names)]
+
+    def acquire_lock(self, name: str, timeout: float = 10) -> Any:
+        """ 尝试获取一个跨进程的锁，不等待。用于避免多个进程同时加载同一个键。
+
+        :param timeout: 锁的最长持有秒数，持有者崩溃后锁会自动失效。
+        :return: 获取成功返回一个 token，用于 release_lock；被其他进程持有则返回 None。
+            默认实现不做跨进程协调，总是获取成功。
+        """
+        return True
+
+    def release_lock(self, name: str, token: Any) -> None:
+        """ 释放 acquire_lock 获取的锁。"""
+        pass
 
 
 class DictCache(Cache):
     """ 使用一个 Python Dict 保存缓存
     仅用于测试，应该在 单线程/单进程 本地环境使用
+
+    过期采用惰性删除：读取时检查过期时间，
+    写入时每隔 sweep_interval 秒清理一次所有过期的键。
     """
+
+    sweep_interval: float = 60
+    """ 清理过期键的间隔秒数。"""
+
     def __init__(self):
         super().__init__('dict')
         self.__g = {}
+        # name -> 过期时间
+        self.__expires = {}
+        self.__last_sweep = time.monotonic()
         warnings.warn(f'GlobalCache USE {self!s}')
 
     def __getitem__(self, name):
+        expire_at = self.__expires.get(name)
+        if expire_at is not None and expire_at <= time.monotonic():
+            self.__g.pop(name, None)
+            self.__expires.pop(name, None)
+            return None
         return self.__g.get(name)
 
-    def __setitem__(self, name, value):
+    def mget_ttl(self, names: list[str]) -> list[tuple]:
+        result = []
+        for name in names:
+            value = self[name]
+            expire_at = self.__expires.get(name)
+            result.append((value, None if expire_at is None else expire_at - time.monotonic()))
+        return result
+
+    def set(self, name, value, ttl: int = None):
         self.__g[name] = value
+        if ttl:
+            self.__expires[name] = time.monotonic() + ttl
+        else:
+            self.__expires.pop(name, None)
+        self.sweep()
+
+    def delete(self, name):
+        self.__g.pop(name, None)
+        self.__expires.pop(name, None)
+
+    def delete_prefix(self, prefix: str) -> int:
+        names = [n for n in self.__g if n.startswith(prefix)]
+        for name in names:
+            self.delete(name)
+        return len(names)
+
+    def sweep(self, force: bool = False) -> int:
+        """ 清理过期的键，返回清理的数量。"""
+        now = time.monotonic()
+        if not force and now - self.__last_sweep < self.sweep_interval:
+            return 0
+        self.__last_sweep = now
+        expired = [n for n, expire_at in self.__expires.items() if expire_at <= now]
+        for name in expired:
+            self.__g.pop(name, None)
+            self.__expires.pop(name, None)
+        return len(expired)
 
     def __str__(self) -> str:
         return f'{self.__class__.__name__} {id(self.__g)}'
 
 
+class FileKeyLock(object):
+    """ 使用 fcntl 字节范围锁实现的跨进程键锁，用于本地文件类的缓存。
+    键被散列到锁文件的不同字节上，进程退出后锁自动释放。
+
+    fcntl 锁属于进程，同一进程的多个线程都能获取同一个字节，
+    因此每个字节还使用一个线程锁，在持有 fcntl 锁期间一直持有。
+
+    :param lock_path: 锁文件路径。
+    :param stripes: 散列的字节数量。
+    """
+
+    def __init__(self, lock_path: Path, stripes: int = 4096):
+        self.lock_path = lock_path
+        self.stripes = stripes
+        self.__fd = None
+        self.__reset()
+        register_after_fork(self, '_FileKeyLock__reset')
+
+    def __reset(self) -> None:
+        # 子进程中不存在父进程其他线程持有的锁
+        self.__thread_locks: dict = {}
+        self.__thread_locks_lock = threading.Lock()
+
+    def __thread_lock(self, stripe: int) -> threading.Lock:
+        with self.__thread_locks_lock:
+            lock = self.__thread_locks.get(stripe)
+            if lock is None:
+                lock = self.__thread_locks[stripe] = threading.Lock()
+            return lock
+
+    def acquire(self, name: str) -> Any:
+        if fcntl is None:
+            return True
+        if self.__fd is None:
+            self.__fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        stripe = zlib.crc32(name.encode('utf-8')) % self.stripes
+        thread_lock = self.__thread_lock(stripe)
+        if not thread_lock.acquire(blocking=False):
+            return None
+        try:
+            fcntl.lockf(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, stripe)
+        except OSError:
+            thread_lock.release()
+            return None
+        return stripe
+
+    def release(self, token: Any) -> None:
+        if fcntl is None or token is True:
+            return
+        try:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN, 1, token)
+        finally:
+            self.__thread_lock(token).release()
+
+
 class FileCache(Cache):
-    """  使用一个本地文件作为缓存。"""
+    """  使用一个本地文件作为缓存。
+
+    进程内保存一份解析后的快照，仅在文件的 mtime/size/inode 变化时重新载入，
+    因此读取仅是一次 ``os.stat`` 加 dict 查询。
+    写入时使用 fcntl 文件锁在多个 worker 之间互斥，先写入临时文件再 rename 替换，
+    避免并发写入互相覆盖，也避免读取到写了一半的文件。
+
+    过期时间保存在文件的 ``@expires`` 键中，读取时惰性判断，
+    每次写入都会顺带清理所有过期的键。
+
+    缓存文件所在的文件夹中还会创建 ``.lock`` 和 ``.klock`` 两个锁文件，worker 运行时不要删除它们。
+    """
 
     ftype: str = '.toml'
     """ 默认的本地文件类型，支持 toml/json/pickle"""
 
     fpath: Path = None
 
+    lock_path: Path = None
+    """ 多进程写入时使用的锁文件，位于 fpath 同一文件夹。"""
+
     def __init__(self, fpath: Path, ftype: str = None):
         super().__init__('file')
+        if fpath is None:
+            raise ValueError('FileCache need a file!')
         self.fpath = fpath
         self.ftype = ftype or fpath.suffix
-        if self.fpath is None:
-            raise ValueError('FileCache need a file!')
+        self.lock_path = fpath.with_name(f'{fpath.name}.lock')
+        self.key_lock = FileKeyLock(fpath.with_name(f'{fpath.name}.klock'))
+        # 进程内的快照，以及生成快照时文件的 stat 信息
+        self.__snapshot: dict = None
+        self.__snapshot_stat: tuple = None
+        # fcntl 锁仅在进程之间有效，同进程的多个线程还需要线程锁
+        self.__thread_lock = threading.RLock()
         warnings.warn(f'GlobalCache USE {self!s}')
         self.get_cache()
 
-    def get_cache(self) -> dict:
-        if not self.fpath.exists():
-            self.fpath.touch()
-            return {'@cache_created': time.time()}
+    def _stat(self) -> tuple:
+        """ 获取用于判断文件是否变化的 stat 信息，文件不存在返回 None。"""
+        try:
+            st = os.stat(self.fpath)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load(self) -> dict:
+        """ 读取并解析缓存文件。"""
         if self.ftype == '.toml':
             return tomllib.loads(self.fpath.read_text(encoding='utf-8'))
         elif self.ftype == '.json':
-            return json.loads(self.fpath.read_text(encoding='utf-8'))
+            text = self.fpath.read_text(encoding='utf-8')
+            return json.loads(text) if text else {}
         elif self.ftype == '.pickle':
-            return pickle.loads(self.fpath.read_bytes(), encoding='utf-8')
+            raw = self.fpath.read_bytes()
+            return pickle.loads(raw, encoding='utf-8') if raw else {}
         raise ValueError('FileCache.get_cache only supports .toml/.json/.pickle!')
 
-    def set_cache(self, cache_data: dict) -> int:
+    def _dump(self, cache_data: dict) -> bytes:
         if self.ftype == '.toml':
-            return self.fpath.write_text(tomli_w.dumps(cache_data), encoding='utf-8')
+            return tomli_w.dumps(cache_data).encode('utf-8')
         elif self.ftype == '.json':
-            return self.fpath.write_text(json.dumps(cache_data), encoding='utf-8')
+            return json.dumps(cache_data).encode('utf-8')
         elif self.ftype == '.pickle':
-            return self.fpath.write_bytes(pickle.dumps(cache_data, pickle.HIGHEST_PROTOCOL))
+            return pickle.dumps(cache_data, pickle.HIGHEST_PROTOCOL)
         raise ValueError('FileCache.set_cache only supports .toml/.json/.pickle!')
 
+    @contextmanager
+    def _locked(self):
+        """ 获取写锁，同时在线程和进程之间互斥。"""
+        with self.__thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lockf:
+                fcntl.flock(lockf.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+
+    def get_cache(self) -> dict:
+        """ 返回缓存的快照，文件发生变化时才重新载入。
+        返回的 dict 为内部快照，不要直接修改它。
+        """
+        stat = self._stat()
+        if stat is None:
+            with self._locked():
+                # 获得锁之后再检查一次，避免多个 worker 同时创建文件
+                if not self.fpath.exists():
+                    self.set_cache({'@cache_created': time.time()})
+            stat = self._stat()
+        if stat != self.__snapshot_stat:
+            with self.__thread_lock:
+                if stat != self.__snapshot_stat:
+                    self.__snapshot = self._load()
+                    self.__snapshot_stat = stat
+                    # 读取都来自快照，只有重新载入文件时才产生读取的字节数
+                    self._count_io(read=stat[1])
+        return self.__snapshot
+
+    def set_cache(self, cache_data: dict) -> int:
+        """ 将 cache_data 写入临时文件后替换缓存文件，并更新快照。
+        调用者应持有 ``_locked`` 锁，以免与其他 worker 的写入交错。
+        """
+        raw = self._dump(cache_data)
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=f'.{self.fpath.name}.', dir=self.fpath.parent
+        )
+        try:
+            # mkstemp 创建的文件权限为 0600，替换后其他用户的进程将无法读取，需要保持原文件的权限
+            if hasattr(os, 'fchmod'):
+                try:
+                    mode = os.stat(self.fpath).st_mode & 0o7777
+                except FileNotFoundError:
+                    mode = DEFAULT_FILE_MODE
+                os.fchmod(fd, mode)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp_name, self.fpath)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        with self.__thread_lock:
+            self.__snapshot = cache_data
+            self.__snapshot_stat = self._stat()
+        self._count_io(written=len(raw))
+        return len(raw)
+
     def __getitem__(self, name):
-        return self.get_cache().get(name)
+        c = self.get_cache()
+        expires = c.get('@expires')
+        if expires:
+            expire_at = expires.get(name)
+            if expire_at is not None and expire_at <= time.time():
+                return None
+        return c.get(name)
+
+    def _update(self, nvs: dict, ttl: int = None, deletes: Callable = None) -> int:
+        """ 在锁内基于最新的文件内容修改，避免覆盖其他 worker 的写入。
 
-    def __setitem__(self, name, value):
+        :param deletes: 接受键名，返回是否删除该键的函数。
+        :return: 删除的键数量。
+        """
+        with self._locked():
+            now = time.time()
+            c = dict(self.get_cache())
+            expires = dict(c.get('@expires') or {})
+            for name, expire_at in list(expires.items()):
+                if expire_at <= now:
+                    c.pop(name, None)
+                    del expires[name]
+            deleted = 0
+            if deletes is not None:
+                for name in [n for n in c if not n.startswith('@') and deletes(n)]:
+                    del c[name]
+                    expires.pop(name, None)
+                    deleted += 1
+                if deleted == 0 and not nvs:
+                    return 0
+            for name, value in nvs.items():
+                c[name] = value
+                if ttl:
+                    expires[name] = now + ttl
+                else:
+                    expires.pop(name, None)
+            if expires:
+                c['@expires'] = expires
+            else:
+                c.pop('@expires', None)
+            c['@cache_updated'] = now
+            self.set_cache(c)
+            return deleted
+
+    def acquire_lock(self, name: str, timeout: float = 10) -> Any:
+        return self.key_lock.acquire(name)
+
+    def release_lock(self, name: str, token: Any) -> None:
+        self.key_lock.release(token)
+
+    def mget(self, names: list[str]) -> list:
+        """ 批量获取，所有的值都来自同一个快照。
+        """
         c = self.get_cache()
-        c['@cache_updated'] = time.time()
-        c[name] = value
-        self.set_cache(c)
+        expires = c.get('@expires') or {}
+        now = time.time()
+        values = []
+        for name in names:
+            expire_at = expires.get(name)
+            if expire_at is not None and expire_at <= now:
+                values.append(None)
+            else:
+                values.append(c.get(name))
+        return values
+
+    def mget_ttl(self, names: list[str]) -> list[tuple]:
+        c = self.get_cache()
+        expires = c.get('@expires') or {}
+        now = time.time()
+        result = []
+        for name in names:
+            expire_at = expires.get(name)
+            if expire_at is None:
+                result.append((c.get(name), None))
+            elif expire_at <= now:
+                result.append((None, 0))
+            else:
+                result.append((c.get(name), expire_at - now))
+        return result
+
+    def set(self, name, value, ttl: int = None):
+        self._update({name: value}, ttl)
+
+    def mset(self, nvs: dict, ttl: int = None):
+        """ 批量设置，只需要重写一次文件。
+        """
+        self._update(nvs, ttl)
+
+    def delete(self, name):
+        self._update({}, deletes=lambda n: n == name)
+
+    def delete_prefix(self, prefix: str) -> int:
+        return self._update({}, deletes=lambda n: n.startswith(prefix))
 
     def __str__(self) -> str:
         return f'{self.__class__.__name__} {self.fpath.as_posix()} ftype: {self.ftype}'
 
 
 class UwsgiCache(Cache):
-    def __init__(self):
+    serializer: ValueSerializer = None
+
+    def __init__(self, serializer: ValueSerializer = None):
         super().__init__('uwsgi')
+        self.serializer = serializer or ValueSerializer()
         warnings.warn(f'GlobalCache USE {self!s}')
 
     def __getitem__(self, name):
@@ -107,25 +696,48 @@ class UwsgiCache(Cache):
         raw_value = uwsgiproxy.cache_get(name)
         # print('_getuwsgicache:', raw_value)
         if raw_value is not None:
-            return pickle.loads(raw_value, encoding='utf8')
+            self._count_io(read=len(raw_value))
+            return self.serializer.loads(raw_value)
         return None
 
-    def __setitem__(self, name, value):
+    def set(self, name, value, ttl: int = None):
         """
         设置 UWSGI 缓存
         :param name: 设置名称
         :param value:
+        :param ttl: 过期秒数，使用 uwsgi cache 的 expires 参数
         :return:
         """
         if value is None:
-            uwsgiproxy.cache_del(name)
+            self.delete(name)
             return
-        raw_value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        raw_value = self.serializer.dumps(value)
+        self._count_io(written=len(raw_value))
         # print('_setuwsgicache:', raw_value)
+        expires = math.ceil(ttl) if ttl else 0
         if uwsgiproxy.cache_exists(name):
-            uwsgiproxy.cache_update(name, raw_value)
+            uwsgiproxy.cache_update(name, raw_value, expires)
         else:
-            uwsgiproxy.cache_set(name, raw_value)
+            uwsgiproxy.cache_set(name, raw_value, expires)
+
+    def delete(self, name):
+        uwsgiproxy.cache_del(name)
+
+    def delete_prefix(self, prefix: str) -> int:
+        """ uwsgi 版本不支持列出键名时，清空整个缓存。"""
+        keys = uwsgiproxy.cache_keys()
+        if keys is None:
+            warnings.warn(f'{self!s}.delete_prefix: cache_keys is unavailable, clear all!')
+            uwsgiproxy.cache_clear()
+            return -1
+        count = 0
+        for key in keys:
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            if key.startswith(prefix):
+                uwsgiproxy.cache_del(key)
+                count += 1
+        return count
 
     def __str__(self) -> str:
         return f'{self.__class__.__name__}'
@@ -133,55 +745,664 @@ class UwsgiCache(Cache):
 
 class RedisCache(Cache):
     redis_uri: str = None
+    serializer: ValueSerializer = None
+
+    LOCK_PREFIX: str = 'pyape:gcache:lock:'
+    """ 锁的键名前缀，不以 r 开头，不会被 ``GlobalCache.clear_prefix`` 删除。"""
+
+    RELEASE_LOCK_SCRIPT: str = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
 
-    def __init__(self, redis_client: Redis, redis_uri: str=None):
+    def __init__(
+        self,
+        redis_client: Redis,
+        redis_uri: str = None,
+        serializer: ValueSerializer = None,
+    ):
         super().__init__('redis')
         self.redis_uri = redis_uri
+        self.serializer = serializer or ValueSerializer()
         self.__client = redis_client
         if not isinstance(self.__client, Redis):
             raise ValueError(f'{self!s} redis_client must be a Redis instance!')
         warnings.warn(f'GlobalCache USE {self!s}')
 
-    def __getitem__(self, name: str):
-        raw_value = self.__client.get(name)
+    def _loads(self, name: str, raw_value: bytes):
         if raw_value is None:
             return None
+        self._count_io(read=len(raw_value))
         try:
-            return pickle.loads(raw_value, encoding='utf8')
-        except pickle.UnpicklingError as e:
-            warnings.warn(f'{self!s}.pickle.loads {name=} error: {e!s}')
+            return self.serializer.loads(raw_value)
+        except Exception as e:
+            warnings.warn(f'{self!s}.loads {name=} error: {e!s}')
             return None
 
-    def __setitem__(self, name: str, value: Any):
-        raw_value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
-        self.__client.set(name, raw_value)
+    def __getitem__(self, name: str):
+        return self._loads(name, self.__client.get(name))
+
+    def acquire_lock(self, name: str, timeout: float = 10) -> Any:
+        """ 使用 SET NX PX 获取锁，锁在 timeout 秒后自动过期。"""
+        token = uuid.uuid4().hex
+        if self.__client.set(f'{self.LOCK_PREFIX}{name}', token, nx=True, px=int(timeout * 1000)):
+            return token
+        return None
+
+    def release_lock(self, name: str, token: Any) -> None:
+        """ 仅当锁仍然属于自己时才删除，避免删除过期后被其他进程获取的锁。"""
+        try:
+            self.__client.eval(self.RELEASE_LOCK_SCRIPT, 1, f'{self.LOCK_PREFIX}{name}', token)
+        except RedisError as e:
+            warnings.warn(f'{self!s}.release_lock {name=} error: {e!s}')
+
+    def mget(self, names: list[str]) -> list:
+        """ 使用 MGET 在一次往返中获取所有的值。
+        """
+        if not names:
+            return []
+        raw_values = self.__client.mget(names)
+        return [self._loads(n, v) for n, v in zip(names, raw_values)]
+
+    def mget_ttl(self, names: list[str]) -> list[tuple]:
+        """ 使用 pipeline 在一次往返中发送 MGET 和每个键的 PTTL。"""
+        if not names:
+            return []
+        with self.__client.pipeline(transaction=False) as pipe:
+            pipe.mget(names)
+            for name in names:
+                pipe.pttl(name)
+            raw_values, *pttls = pipe.execute()
+        # PTTL 返回 -1 代表没有过期时间，-2 代表键不存在
+        return [
+            (self._loads(n, v), None if pttl == -1 else max(pttl, 0) / 1000)
+            for n, v, pttl in zip(names, raw_values, pttls)
+        ]
+
+    def set(self, name: str, value: Any, ttl: int = None):
+        raw_value = self.serializer.dumps(value)
+        self._count_io(written=len(raw_value))
+        self.__client.set(name, raw_value, ex=math.ceil(ttl) if ttl else None)
+
+    def delete(self, name: str):
+        """ 使用 UNLINK 在后台释放内存，不阻塞 redis。"""
+        self.__client.unlink(name)
+
+    def delete_prefix(self, prefix: str, batch: int = 1000) -> int:
+        """ 使用 SCAN 分批查找键名，每批使用 pipeline 发送 UNLINK，不会长时间阻塞 redis。"""
+        # 转义 glob 特殊字符，仅匹配前缀
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', prefix) + '*'
+        count = 0
+        keys = []
+        with self.__client.pipeline(transaction=False) as pipe:
+            for key in self.__client.scan_iter(match=pattern, count=batch):
+                keys.append(key)
+                if len(keys) >= batch:
+                    pipe.unlink(*keys)
+                    pipe.execute()
+                    count += len(keys)
+                    keys = []
+            if keys:
+                pipe.unlink(*keys)
+                pipe.execute()
+                count += len(keys)
+        return count
 
-    def mset(self, nvs):
-        """ 批量设置
+    def mset(self, nvs: dict, ttl: int = None):
+        """ 批量设置。MSET 不支持过期时间，提供 ttl 时使用 pipeline 发送 SET EX。
         """
-        self.__client.mset(nvs)
+        raw_nvs = {name: self.serializer.dumps(value) for name, value in nvs.items()}
+        self._count_io(written=sum(len(v) for v in raw_nvs.values()))
+        if not ttl:
+            self.__client.mset(raw_nvs)
+            return
+        ex = math.ceil(ttl)
+        with self.__client.pipeline(transaction=False) as pipe:
+            for name, raw_value in raw_nvs.items():
+                pipe.set(name, raw_value, ex=ex)
+            pipe.execute()
 
     def __str__(self) -> str:
         return f'{self.__class__.__name__} {self.redis_uri}'
 
 
+class ShmCache(Cache):
+    """ 使用 mmap 文件中的共享哈希表保存缓存，同一主机上的所有 worker 共享。
+    用于 gunicorn 等没有 uwsgi cache 的部署，不依赖外部服务。
+
+    :param fpath: mmap 文件路径。
+    :param slots: 槽位数量，即最多保存的键数量。
+    :param slot_size: 每个槽位的字节数，序列化后超出的值不会被缓存。
+    """
+
+    def __init__(
+        self,
+        fpath: Path,
+        slots: int = 4096,
+        slot_size: int = 1024,
+        serializer: ValueSerializer = None,
+    ):
+        super().__init__('shm')
+        if fpath is None:
+            raise ValueError('ShmCache need a file!')
+        self.serializer = serializer or ValueSerializer()
+        self.table = SharedHashTable(fpath, slots, slot_size)
+        self.key_lock = FileKeyLock(fpath.with_name(f'{fpath.name}.klock'))
+        warnings.warn(f'GlobalCache USE {self!s}')
+
+    def acquire_lock(self, name: str, timeout: float = 10) -> Any:
+        return self.key_lock.acquire(name)
+
+    def release_lock(self, name: str, token: Any) -> None:
+        self.key_lock.release(token)
+
+    def _loads(self, name: str, raw_value: bytes):
+        if raw_value is None:
+            return None
+        self._count_io(read=len(raw_value))
+        try:
+            return self.serializer.loads(raw_value)
+        except Exception as e:
+            warnings.warn(f'{self!s}.loads {name=} error: {e!s}')
+            return None
+
+    def __getitem__(self, name: str):
+        return self._loads(name, self.table.get(name.encode('utf-8')))
+
+    def mget_ttl(self, names: list[str]) -> list[tuple]:
+        result = []
+        for name in names:
+            raw_value, expire_at = self.table.get_with_expire(name.encode('utf-8'))
+            ttl = expire_at - time.time() if expire_at else None
+            result.append((self._loads(name, raw_value), ttl))
+        return result
+
+    def delete(self, name: str):
+        self.table.delete(name.encode('utf-8'))
+
+    def delete_prefix(self, prefix: str) -> int:
+        return self.table.delete_prefix(prefix.encode('utf-8'))
+
+    def set(self, name: str, value: Any, ttl: int = None):
+        key = name.encode('utf-8')
+        if value is None:
+            self.table.delete(key)
+            return
+        raw_value = self.serializer.dumps(value)
+        self._count_io(written=len(raw_value))
+        if not self.table.set(key, raw_value, ttl):
+            warnings.warn(
+                f'{self!s} {name=} is too large: {len(raw_value)} > {self.table.payload_size}'
+            )
+
+    def __str__(self) -> str:
+        return f'{self.__class__.__name__} {self.table!s}'
+
+
+class FileStatsStore(object):
+    """ 将每个 worker 的统计快照保存为文件夹中的一个 json 文件，用于单机多 worker 汇总。"""
+
+    def __init__(self, dpath: Path):
+        self.dpath = Path(dpath)
+        self.dpath.mkdir(parents=True, exist_ok=True)
+
+    def save(self, worker: str, snapshot: dict) -> None:
+        fd, tmp_name = tempfile.mkstemp(prefix='.stats.', dir=self.dpath)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_name, self.dpath.joinpath(f'{worker}.json'))
+
+    def remove(self, *workers: str) -> None:
+        for worker in workers:
+            self.dpath.joinpath(f'{worker}.json').unlink(missing_ok=True)
+
+    def load_all(self) -> list[dict]:
+        snapshots = []
+        for f in self.dpath.glob('*.json'):
+            try:
+                snapshots.append(json.loads(f.read_text(encoding='utf-8')))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+
+class RedisStatsStore(object):
+    """ 将每个 worker 的统计快照保存在一个 redis hash 中，用于多机汇总。"""
+
+    def __init__(self, client: Redis, key: str = 'pyape:gcache:stats'):
+        self.client = client
+        self.key = key
+
+    def save(self, worker: str, snapshot: dict) -> None:
+        self.client.hset(self.key, worker, json.dumps(snapshot))
+
+    def remove(self, *workers: str) -> None:
+        if workers:
+            self.client.hdel(self.key, *workers)
+
+    def load_all(self) -> list[dict]:
+        snapshots = []
+        for raw in self.client.hvals(self.key):
+            try:
+                snapshots.append(json.loads(raw))
+            except ValueError:
+                continue
+        return snapshots
+
+
+class CacheStats(object):
+    """ 统计 GlobalCache 的命中、未命中、写入、删除、序列化字节数和延迟，按 r 分组。
+
+    统计数据保存在 worker 进程内，后台线程每隔 flush_interval 秒将快照写入 store，
+    ``aggregate`` 读取所有 worker 的快照并汇总。
+    worker 退出时删除自己的快照，汇总时删除超过 ``stale`` 秒没有更新的快照。
+
+    :param ctype: 缓存类型，写入快照中。
+    :param store: ``FileStatsStore`` 或 ``RedisStatsStore``，不提供则仅统计当前 worker。
+    :param flush_interval: 写入 store 的间隔秒数，0 代表仅在 aggregate 时写入。
+    :param hot_keys: 记录访问次数的键数量上限，用于找出热点键。
+    """
+
+    LATENCY_BUCKETS: tuple = (0.1, 0.5, 1, 5, 10, 50, 100, 500)
+    """ 延迟直方图的桶上限，单位毫秒，最后还有一个无上限的桶。"""
+
+    COUNTERS: tuple = ('hits', 'misses', 'sets', 'deletes', 'bytes_read', 'bytes_written')
+
+    stale: float = 300
+    """ 超过这个秒数没有更新的 worker 快照视为已经退出，不参与汇总并被删除。"""
+
+    def __init__(
+        self,
+        ctype: str,
+        store: FileStatsStore | RedisStatsStore = None,
+        flush_interval: float = 10,
+        hot_keys: int = 1000,
+    ):
+        self.ctype = ctype
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_hot_keys = hot_keys
+        self.__lock = threading.Lock()
+        self.__regionals: dict = {}
+        self.__latency: dict = {}
+        self.__hot_keys: dict = {}
+        self.__reset_flusher()
+        if store is not None:
+            atexit.register(self.close)
+            uwsgiproxy.register_atexit(self.close)
+            register_after_fork(self, 'after_fork')
+
+    def __reset_flusher(self) -> None:
+        self.__flusher = None
+        self.__stop = threading.Event()
+
+    def after_fork(self) -> None:
+        """ 后台线程不会被 fork 复制，在子进程中下次记录时重新启动。"""
+        self.__reset_flusher()
+
+    def __start_flusher(self) -> None:
+        with self.__lock:
+            if self.__flusher is None:
+                self.__flusher = threading.Thread(target=self._run, name='pyape-cache-stats', daemon=True)
+                self.__flusher.start()
+
+    def _run(self) -> None:
+        stop = self.__stop
+        while not stop.wait(self.flush_interval):
+            self.flush()
+
+    def _regional(self, r) -> dict:
+        counters = self.__regionals.get(r)
+        if counters is None:
+            counters = dict.fromkeys(self.COUNTERS, 0)
+            self.__regionals[r] = counters
+        return counters
+
+    def record(
+        self,
+        op: str,
+        r,
+        seconds: float,
+        hits: int = 0,
+        misses: int = 0,
+        sets: int = 0,
+        deletes: int = 0,
+        io: tuple = (0, 0),
+        keys: list = None,
+    ) -> None:
+        """ 记录一次缓存操作。
+
+        :param op: 操作名称，每种操作单独统计延迟直方图。
+        :param seconds: 操作耗时。
+        :param io: 后端 ``take_io`` 返回的 (read, written) 字节数。
+        :param keys: 被读取的键名，用于统计热点键。
+        """
+        ms = seconds * 1000
+        with self.__lock:
+            c = self._regional(r)
+            c['hits'] += hits
+            c['misses'] += misses
+            c['sets'] += sets
+            c['deletes'] += deletes
+            c['bytes_read'] += io[0]
+            c['bytes_written'] += io[1]
+            hist = self.__latency.get(op)
+            if hist is None:
+                hist = {'count': 0, 'sum_ms': 0.0, 'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+                self.__latency[op] = hist
+            hist['count'] += 1
+            hist['sum_ms'] += ms
+            hist['buckets'][bisect.bisect_left(self.LATENCY_BUCKETS, ms)] += 1
+            if keys:
+                hot = self.__hot_keys
+                for key in keys:
+                    hot[key] = hot.get(key, 0) + 1
+                if len(hot) > self.max_hot_keys:
+                    # 保留访问次数较多的一半
+                    kept = sorted(hot.items(), key=lambda kv: kv[1], reverse=True)
+                    self.__hot_keys = dict(kept[:self.max_hot_keys // 2])
+        # 写入 store 在后台线程中进行，不阻塞缓存操作
+        if self.__flusher is None and self.store is not None and self.flush_interval > 0:
+            self.__start_flusher()
+
+    def snapshot(self) -> dict:
+        """ 返回当前 worker 的统计数据。"""
+        with self.__lock:
+            return {
+                'ctype': self.ctype,
+                'worker': self.worker,
+                'updated': time.time(),
+                'regionals': {str(r): dict(c) for r, c in self.__regionals.items()},
+                'latency': {
+                    op: dict(hist, buckets=list(hist['buckets']))
+                    for op, hist in self.__latency.items()
+                },
+                'hot_keys': dict(self.__hot_keys),
+            }
+
+    @property
+    def worker(self) -> str:
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def flush(self) -> None:
+        """ 将当前 worker 的快照写入 store。"""
+        if self.store is None:
+            return
+        try:
+            self.store.save(self.worker, self.snapshot())
+        except (OSError, RedisError) as e:
+            warnings.warn(f'{self.__class__.__name__}.flush error: {e!s}')
+
+    def close(self) -> None:
+        """ 停止后台线程并删除当前 worker 的快照。worker 退出时自动调用。"""
+        self.__stop.set()
+        if self.store is None:
+            return
+        flusher = self.__flusher
+        if flusher is not None and flusher is not threading.current_thread():
+            flusher.join(1)
+        try:
+            self.store.remove(self.worker)
+        except (OSError, RedisError) as e:
+            warnings.warn(f'{self.__class__.__name__}.close error: {e!s}')
+
+    def aggregate(self, top: int = 20) -> dict:
+        """ 汇总所有 worker 的快照。
+
+        :param top: 返回访问次数最多的键的数量。
+        """
+        if self.store is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            now = time.time()
+            snapshots = []
+            stale_workers = []
+            for s in self.store.load_all():
+                if now - s.get('updated', 0) < self.stale:
+                    snapshots.append(s)
+                elif s.get('worker'):
+                    stale_workers.append(s['worker'])
+            if stale_workers:
+                # 已经退出但没有删除快照的 worker，例如被强制结束的进程
+                try:
+                    self.store.remove(*stale_workers)
+                except (OSError, RedisError) as e:
+                    warnings.warn(f'{self.__class__.__name__}.aggregate error: {e!s}')
+        regionals: dict = {}
+        latency: dict = {}
+        hot_keys: dict = {}
+        for s in snapshots:
+            for r, c in s.get('regionals', {}).items():
+                total = regionals.setdefault(r, dict.fromkeys(self.COUNTERS, 0))
+                for k in self.COUNTERS:
+                    total[k] += c.get(k, 0)
+            for op, hist in s.get('latency', {}).items():
+                total = latency.setdefault(
+                    op, {'count': 0, 'sum_ms': 0.0, 'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+                )
+                total['count'] += hist['count']
+                total['sum_ms'] += hist['sum_ms']
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], hist['buckets'])]
+            for key, count in s.get('hot_keys', {}).items():
+                hot_keys[key] = hot_keys.get(key, 0) + count
+        for c in regionals.values():
+            lookups = c['hits'] + c['misses']
+            c['hit_ratio'] = c['hits'] / lookups if lookups else 0.0
+        return {
+            'ctype': self.ctype,
+            'workers': [s.get('worker') for s in snapshots],
+            'latency_buckets_ms': list(self.LATENCY_BUCKETS),
+            'regionals': regionals,
+            'latency': latency,
+            'hot_keys': sorted(hot_keys.items(), key=lambda kv: kv[1], reverse=True)[:top],
+        }
+
+
+_MISSING = object()
+
+
+class LocalCache(object):
+    """ 进程内的 LRU/TTL 缓存，作为 GlobalCache 的一级缓存使用。
+
+    热点键直接从进程内存中返回，不再访问 redis/uwsgi，也不需要反序列化。
+    返回的是缓存对象本身，调用者不应修改它。
+
+    :param maxsize: 最多保存的键数量，超出后淘汰最久未使用的键。
+    :param ttl: 每个键在一级缓存中的最长存活秒数，0 代表不过期。
+    """
+
+    maxsize: int = 1024
+    ttl: float = 60
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (过期时间, value)
+        self.__data: OrderedDict = OrderedDict()
+        self.__lock = threading.Lock()
+        # 每次失效都会增加版本号，用于丢弃失效前读取到的旧值
+        self.version: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is not None:
+                expire_at, value = item
+                if expire_at == 0 or expire_at > time.monotonic():
+                    self.__data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.__data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: str, value: Any, version: int = None, ttl: float = None) -> bool:
+        """ 写入一级缓存。
+
+        :param version: 读取二级缓存之前获取的 ``version``。
+            若期间发生过失效，说明 value 可能已经过期，放弃写入。
+        :param ttl: 值在二级缓存中的剩余秒数，None 代表永不过期。
+            保存时间不超过 ``self.ttl`` 和 ttl 中较小的一个，ttl 不大于 0 时不写入。
+        """
+        if ttl is not None:
+            if ttl <= 0:
+                return False
+            ttl = min(self.ttl, ttl) if self.ttl else ttl
+        else:
+            ttl = self.ttl
+        with self.__lock:
+            if version is not None and version != self.version:
+                return False
+            expire_at = time.monotonic() + ttl if ttl else 0
+            self.__data[key] = (expire_at, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def delete(self, *keys: str) -> None:
+        with self.__lock:
+            self.version += 1
+            for key in keys:
+                if self.__data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def delete_prefix(self, prefix: str) -> None:
+        with self.__lock:
+            self.version += 1
+            for key in [k for k in self.__data if k.startswith(prefix)]:
+                del self.__data[key]
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.version += 1
+            self.invalidations += len(self.__data)
+            self.__data.clear()
+
+    def stats(self) -> dict:
+        """ 返回命中率等统计信息，用于确定 maxsize 和 ttl。"""
+        with self.__lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.__data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+
 class GlobalCache(object):
     """ 创建一个唯一的全局 Cache 方便使用
     注意这个全局代表同进程全局，因此在使用 DictCache 和 UwsgiCache 的时候，需要自行同步
+
+    :param cache: 二级缓存，即 ``Cache`` 的子类实例。
+    :param local: 一级缓存，若提供则热点键直接从进程内返回。
+    :param invalidate_client: 用于发布和订阅失效消息的 redis client。
+        若不提供，一级缓存只能依靠 ttl 过期，不同 worker 之间的值可能不一致。
+    :param invalidate_channel: 失效消息使用的 redis 频道名称。
+    :param stats: 若提供，则统计每次读写的命中、字节数和延迟，见 ``CacheStats``。
     """
-    def __init__(self, cache):
+
+    local: LocalCache = None
+    """ 一级缓存，未启用时为 None。"""
+
+    cache_stats: CacheStats = None
+    """ 统计数据，未启用时为 None。"""
+
+    invalidate_channel: str = 'pyape:gcache:invalidate'
+
+    def __init__(
+        self,
+        cache,
+        local: LocalCache = None,
+        invalidate_client: Redis = None,
+        invalidate_channel: str = None,
+        stats: CacheStats = None,
+    ):
         self.cache = cache
+        self.local = local
+        self.cache_stats = stats
+        self.__invalidate_client = invalidate_client
+        if invalidate_channel:
+            self.invalidate_channel = invalidate_channel
+        # 用于在收到失效消息时，忽略自身发出的消息
+        self.__sender = uuid.uuid4().hex
+        self.__subscriber = None
+        self.__subscriber_pid = None
+        self.__subscriber_lock = threading.Lock()
+        # get_or_set 使用的进程内键锁，key -> [Lock, 引用计数]
+        self.__key_locks: dict = {}
+        self.__key_locks_lock = threading.Lock()
 
     @classmethod
     def from_config(cls, ctype: str, **kwargs):
         """ 获取一个 Cache 实例
+
+        :param local: 一级缓存配置，一个包含 maxsize/ttl/channel 的 dict。
+        :param codec: uwsgi/redis/shm 缓存使用的序列化配置，
+            一个包含 name/compression/threshold/level/header 的 dict，见 ``ValueSerializer``。
+        :param shm: shm 缓存的配置，一个包含 slots/slot_size 的 dict。
+        :param stats: 统计配置，一个包含 enable/flush_interval/dir 的 dict。
         """
+        serializer = ValueSerializer.from_config(kwargs.get('codec'))
+        local = None
+        local_cfg = kwargs.get('local')
+        if isinstance(local_cfg, dict):
+            local = LocalCache(
+                maxsize=local_cfg.get('maxsize', LocalCache.maxsize),
+                ttl=local_cfg.get('ttl', LocalCache.ttl),
+            )
+            local_kwargs = {
+                'local': local,
+                'invalidate_client': kwargs.get('invalidate_client'),
+                'invalidate_channel': local_cfg.get('channel'),
+            }
+        else:
+            local_kwargs = {}
+        stats_cfg = kwargs.get('stats')
+        if isinstance(stats_cfg, dict) and stats_cfg.get('enable', True):
+            store = None
+            if stats_cfg.get('dir'):
+                store = FileStatsStore(stats_cfg['dir'])
+            local_kwargs['stats'] = CacheStats(
+                ctype,
+                store=store,
+                flush_interval=stats_cfg.get('flush_interval', 10),
+            )
+
         if ctype == 'uwsgi':
-            return cls(UwsgiCache())
+            return cls(UwsgiCache(serializer), **local_kwargs)
         elif ctype == 'file':
             fpath = kwargs.get('fpath')
             ftype = kwargs.get('ftype')
-            return cls(FileCache(fpath, ftype))
+            return cls(FileCache(fpath, ftype), **local_kwargs)
+        elif ctype == 'shm':
+            shm_cfg = kwargs.get('shm') or {}
+            return cls(
+                ShmCache(
+                    kwargs.get('fpath'),
+                    slots=shm_cfg.get('slots', 4096),
+                    slot_size=shm_cfg.get('slot_size', 1024),
+                    serializer=serializer,
+                ),
+                **local_kwargs,
+            )
         elif ctype == 'redis':
             # 优先确认 redis_client 参数
             redis_client = kwargs.get('redis_client')
@@ -197,8 +1418,14 @@ class GlobalCache(object):
             # redis 模式下，redis_client 必须存在
             if redis_client is None:
                 raise ValueError('redis_client must be existence!')
-            return cls(RedisCache(redis_client, redis_uri))
-        return cls(DictCache())
+            if local is not None and local_kwargs['invalidate_client'] is None:
+                local_kwargs['invalidate_client'] = redis_client
+            stats = local_kwargs.get('stats')
+            if stats is not None and stats.store is None:
+                # redis 模式下使用 redis 汇总所有主机上的 worker
+                stats.store = RedisStatsStore(redis_client)
+            return cls(RedisCache(redis_client, redis_uri, serializer), **local_kwargs)
+        return cls(DictCache(), **local_kwargs)
 
     @property
     def ctype(self) -> str:
@@ -207,34 +1434,333 @@ class GlobalCache(object):
     def keyname(self, r: int, name: str):
         return f'{r}_{name!s}'
 
+    def local_stats(self) -> dict:
+        """ 返回一级缓存的统计信息，未启用一级缓存时返回 None。"""
+        if self.local is None:
+            return None
+        return self.local.stats()
+
+    def stats(self, aggregate: bool = False) -> dict:
+        """ 返回缓存的统计信息，未启用统计时返回 None。
+
+        :param aggregate: 是否汇总所有 worker 的统计数据，否则仅返回当前 worker。
+        """
+        if self.cache_stats is None:
+            return None
+        if aggregate:
+            result = self.cache_stats.aggregate()
+        else:
+            result = self.cache_stats.snapshot()
+        result['local'] = self.local_stats()
+        return result
+
+    def _record(self, op: str, r, start: float, **kwargs) -> None:
+        """ 记录一次后端操作，start 为 ``time.perf_counter`` 的返回值。"""
+        if self.cache_stats is not None:
+            self.cache_stats.record(
+                op, r, time.perf_counter() - start, io=self.cache.take_io(), **kwargs
+            )
+
+    def _ensure_subscriber(self) -> None:
+        """ 在当前进程中启动订阅失效消息的线程。
+        fork 之后子进程中没有这个线程，因此使用 pid 判断是否需要重新启动。
+        """
+        if self.__invalidate_client is None:
+            return
+        pid = os.getpid()
+        if self.__subscriber_pid == pid:
+            return
+        with self.__subscriber_lock:
+            if self.__subscriber_pid == pid:
+                return
+            # 启动订阅之前的值可能已经被其他 worker 修改过
+            self.local.clear()
+            try:
+                pubsub = self.__invalidate_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.invalidate_channel: self._handle_invalidate})
+                self.__subscriber = pubsub.run_in_thread(
+                    sleep_time=1,
+                    daemon=True,
+                    exception_handler=self._handle_subscriber_error,
+                )
+            except RedisError as e:
+                warnings.warn(f'{self.__class__.__name__} subscribe error: {e!s}')
+                return
+            self.__subscriber_pid = pid
+
+    def _handle_invalidate(self, message: dict) -> None:
+        """ 处理其他 worker 发出的失效消息。"""
+        try:
+            data = json.loads(message['data'])
+        except (TypeError, ValueError) as e:
+            warnings.warn(f'{self.__class__.__name__} invalid message: {e!s}')
+            return
+        if data.get('s') == self.__sender:
+            return
+        prefix = data.get('p')
+        keys = data.get('k')
+        if prefix is not None:
+            self.local.delete_prefix(prefix)
+        elif keys is None:
+            self.local.clear()
+        else:
+            self.local.delete(*keys)
+
+    def _handle_subscriber_error(self, e: Exception, pubsub, thread) -> None:
+        # 断线期间可能错过了失效消息，清空一级缓存，pubsub 会在下次读取时重连
+        warnings.warn(f'{self.__class__.__name__} subscriber error: {e!s}')
+        self.local.clear()
+        time.sleep(1)
+
+    def _invalidate(self, keys: list[str] = None, prefix: str = None) -> None:
+        """ 删除本进程的一级缓存，并通知其他 worker 删除。
+
+        :param keys: 需要失效的键名，None 代表全部失效。
+        :param prefix: 若提供，则失效所有以 prefix 开头的键，忽略 keys。
+        """
+        if self.local is None:
+            return
+        if prefix is not None:
+            self.local.delete_prefix(prefix)
+        elif keys is None:
+            self.local.clear()
+        else:
+            self.local.delete(*keys)
+        if self.__invalidate_client is None:
+            return
+        message = {'s': self.__sender, 'k': keys}
+        if prefix is not None:
+            message['p'] = prefix
+        try:
+            self.__invalidate_client.publish(self.invalidate_channel, json.dumps(message))
+        except RedisError as e:
+            warnings.warn(f'{self.__class__.__name__} publish error: {e!s}')
+
     def getg(self, name, r=0):
         """ 默认使用 0 这个r值，代表不区分 r
         """
         if r is None or name is None:
             return None
-        return self.cache[self.keyname(r, name)]
+        key = self.keyname(r, name)
+        start = time.perf_counter()
+        if self.local is not None:
+            self._ensure_subscriber()
+            version = self.local.version
+            value = self.local.get(key, _MISSING)
+            if value is not _MISSING:
+                self._record('get_local', r, start, hits=1, keys=[key])
+                return value
+        if self.local is None:
+            value = self.cache[key]
+        else:
+            value, ttl = self.cache.mget_ttl([key])[0]
+        hit = value is not None
+        self._record('get', r, start, hits=int(hit), misses=int(not hit), keys=[key])
+        if self.local is not None and hit:
+            self.local.set(key, value, version, ttl)
+        return value
 
-    def setg(self, name, value, r=0):
+    def mgetg(self, names: list[str], r=0) -> dict:
+        """ 批量获取一组缓存，返回以 name 为键的 dict，不存在的值为 None。
+        默认使用 0 这个r值，代表不区分 r
+        """
+        if r is None or not names:
+            return {}
+        keys = {name: self.keyname(r, name) for name in names if name is not None}
+        start = time.perf_counter()
+        result = {}
+        misses = []
+        if self.local is None:
+            misses = list(keys.items())
+        else:
+            self._ensure_subscriber()
+            version = self.local.version
+            for name, key in keys.items():
+                value = self.local.get(key, _MISSING)
+                if value is _MISSING:
+                    misses.append((name, key))
+                else:
+                    result[name] = value
+        if misses and self.local is None:
+            values = self.cache.mget([key for _, key in misses])
+            for (name, _), value in zip(misses, values):
+                result[name] = value
+        elif misses:
+            items = self.cache.mget_ttl([key for _, key in misses])
+            for (name, key), (value, ttl) in zip(misses, items):
+                result[name] = value
+                if value is not None:
+                    self.local.set(key, value, version, ttl)
+        hits = sum(1 for v in result.values() if v is not None)
+        self._record(
+            'mget', r, start, hits=hits, misses=len(result) - hits, keys=list(keys.values())
+        )
+        return result
+
+    @contextmanager
+    def _key_lock(self, key: str):
+        """ 同一进程中，同一个键同时只有一个线程在加载。"""
+        with self.__key_locks_lock:
+            item = self.__key_locks.get(key)
+            if item is None:
+                item = [threading.Lock(), 0]
+                self.__key_locks[key] = item
+            item[1] += 1
+        try:
+            with item[0]:
+                yield
+        finally:
+            with self.__key_locks_lock:
+                item[1] -= 1
+                if item[1] == 0:
+                    del self.__key_locks[key]
+
+    @staticmethod
+    def _unwrap(value: Any) -> tuple:
+        """ 解开 get_or_set 提前刷新模式保存的值。
+
+        :return: (值, 加载耗时, 过期时间)，非提前刷新模式保存的值后两项为 None。
+        """
+        if isinstance(value, dict) and '@expire' in value:
+            return value.get('@value'), value.get('@delta'), value.get('@expire')
+        return value, None, None
+
+    def _load(self, name, loader: Callable, r, ttl: int, early_refresh: float) -> Any:
+        start = time.monotonic()
+        value = loader()
+        if value is None:
+            return None
+        if early_refresh and ttl:
+            self.setg(
+                name,
+                {
+                    '@value': value,
+                    '@delta': time.monotonic() - start,
+                    '@expire': time.time() + ttl,
+                },
+                r,
+                ttl,
+            )
+        else:
+            self.setg(name, value, r, ttl)
+        return value
+
+    def get_or_set(
+        self,
+        name,
+        loader: Callable,
+        r=0,
+        ttl: int = None,
+        early_refresh: float = 0,
+        lock_timeout: float = 10,
+    ) -> Any:
+        """ 获取缓存，不存在时调用 loader 加载并写入缓存。
+
+        同一进程内同一个键只有一个线程调用 loader，
+        不同进程之间使用后端的锁（redis SET NX 或文件锁）协调，
+        未获得锁的调用者等待持有者写入缓存后直接读取。
+
+        :param loader: 无参数的加载函数，返回 None 代表不存在，不会被缓存。
+        :param ttl: 过期秒数。
+        :param early_refresh: 提前刷新系数，通常为 1，0 代表不提前刷新，仅在提供 ttl 时有效。
+            接近过期时，按照加载耗时和剩余时间随机决定由一个调用者提前重新加载，
+            其他调用者继续使用当前值。
+            启用后缓存中保存的是包装后的值，这个键只应通过 get_or_set 读取。
+        :param lock_timeout: 跨进程锁的最长持有秒数，也是等待其他进程加载的最长秒数。
+        """
+        if r is None or name is None:
+            return None
+        key = self.keyname(r, name)
+        value, delta, expire_at = self._unwrap(self.getg(name, r))
+        if value is not None:
+            if not (early_refresh and ttl and expire_at):
+                return value
+            # XFetch：剩余时间越少、加载越慢，越可能提前刷新
+            if time.time() - delta * early_refresh * math.log(1 - random.random()) < expire_at:
+                return value
+            # 仅由获得锁的调用者刷新，其他调用者继续使用当前值
+            token = self.cache.acquire_lock(key, lock_timeout)
+            if token is None:
+                return value
+            try:
+                return self._load(name, loader, r, ttl, early_refresh)
+            finally:
+                self.cache.release_lock(key, token)
+
+        with self._key_lock(key):
+            # 等待期间可能已经被其他线程加载
+            value = self._unwrap(self.getg(name, r))[0]
+            if value is not None:
+                return value
+            deadline = time.monotonic() + lock_timeout
+            token = self.cache.acquire_lock(key, lock_timeout)
+            while token is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = self._unwrap(self.getg(name, r))[0]
+                if value is not None:
+                    return value
+                token = self.cache.acquire_lock(key, lock_timeout)
+            # 等待超时则不再等待持有者，自行加载
+            try:
+                return self._load(name, loader, r, ttl, early_refresh)
+            finally:
+                if token is not None:
+                    self.cache.release_lock(key, token)
+
+    def setg(self, name, value, r=0, ttl: int = None):
         """ 默认使用 0 这个r值，代表不区分 r
+
+        :param ttl: 过期秒数，None 或 0 代表永不过期。
+            启用一级缓存时，所有 worker 的一级缓存都不会保存超过剩余过期时间的值。
+            没有配置失效通知时，写入者以外的 worker 在 ``local.ttl`` 秒内仍可能读取到修改前的值。
         """
         if r is not None and name is not None and value is not None:
-            self.cache[self.keyname(r, name)] = value
+            key = self.keyname(r, name)
+            start = time.perf_counter()
+            self.cache.set(key, value, ttl)
+            self._record('set', r, start, sets=1)
+            self._invalidate([key])
 
-    def msetg(self, nvs, r=0):
+    def msetg(self, nvs, r=0, ttl: int = None):
         """ 设置一组缓存
+
+        :param ttl: 过期秒数，所有的键使用相同的过期时间。
         """
-        # 若提供了 setall 方法则直接调用
         newkey_nvs = {}
         for n, v in nvs.items():
             newkey_nvs[self.keyname(r, n)] = v
-        if getattr(self.cache, 'mset', None):
-            self.cache.mset(newkey_nvs)
-        else:
-            for n2, v2 in newkey_nvs.items():
-                self.cache[n2] = v2
+        start = time.perf_counter()
+        self.cache.mset(newkey_nvs, ttl)
+        self._record('mset', r, start, sets=len(newkey_nvs))
+        self._invalidate(list(newkey_nvs.keys()))
 
     def delg(self, name, r=0):
         """ 默认使用 0 这个r值，代表不区分 r
         """
         if r is not None and name is not None:
-            self.cache[self.keyname(r, name)] = None
+            key = self.keyname(r, name)
+            start = time.perf_counter()
+            self.cache.delete(key)
+            self._record('delete', r, start, deletes=1)
+            self._invalidate([key])
+
+    def clear_prefix(self, prefix: str, r=0) -> int:
+        """ 删除 r 下所有名称以 prefix 开头的缓存。
+
+        :return: 删除的数量。uwsgi 不支持列出键名时会清空整个缓存，返回 -1。
+        """
+        if r is None or prefix is None:
+            return 0
+        key_prefix = self.keyname(r, prefix)
+        start = time.perf_counter()
+        count = self.cache.delete_prefix(key_prefix)
+        self._record('delete_prefix', r, start, deletes=max(count, 0))
+        self._invalidate(prefix=key_prefix)
+        return count
+
+    def clear_regional(self, r) -> int:
+        """ 删除 r 下的所有缓存，例如一个 regional 的所有 VO。
+
+        :return: 删除的数量。
+        """
+        return self.clear_prefix('', r)
@@ -7,11 +7,34 @@ pyape.db
 1. 解决 SQLAlchemy 线程问题
 2. 提供多数据库绑定支持
 """
+import csv
 import math
-from threading import Lock
+import time
+import logging
+import json
+import warnings
+import base64
+import hashlib
+import sqlite3
+import functools
+import atexit
+import queue
+from decimal import Decimal
+from datetime import date, datetime
+from threading import Lock, Thread, Event
+from contextvars import ContextVar
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import Iterable, Union
-from sqlalchemy.schema import Table, MetaData
+from sqlalchemy import and_, or_, func, text, event, insert, select, delete, inspect as sa_inspect, Select
+from sqlalchemy.exc import DBAPIError, IntegrityError, DataError
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import ColumnElement, UnaryExpression
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.schema import Table, MetaData, Column, CreateTable, CreateIndex
+from sqlalchemy.types import Integer, String
 from sqlalchemy.orm import (
     DeclarativeMeta,
     declarative_base,
@@ -22,6 +45,164 @@ from sqlalchemy.orm import (
 )
 from sqlalchemy.engine import Engine, Connection, create_engine, make_url, URL
 
+from pyape import uwsgiproxy
+from pyape.util.func import register_after_fork
+
+
+def statement_template(fn):
+    """ 缓存 fn 构建的语句模板，相同的参数只构建一次。
+
+    fn 的参数只用于决定语句的结构，例如 Model 以及是否包含某个条件，必须可以哈希。
+    每次请求中变化的值使用 ``bindparam`` 占位，执行时作为参数传入。
+    重复使用同一个语句对象，省去每次构建语句和计算缓存键的开销： ::
+
+        @statement_template
+        def user_by_name(user_cls):
+            return select(user_cls).where(user_cls.name == bindparam('name'))
+
+        gdb.session().scalars(user_by_name(User), {'name': name}).first()
+
+    fn 也可以返回条件的 tuple，配合 ``Query.filter(*clauses).params(...)`` 使用。
+    """
+    return functools.lru_cache(maxsize=1024)(fn)
+
+
+def exact_total(qry: Query) -> int:
+    """ 使用 COUNT 查询获取精确的总数。"""
+    return qry.order_by(None).count()
+
+
+class CachedTotal(object):
+    """ 将 COUNT 的结果保存在缓存中，键名由主库地址、编译后的 SQL 和参数计算。
+
+    :param cache: ``pyape.cache.GlobalCache`` 实例。
+    :param ttl: 缓存秒数，在此期间内总数的变化不会反映在分页中。
+    :param r: 保存缓存使用的 r 值。
+    """
+
+    prefix: str = 'pagination_total_'
+
+    def __init__(self, cache, ttl: int = 60, r: int = 0):
+        self.cache = cache
+        self.ttl = ttl
+        self.r = r
+
+    def keyname(self, qry: Query) -> str:
+        compiled = qry.order_by(None).statement.compile()
+        params = sorted((k, repr(v)) for k, v in compiled.params.items())
+        # 相同的查询在不同的数据库（bind_key 或 regional 分库）中总数不同。
+        # 使用主库的地址，不能调用 get_bind，它会选择一个副本并推进副本的轮询
+        session = qry.session
+        if isinstance(session, RoutingSession):
+            url = session.get_primary_bind(clause=qry.statement).url
+        else:
+            url = session.get_bind(clause=qry.statement).url
+        digest = hashlib.sha1(f'{url}|{compiled}|{params}'.encode()).hexdigest()
+        return self.prefix + digest
+
+    def __call__(self, qry: Query) -> int:
+        return self.cache.get_or_set(self.keyname(qry), lambda: exact_total(qry), self.r, self.ttl)
+
+
+class EstimatedTotal(object):
+    """ 对没有筛选条件的单表查询，使用数据库的统计信息估算行数，不执行 COUNT。
+    支持 mysql 和 postgresql，其他数据库或者带有筛选条件的查询使用 fallback。
+
+    :param fallback: 无法估算时使用的方法。
+    """
+
+    MYSQL_SQL = (
+        'SELECT TABLE_ROWS FROM information_schema.TABLES '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name'
+    )
+    POSTGRESQL_SQL = 'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)'
+
+    def __init__(self, fallback=exact_total):
+        self.fallback = fallback
+
+    @staticmethod
+    def estimable_table(qry: Query) -> Table:
+        """ 若查询是不带筛选、分组和去重的单表查询，返回这个表，否则返回 None。"""
+        stmt = qry.statement
+        if stmt.whereclause is not None or stmt._group_by_clauses or stmt._distinct \
+                or stmt._having_criteria or stmt._limit_clause is not None \
+                or stmt._offset_clause is not None:
+            return None
+        froms = stmt.get_final_froms()
+        if len(froms) != 1 or not isinstance(froms[0], Table):
+            return None
+        return froms[0]
+
+    def __call__(self, qry: Query) -> int:
+        table = self.estimable_table(qry)
+        if table is not None:
+            bind = qry.session.get_bind(clause=qry.statement)
+            dialect = bind.dialect.name
+            sql = None
+            name = table.name
+            if dialect in ('mysql', 'mariadb'):
+                sql = self.MYSQL_SQL
+            elif dialect == 'postgresql':
+                sql = self.POSTGRESQL_SQL
+                if table.schema is not None:
+                    name = f'{table.schema}.{table.name}'
+            if sql is not None:
+                estimated = qry.session.execute(
+                    text(sql), {'name': name}, bind_arguments={'bind': bind}
+                ).scalar()
+                # postgresql 未执行过 ANALYZE 的表返回 -1
+                if estimated is not None and estimated >= 0:
+                    return int(estimated)
+        return self.fallback(qry)
+
+
+def supports_window_functions(dialect) -> bool:
+    """ 判断数据库是否支持窗口函数。
+
+    mysql 和 mariadb 需要版本信息，dialect 应来自已经建立过连接的 Engine。
+    """
+    version = dialect.server_version_info or ()
+    if dialect.name == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 25)
+    # 使用 mysql:// 连接 MariaDB 时 dialect.name 也是 mysql
+    if dialect.name == 'mariadb' or getattr(dialect, 'is_mariadb', False):
+        return version >= (10, 2)
+    if dialect.name == 'mysql':
+        return version >= (8,)
+    return dialect.name in ('postgresql', 'mssql', 'oracle')
+
+
+class WindowTotal(object):
+    """ 使用 ``COUNT(*) OVER()`` 在获取当前页的同一个查询中得到总数，只需要一次查询。
+
+    数据库不支持窗口函数、查询包含多个实体或者使用了 DISTINCT 时，回退到 ``exact_total`` 。
+    """
+
+    column_name: str = 'pyape_window_total'
+
+    def usable(self, qry: Query) -> bool:
+        if len(qry.column_descriptions) != 1 or qry.statement._distinct:
+            return False
+        dialect = qry.session.get_bind(clause=qry.statement).dialect
+        if dialect.server_version_info is None:
+            # Engine 第一次连接时才获取版本信息，使用查询将要使用的连接
+            dialect = qry.session.connection(bind_arguments={'clause': qry.statement}).dialect
+        return supports_window_functions(dialect)
+
+    def fetch(self, qry: Query, limit: int, offset: int) -> tuple:
+        """ 获取一页数据和总数。
+
+        :return: (items, total)，当前页没有数据时 total 为 None。
+        """
+        total_col = func.count().over().label(self.column_name)
+        rows = qry.add_columns(total_col).limit(limit).offset(offset).all()
+        if not rows:
+            return [], None
+        return [row[0] for row in rows], rows[0][-1]
+
+    def __call__(self, qry: Query) -> int:
+        return exact_total(qry)
+
 
 class Pagination(object):
     """ from flask_sqlalchemy
@@ -32,7 +213,16 @@ class Pagination(object):
     no longer work.
     """
 
-    def __init__(self, query: Query, page: int, per_page: int, total: int, items):
+    def __init__(
+        self,
+        query: Query,
+        page: int,
+        per_page: int,
+        total: int,
+        items,
+        has_more: bool = None,
+        total_strategy=None,
+    ):
         #: the unlimited query object that was used to create this
         #: pagination object.
         self.query = query
@@ -44,6 +234,10 @@ class Pagination(object):
         self.total = total
         #: the items for the current page
         self.items = items
+        #: 当前页之后是否还有数据，None 代表根据 total 计算
+        self.has_more = has_more
+        #: 获取 total 使用的方法，prev/next 沿用
+        self.total_strategy = total_strategy
 
     @classmethod
     def paginate(
@@ -52,6 +246,7 @@ class Pagination(object):
         page: int = None,
         per_page: int = None,
         max_per_page: int = None,
+        total_strategy=None,
     ):
         """ from flask_sqlalchemy
         Returns ``per_page`` items from page ``page``.
@@ -61,6 +256,10 @@ class Pagination(object):
         be limited to that value. If there is no request or they aren't in the
         query, they default to 1 and 20 respectively.
 
+        :param total_strategy: 获取总数的方法，接受 query 返回 int，
+            可使用 ``exact_total`` (默认)、 ``CachedTotal`` 、 ``EstimatedTotal`` 或 ``WindowTotal`` 。
+            has_next 由多获取的一行决定，因此总数不精确时也能正确翻页。
+
         Returns a :class:`Pagination` object.
         """
 
@@ -73,11 +272,27 @@ class Pagination(object):
         if max_per_page is not None:
             per_page = min(per_page, max_per_page)
 
-        items = qry.limit(per_page).offset((page - 1) * per_page).all()
-
-        total = qry.order_by(None).count()
-
-        return cls(qry, page, per_page, total, items)
+        # 多取一行用于判断是否有下一页
+        offset = (page - 1) * per_page
+        total = None
+        if isinstance(total_strategy, WindowTotal) and total_strategy.usable(qry):
+            items, total = total_strategy.fetch(qry, per_page + 1, offset)
+        else:
+            items = qry.limit(per_page + 1).offset(offset).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if total is None:
+            if not has_more and (items or page == 1):
+                # 已经到达最后一页，不需要查询总数
+                total = offset + len(items)
+            else:
+                total = (total_strategy or exact_total)(qry)
+                # 缓存或估算的总数不能小于已经读取到的数量
+                if has_more:
+                    total = max(total, offset + len(items) + 1)
+
+        return cls(qry, page, per_page, total, items, has_more, total_strategy)
 
     @property
     def pages(self):
@@ -93,7 +308,9 @@ class Pagination(object):
         assert self.query is not None, (
             'a query object is required ' 'for this method to work'
         )
-        return self.__class__.paginate(self.query, self.page - 1, self.per_page)
+        return self.__class__.paginate(
+            self.query, self.page - 1, self.per_page, total_strategy=self.total_strategy
+        )
 
     @property
     def prev_num(self):
@@ -112,11 +329,15 @@ class Pagination(object):
         assert self.query is not None, (
             'a query object is required ' 'for this method to work'
         )
-        return self.__class__.paginate(self.query, self.page + 1, self.per_page)
+        return self.__class__.paginate(
+            self.query, self.page + 1, self.per_page, total_strategy=self.total_strategy
+        )
 
     @property
     def has_next(self):
         """True if a next page exists."""
+        if self.has_more is not None:
+            return self.has_more
         return self.page < self.pages
 
     @property
@@ -166,6 +387,201 @@ class Pagination(object):
                 last = num
 
 
+def _encode_cursor_value(value):
+    if isinstance(value, datetime):
+        return {'@dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'@d': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'@dec': str(value)}
+    return value
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict):
+        if '@dt' in value:
+            return datetime.fromisoformat(value['@dt'])
+        if '@d' in value:
+            return date.fromisoformat(value['@d'])
+        if '@dec' in value:
+            return Decimal(value['@dec'])
+    return value
+
+
+def encode_cursor(direction: str, values: list) -> str:
+    """ 将排序列的值编码为不透明的游标字符串。
+
+    :param direction: n 代表下一页，p 代表上一页
+    """
+    data = json.dumps(
+        {'d': direction, 'v': [_encode_cursor_value(v) for v in values]},
+        separators=(',', ':'),
+    )
+    return base64.urlsafe_b64encode(data.encode()).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """ 解码 ``encode_cursor`` 生成的游标。
+
+    :return: (direction, values)
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+        direction = data['d']
+        values = [_decode_cursor_value(v) for v in data['v']]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+    if direction not in ('n', 'p'):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return direction, values
+
+
+class KeysetPagination(object):
+    """ 游标分页，也称为 keyset 分页。
+
+    使用查询的 ORDER BY 列作为游标，以 ``WHERE (排序列) > (上一页最后一行)`` 代替 OFFSET，
+    任何一页的查询成本都与第一页相同。若排序列中不包含主键，会自动加入主键保证顺序唯一。
+
+    排序列必须是普通的列（或其 asc/desc），且不能为 NULL。
+    不提供总数和页码，只提供 ``next_cursor`` 和 ``prev_cursor`` 。
+    """
+
+    def __init__(
+        self,
+        query: Query,
+        per_page: int,
+        items: list,
+        next_cursor: str = None,
+        prev_cursor: str = None,
+    ):
+        self.query = query
+        self.per_page = per_page
+        self.items = items
+        #: 获取下一页使用的游标，没有下一页时为 None
+        self.next_cursor = next_cursor
+        #: 获取上一页使用的游标，没有上一页时为 None
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self) -> bool:
+        return self.prev_cursor is not None
+
+    @staticmethod
+    def order_columns(qry: Query) -> list[tuple]:
+        """ 获取查询的排序列。
+
+        :return: [(列, 是否降序), ...]
+        """
+        columns = []
+        for clause in qry._order_by_clauses:
+            desc = False
+            if isinstance(clause, UnaryExpression) and clause.modifier in (
+                operators.desc_op,
+                operators.asc_op,
+            ):
+                desc = clause.modifier is operators.desc_op
+                clause = clause.element
+            if not isinstance(clause, ColumnElement) or getattr(clause, 'key', None) is None:
+                raise ValueError(f'KeysetPagination can not use ORDER BY {clause}!')
+            columns.append((clause, desc))
+        entity = qry.column_descriptions[0].get('entity') if qry.column_descriptions else None
+        if entity is not None:
+            for pk in sa_inspect(entity).primary_key:
+                if not any(pk.compare(col) for col, _ in columns):
+                    columns.append((pk, False))
+        if not columns:
+            raise ValueError('KeysetPagination requires an ORDER BY or a primary key!')
+        return columns
+
+    @staticmethod
+    def attribute_names(qry: Query, columns: list[tuple]) -> list[str]:
+        """ 获取排序列在结果对象上的属性名称。
+
+        Model 的属性名称可以与列名不同，例如 ``rank = Column('rank_value', Integer)`` ，
+        需要通过 mapper 查找。查询的不是 Model 时使用列的 key。
+        """
+        entity = qry.column_descriptions[0].get('entity') if qry.column_descriptions else None
+        mapper = sa_inspect(entity) if entity is not None else None
+        names = []
+        for col, _ in columns:
+            name = col.key
+            if mapper is not None:
+                try:
+                    name = mapper.get_property_by_column(col).key
+                except UnmappedColumnError:
+                    pass
+            names.append(name)
+        return names
+
+    @staticmethod
+    def _after(columns: list[tuple], values: list, backward: bool):
+        """ 生成排在 values 之后（backward 为 True 时为之前）的行的条件。"""
+        clauses = []
+        for i, (col, desc) in enumerate(columns):
+            greater = desc == backward
+            cmp = col > values[i] if greater else col < values[i]
+            clauses.append(and_(*[c == v for (c, _), v in zip(columns[:i], values)], cmp))
+        return or_(*clauses)
+
+    @classmethod
+    def paginate(
+        cls,
+        qry: Query,
+        cursor: str = None,
+        per_page: int = None,
+        max_per_page: int = None,
+    ):
+        """ 获取 cursor 之后（或之前）的 ``per_page`` 个项目。
+
+        :param cursor: 上一次分页返回的 ``next_cursor`` 或 ``prev_cursor`` ，None 或空字符串代表第一页。
+        """
+        if per_page is None or per_page < 0:
+            per_page = 20
+        if max_per_page is not None:
+            per_page = min(per_page, max_per_page)
+
+        columns = cls.order_columns(qry)
+        direction, values = 'n', None
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            if len(values) != len(columns):
+                raise ValueError(f'Invalid cursor: {cursor}')
+        backward = direction == 'p'
+
+        page_qry = qry
+        if values is not None:
+            page_qry = page_qry.filter(cls._after(columns, values, backward))
+        page_qry = page_qry.order_by(None).order_by(
+            *[col.asc() if desc == backward else col.desc() for col, desc in columns]
+        )
+        # 多取一行用于判断是否还有更多
+        items = page_qry.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backward:
+            items.reverse()
+
+        names = cls.attribute_names(qry, columns)
+
+        def row_values(item):
+            return [getattr(item, name) for name in names]
+
+        next_cursor = prev_cursor = None
+        if items:
+            has_next = (not backward and more) or (backward and values is not None)
+            has_prev = (backward and more) or (not backward and values is not None)
+            if has_next:
+                next_cursor = encode_cursor('n', row_values(items[-1]))
+            if has_prev:
+                prev_cursor = encode_cursor('p', row_values(items[0]))
+        return cls(qry, per_page, items, next_cursor, prev_cursor)
+
+
 class BindMetaMixin(type):
     def __init__(cls, name: str, bases, d):
         bind_key = d.pop('__bind_key__', None) or getattr(cls, '__bind_key__', None)
@@ -178,10 +594,433 @@ class DefaultMeta(BindMetaMixin, DeclarativeMeta):
     pass
 
 
+class SQLStats(object):
+    """ 一次请求中执行的 SQL 统计。"""
+
+    def __init__(self, max_slowest: int = 5):
+        self.max_slowest = max_slowest
+        #: 执行的语句数量
+        self.count = 0
+        #: 累计耗时秒数
+        self.seconds = 0.0
+        #: 最慢的语句，[(秒数, 语句), ...]，按耗时降序
+        self.slowest: list = []
+        #: 语句形状的执行次数
+        self.shapes: dict = {}
+        #: 已经报告过 N+1 的语句形状
+        self.reported: set = set()
+
+    def add(self, shape: tuple, statement: str, seconds: float) -> int:
+        """ 记录一条语句，返回该形状在本次请求中的执行次数。"""
+        self.count += 1
+        self.seconds += seconds
+        if len(self.slowest) < self.max_slowest or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.max_slowest:]
+        count = self.shapes.get(shape, 0) + 1
+        self.shapes[shape] = count
+        return count
+
+    def summary(self) -> str:
+        return f'count={self.count}; time={self.seconds * 1000:.1f}ms'
+
+
+class SQLInstrument(object):
+    """ 统计每个请求执行的 SQL 数量和耗时，记录慢查询，检测 N+1 查询。
+
+    在 ``start`` 和 ``finish`` 之间执行的语句计入同一个 ``SQLStats`` ，
+    使用 contextvars 隔离不同的线程和 greenlet。
+
+    :param slow_threshold: 慢查询秒数，超过则写入日志。
+    :param n_plus_one: 同一个请求中相同形状的语句执行次数达到这个值时报告 N+1。
+    :param explain: 是否在慢查询日志中包含 SELECT 语句的执行计划。
+    :param max_slowest: 每个请求保留的最慢语句数量。
+    :param logger: 日志对象，默认为 ``pyape.sql`` 。
+    """
+
+    EXPLAIN_PREFIX: dict = {
+        'sqlite': 'EXPLAIN QUERY PLAN ',
+        'mysql': 'EXPLAIN ',
+        'mariadb': 'EXPLAIN ',
+        'postgresql': 'EXPLAIN ',
+    }
+
+    def __init__(
+        self,
+        slow_threshold: float = 0.5,
+        n_plus_one: int = 10,
+        explain: bool = False,
+        max_slowest: int = 5,
+        logger: logging.Logger = None,
+    ):
+        self.slow_threshold = slow_threshold
+        self.n_plus_one = n_plus_one
+        self.explain = explain
+        self.max_slowest = max_slowest
+        self.logger = logger or logging.getLogger('pyape.sql')
+        self.__current: ContextVar = ContextVar(f'pyape_sql_stats_{id(self)}', default=None)
+
+    def attach(self, engine: Engine) -> None:
+        """ 统计这个 engine 执行的语句。"""
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def start(self) -> SQLStats:
+        """ 开始一次请求的统计。"""
+        stats = SQLStats(self.max_slowest)
+        self.__current.set(stats)
+        return stats
+
+    def finish(self) -> SQLStats:
+        """ 结束当前请求的统计并返回结果，没有开始统计时返回 None。"""
+        stats = self.__current.get()
+        self.__current.set(None)
+        return stats
+
+    @property
+    def current(self) -> SQLStats:
+        return self.__current.get()
+
+    @staticmethod
+    def param_shape(parameters, executemany: bool) -> str:
+        """ 返回参数的形状，即参数的类型而非具体的值，避免在日志中记录敏感数据。"""
+        if executemany:
+            size = len(parameters)
+            parameters = parameters[0] if parameters else ()
+            return f'{size} x {SQLInstrument.param_shape(parameters, False)}'
+        if isinstance(parameters, dict):
+            return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in parameters.items()) + '}'
+        if isinstance(parameters, (list, tuple)):
+            return '(' + ', '.join(type(v).__name__ for v in parameters) + ')'
+        return type(parameters).__name__
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('pyape_sql_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('pyape_sql_start')
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        stats = self.__current.get()
+        if stats is not None:
+            shape = (statement, executemany)
+            count = stats.add(shape, statement, seconds)
+            if count >= self.n_plus_one and shape not in stats.reported:
+                stats.reported.add(shape)
+                self.logger.warning(
+                    'Possible N+1 query, executed %s times in one request: %s', count, statement
+                )
+        if seconds >= self.slow_threshold:
+            self._log_slow(conn, cursor, statement, parameters, context, executemany, seconds)
+
+    def _log_slow(self, conn, cursor, statement, parameters, context, executemany, seconds):
+        plan = None
+        prefix = self.EXPLAIN_PREFIX.get(conn.dialect.name)
+        # 流式读取时连接上还有未读取的结果，不能执行其他语句
+        streaming = context is not None and context.execution_options.get('stream_results')
+        if self.explain and prefix and not executemany and not streaming \
+                and statement.lstrip()[:6].upper() == 'SELECT':
+            try:
+                explain_cursor = cursor.connection.cursor()
+                explain_cursor.execute(prefix + statement, parameters)
+                plan = explain_cursor.fetchall()
+                explain_cursor.close()
+            except Exception as e:
+                plan = f'EXPLAIN error: {e!s}'
+        self.logger.warning(
+            'Slow query %.1fms params %s: %s%s',
+            seconds * 1000,
+            self.param_shape(parameters, executemany),
+            statement,
+            '' if plan is None else f' plan: {plan}',
+        )
+
+
+def schema_fingerprint(metadata: MetaData, dialect) -> str:
+    """ 计算 metadata 中所有表在 dialect 下的 DDL 的哈希值，表结构变化时哈希值随之变化。"""
+    sha = hashlib.sha256()
+    for table in sorted(metadata.tables.values(), key=lambda t: t.key):
+        sha.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda i: i.name or ''):
+            sha.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return sha.hexdigest()
+
+
+# 保存 schema 哈希值的表，不属于任何 Model 的 metadata
+# 多个 bind_key 可能使用同一个数据库，每个 bind_key 一行，默认数据库的 bind_key 保存为空字符串
+_schema_table = Table(
+    'pyape_schema',
+    MetaData(),
+    Column('bind_key', String(64), primary_key=True),
+    Column('fingerprint', String(64), nullable=False),
+    Column('updatetime', Integer, nullable=False),
+)
+
+
+class PoolStats(object):
+    """ 统计一个 Engine 连接池的使用情况，用于根据实际流量确定 pool_size。
+
+    :param engine: 需要统计的 Engine。
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        self.engine = engine
+        self.connects = 0
+        """ 新建的连接数。"""
+        self.checkouts = 0
+        self.invalidations = 0
+        self.soft_invalidations = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.wait_max = 0.0
+        self.__lock = Lock()
+        # Engine 上的连接池事件在 dispose 重建连接池之后仍然有效
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+        event.listen(engine, 'soft_invalidate', self._on_soft_invalidate)
+        # 连接池没有获取连接耗时的事件，包装 raw_connection 统计等待时间
+        raw_connection = engine.raw_connection
+
+        def timed_raw_connection():
+            start = time.perf_counter()
+            try:
+                return raw_connection()
+            finally:
+                self._add_wait(time.perf_counter() - start)
+
+        engine.raw_connection = timed_raw_connection
+
+    def _on_connect(self, dbapi_connection, connection_record) -> None:
+        with self.__lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        with self.__lock:
+            self.checkouts += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception) -> None:
+        with self.__lock:
+            self.invalidations += 1
+
+    def _on_soft_invalidate(self, dbapi_connection, connection_record, exception) -> None:
+        with self.__lock:
+            self.soft_invalidations += 1
+
+    def _add_wait(self, seconds: float) -> None:
+        with self.__lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self) -> dict:
+        """ 返回连接池当前的状态和累计的统计数据。NullPool 等连接池没有 size 等状态，值为 None。"""
+        pool = self.engine.pool
+
+        def pool_value(name):
+            method = getattr(pool, name, None)
+            return None if method is None else method()
+
+        with self.__lock:
+            return {
+                'pool': pool.__class__.__name__,
+                'size': pool_value('size'),
+                'checked_in': pool_value('checkedin'),
+                'checked_out': pool_value('checkedout'),
+                'overflow': pool_value('overflow'),
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'invalidations': self.invalidations,
+                'soft_invalidations': self.soft_invalidations,
+                'wait_avg_ms': round(self.wait_seconds / self.waits * 1000, 3) if self.waits else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }
+
+
+class ReplicaSet(object):
+    """ 一个 bind_key 的主库和只读副本。
+
+    :param primary: 主库的 Engine。
+    :param replicas: 副本的 Engine 列表。
+    :param policy: 选择副本的策略，round_robin 轮询，least_connections 选择连接池中已检出连接最少的副本。
+    :param max_lag: 允许的最大复制延迟秒数，超过则不使用该副本。None 代表不检查延迟。
+    :param check_interval: 检查副本健康状态和延迟的间隔秒数。
+    :param retry_interval: 副本不可用后，等待多少秒再重新尝试。
+    """
+
+    POLICIES: tuple = ('round_robin', 'least_connections')
+
+    # 各数据库获取复制延迟秒数的 SQL
+    LAG_SQL: dict = {
+        'postgresql': 'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())',
+    }
+
+    def __init__(
+        self,
+        primary: Engine,
+        replicas: list[Engine],
+        policy: str = 'round_robin',
+        max_lag: float = None,
+        check_interval: float = 5,
+        retry_interval: float = 30,
+    ):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Replica policy {policy} is not supported!')
+        self.primary = primary
+        self.replicas = replicas
+        self.policy = policy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.__lock = Lock()
+        self.__counter = 0
+        # engine -> 不可用截止时间
+        self.__down_until: dict = {}
+        # engine -> 下次检查时间
+        self.__next_check: dict = {}
+        for engine in replicas:
+            event.listen(engine, 'handle_error', self.__handle_error)
+
+    def __handle_error(self, context) -> None:
+        # 连接断开的副本暂停使用
+        if context.is_disconnect and context.engine is not None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine: Engine) -> None:
+        """ 标记一个副本不可用，retry_interval 秒后重新检查。"""
+        with self.__lock:
+            self.__down_until[engine] = time.monotonic() + self.retry_interval
+            self.__next_check.pop(engine, None)
+
+    def replication_lag(self, engine: Engine) -> float:
+        """ 获取副本的复制延迟秒数，无法获取时返回 0。"""
+        dialect = engine.dialect.name
+        with engine.connect() as conn:
+            if dialect in ('mysql', 'mariadb'):
+                for sql, key in (
+                    ('SHOW REPLICA STATUS', 'Seconds_Behind_Source'),
+                    ('SHOW SLAVE STATUS', 'Seconds_Behind_Master'),
+                ):
+                    try:
+                        row = conn.exec_driver_sql(sql).mappings().first()
+                    except DBAPIError:
+                        continue
+                    if row is None:
+                        return 0
+                    # 复制线程停止时为 NULL，视为无限延迟
+                    lag = row.get(key)
+                    return float('inf') if lag is None else float(lag)
+                return 0
+            sql = self.LAG_SQL.get(dialect)
+            if sql is None:
+                conn.exec_driver_sql('SELECT 1')
+                return 0
+            lag = conn.exec_driver_sql(sql).scalar()
+            return 0 if lag is None else float(lag)
+
+    def is_available(self, engine: Engine) -> bool:
+        """ 判断副本是否可用，每隔 check_interval 秒检查一次连接和延迟。"""
+        now = time.monotonic()
+        if self.__down_until.get(engine, 0) > now:
+            return False
+        if self.__next_check.get(engine, 0) > now:
+            return True
+        try:
+            lag = self.replication_lag(engine)
+        except DBAPIError as e:
+            warnings.warn(f'{self.__class__.__name__} replica {engine.url!r} is down: {e!s}')
+            self.mark_down(engine)
+            return False
+        if self.max_lag is not None and lag > self.max_lag:
+            warnings.warn(f'{self.__class__.__name__} replica {engine.url!r} lag {lag}s')
+            self.mark_down(engine)
+            return False
+        with self.__lock:
+            self.__down_until.pop(engine, None)
+            self.__next_check[engine] = now + self.check_interval
+        return True
+
+    def choose(self) -> Engine:
+        """ 选择一个可用的副本，没有可用的副本时返回主库。"""
+        candidates = [engine for engine in self.replicas if self.is_available(engine)]
+        if not candidates:
+            return self.primary
+        if self.policy == 'least_connections':
+            return min(candidates, key=lambda e: getattr(e.pool, 'checkedout', lambda: 0)())
+        with self.__lock:
+            self.__counter += 1
+            return candidates[self.__counter % len(candidates)]
+
+
+class RoutingSession(Session):
+    """ 根据 Model 所在的 bind_key 选择 Engine，并将只读查询路由到副本的 Session。
+    Engine 在第一次使用时才创建。
+
+    只有 SELECT（不含 FOR UPDATE）会使用副本，flush、写入和文本 SQL 都使用主库。
+    Session 中发生写入、执行了文本 SQL 或者提交之后，直到 Session 关闭，所有查询都使用主库，
+    以保证能读到自己的写入。在 Flask 中 Session 在请求结束时关闭。
+
+    :param dbm: ``DBManager`` 实例。
+    """
+
+    def __init__(self, *args, dbm=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dbm = dbm
+
+    def use_primary(self) -> None:
+        """ 此后直到 Session 关闭，所有查询都使用主库。"""
+        self.info['pyape_use_primary'] = True
+
+    def get_primary_bind(self, mapper=None, clause=None, bind=None, **kw):
+        """ 获取主库的 Engine，不选择副本。"""
+        primary = bind
+        if primary is None and self.dbm is not None:
+            primary = self.dbm.get_engine_for(mapper, clause)
+        if primary is None:
+            primary = super().get_bind(mapper=mapper, clause=clause, **kw)
+        return primary
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kw):
+        primary = self.get_primary_bind(mapper, clause, bind, **kw)
+        replica_set = None if self.dbm is None else self.dbm.replica_set_for(primary)
+        if replica_set is None or self._flushing or self.info.get('pyape_use_primary'):
+            return primary
+        if not isinstance(clause, Select) or clause._for_update_arg is not None:
+            return primary
+        if self.new or self.dirty or self.deleted:
+            return primary
+        return replica_set.choose()
+
+    def close(self) -> None:
+        super().close()
+        self.info.pop('pyape_use_primary', None)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _stick_to_primary(session: RoutingSession, flush_context) -> None:
+    # 写入之后的查询需要读到刚写入的数据，副本可能还没有同步
+    session.use_primary()
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _stick_to_primary_on_dml(orm_execute_state) -> None:
+    # session.execute(insert/update/delete) 不经过 flush。
+    # 与 get_bind 的判断相同，所有不是 Select 的语句（包括 text('UPDATE ...')）都在主库执行，
+    # 之后的读取也应使用主库
+    if not isinstance(orm_execute_state.statement, Select):
+        orm_execute_state.session.use_primary()
+
+
 class DBManager(object):
     """ 管理 SQL 连接，创建和管理数据库 Engine，Session，Model。
     
-    :param URI: 提供数据库地址。
+    :param URI: 提供数据库地址。每个 bind_key 的值可以是一个包含 primary 和 replicas 的 dict，
+        此时只读查询会被路由到 replicas 中的副本，见 ``RoutingSession`` 。
+    :param REPLICA: 副本的配置，一个包含 policy/max_lag/check_interval/retry_interval 的 dict，见 ``ReplicaSet`` 。
+    :param INSTRUMENT: SQL 统计配置，一个包含 slow_threshold/n_plus_one/explain/max_slowest 的 dict，
+        见 ``SQLInstrument`` 。不提供则不统计。
     :param dict kwargs: 提供数据库连接参数。
     """
 
@@ -197,23 +1036,62 @@ class DBManager(object):
     Session_Factory = None
     """ Session 工厂类，使用 sessionmaker 生成。"""
 
-    __engine_lock: Lock = Lock()
-    # 保存 engines 对象
+    __engine_lock: Lock = None
+    # 保存 engines 对象，第一次使用时创建
     __engines: dict = None
-    # 保存 sessionmaker 需要的 binds 参数
-    __binds: dict = None
+    # 保存 bind_key 对应的 (uri, replicas)
+    __uris: dict = None
+    # 保存 Model 的 metadata 对应的 bind_key
+    __metadata_keys: dict = None
     # 保存所有的 Model class
     __model_classes: dict = None
+    # 主库 engine 到 ReplicaSet 的映射
+    __replica_sets: dict = None
+    # engine 到 PoolStats 的映射
+    __pool_stats: dict = None
+    # 上一次 warmup 的参数，fork 之后使用它重新预热
+    __warmup_args: tuple = None
+
+    instrument: SQLInstrument = None
+    """ SQL 统计，未启用时为 None。"""
+
+    SQLITE_PROFILE: dict = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+        'pool': 'queue',
+    }
+    """ ``ENGINE_OPTIONS.sqlite`` 的默认值。提供 ``ENGINE_OPTIONS.sqlite`` 时，未提供的项使用这里的值。
+    pool 为 queue 时使用连接池，为 null 时每次创建新连接。"""
 
     def __init__(
-        self, URI: Union[dict, str], ENGINE_OPTIONS: dict = None, **kwargs: dict
+        self,
+        URI: Union[dict, str],
+        ENGINE_OPTIONS: dict = None,
+        REPLICA: dict = None,
+        INSTRUMENT: dict = None,
+        **kwargs: dict,
     ) -> None:
+        self.__engine_lock = Lock()
         self.__engines = {}
-        self.__binds = {}
+        self.__uris = {}
+        self.__metadata_keys = {}
         self.__model_classes = {}
+        self.__replica_sets = {}
+        self.__pool_stats = {}
         self.URI = URI
         self.ENGINE_OPTIONS = ENGINE_OPTIONS
+        self.REPLICA = REPLICA or {}
+        self.instrument = None
+        if isinstance(INSTRUMENT, dict):
+            instrument_options = dict(INSTRUMENT)
+            if instrument_options.pop('enable', True):
+                self.instrument = SQLInstrument(**instrument_options)
         self.__build_binds()
+        register_after_fork(self, 'after_fork')
 
     @property
     def Models(self) -> Iterable:
@@ -239,23 +1117,64 @@ class DBManager(object):
         for name, uri in view:
             self.__add_bind(name, uri)
 
+        # RoutingSession 根据 Model 的 bind_key 选择 Engine，不使用 binds 参数
         self.Session_Factory = sessionmaker(
-            binds=self.__binds, autoflush=False, future=True
+            autoflush=False,
+            future=True,
+            class_=RoutingSession,
+            dbm=self,
         )
 
-    def __add_bind(self, bind_key: str, uri: str) -> bool:
+    def __add_bind(self, bind_key: str, uri: Union[dict, str]) -> bool:
+        if bind_key in self.__uris:
+            return False
         Model = self.set_Model(bind_key)
-        if self.__binds.get(Model) is None:
-            engine = self.__set_engine(bind_key, uri)
-            self.__binds[Model] = engine
-            return True
-        return False
+        self.__metadata_keys[Model.metadata] = bind_key
+        replicas = []
+        if isinstance(uri, dict):
+            replicas = uri.get('replicas') or []
+            uri = uri['primary']
+        self.__uris[bind_key] = (uri, replicas)
+        return True
+
+    def engine_options(self, bind_key: str = None) -> dict:
+        """ 获取 bind_key 使用的 Engine 参数。
+
+        ENGINE_OPTIONS 中与 bind_key 同名的 dict 是这个数据库独有的参数，覆盖全局参数。
+        """
+        options = {}
+        bind_options = None
+        for key, value in (self.ENGINE_OPTIONS or {}).items():
+            if key in self.__uris and isinstance(value, dict):
+                if key == bind_key:
+                    bind_options = value
+                continue
+            options[key] = value
+        if bind_options:
+            options.update(bind_options)
+        return options
+
+    def __set_engine(self, bind_key: str) -> Engine:
+        uri, replicas = self.__uris[bind_key]
+        engine = self.__create_engine(uri, bind_key)
+        if replicas:
+            self.__replica_sets[engine] = ReplicaSet(
+                engine,
+                [self.__create_engine(replica, bind_key) for replica in replicas],
+                **self.REPLICA,
+            )
+        # 保存 engine
+        self.__engines[bind_key] = engine
+        return engine
 
-    def __set_engine(self, bind_key: str, uri: str) -> None:
+    def __create_engine(self, uri: str, bind_key: str = None) -> Engine:
         sa_url: URL = make_url(uri)
 
-        options: dict = self.ENGINE_OPTIONS or {}
+        options: dict = self.engine_options(bind_key)
         options.setdefault('future', True)
+        # sqlite 性能配置和预热的连接数不是 create_engine 的参数
+        sqlite_profile = options.pop('sqlite', None)
+        options.pop('warmup', None)
 
         if sa_url.drivername.startswith('mysql'):
             # 加入 charset 设置，用于 utf8mb4 这种 charset
@@ -285,6 +1204,8 @@ class DBManager(object):
         elif sa_url.drivername == 'sqlite':
             pool_size = options.get('pool_size')
             detected_in_memory = False
+            if sqlite_profile is not None:
+                sqlite_profile = dict(self.SQLITE_PROFILE, **sqlite_profile)
             if sa_url.database in (None, '', ':memory:'):
                 detected_in_memory = True
 
@@ -304,6 +1225,15 @@ class DBManager(object):
                         'empty queue not possible due to data '
                         'loss.'
                     )
+            elif sqlite_profile is not None and sqlite_profile['pool'] == 'queue':
+                # 复用连接，避免每个 Session 都重新打开文件和读取 schema
+                # 连接池保证一个连接同时只被一个线程使用，因此可以关闭 check_same_thread
+                from sqlalchemy.pool import QueuePool
+
+                options['poolclass'] = QueuePool
+                options.setdefault('pool_size', 5)
+                options['connect_args'] = dict(options.get('connect_args') or {})
+                options['connect_args']['check_same_thread'] = False
             # if pool size is None or explicitly set to 0 we assume the
             # user did not want a queue for this sqlite connection and
             # hook in the null pool.
@@ -317,23 +1247,38 @@ class DBManager(object):
         if sa_url.drivername == 'sqlite':
             # 强制 SQLITE 支持支持外键
             # https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#foreign-key-support
-            from sqlalchemy import event
+            pragmas = ['PRAGMA foreign_keys=ON;']
+            if sqlite_profile is not None:
+                pragmas.extend(self.sqlite_pragmas(sqlite_profile, detected_in_memory))
 
             @event.listens_for(engine, "connect")
             def set_sqlite_pragma(dbapi_connection, connection_record):
                 # print(f'ffff {dbapi_connection=} {connection_record=}')
                 cursor = dbapi_connection.cursor()
-                cursor.execute("PRAGMA foreign_keys=ON;")
+                for pragma in pragmas:
+                    cursor.execute(pragma)
                 cursor.close()
 
         # options['poolclass'] = StaticPool
         # if 'connect_args' not in options:
         #     options['connect_args'] = {}
         # options['connect_args']['check_same_thread'] = False
-        # 保存 engine
-        self.__engines[bind_key] = engine
+        if self.instrument is not None:
+            self.instrument.attach(engine)
+        self.__pool_stats[engine] = PoolStats(engine)
         return engine
 
+    @staticmethod
+    def sqlite_pragmas(profile: dict, in_memory: bool = False) -> list[str]:
+        """ 将 sqlite 性能配置转换为 PRAGMA 语句。内存数据库不支持 WAL。"""
+        pragmas = []
+        for name in ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout', 'temp_store'):
+            value = profile.get(name)
+            if value is None or (in_memory and name == 'journal_mode'):
+                continue
+            pragmas.append(f'PRAGMA {name}={value};')
+        return pragmas
+
     def set_bind(self, bind_key: str, uri: str):
         """ 利用 SQLAlchemy 提供的 binds 机制，
         将 bind_key 与数据库连接绑定起来。
@@ -342,12 +1287,10 @@ class DBManager(object):
             值为 ``[SQLALCHEMY.URI]`` 中的键名。
             若 URI 为 str 而非 dict，则 bind_key 值为 ``None`` 。
         """
+        # RoutingSession 在执行时根据 bind_key 查找 Engine，
+        # 已经创建的 Session 实例也可以使用新的 bind
         succ = self.__add_bind(bind_key, uri)
-        # 因为增加了 bind，所以也要同时更新 __Session_Factory，
-        # 以便新创建的 Session 实例包含新的 bind
-        # 对于已经创建的实例，需要调用 Session.bind_mapper 进行绑定
         if succ:
-            self.Session_Factory.configure(binds=self.__binds)
             return
         raise KeyError(f'bind_key {bind_key} is duplicated!')
 
@@ -369,12 +1312,135 @@ class DBManager(object):
         return Model
 
     def get_engine(self, bind_key: str = None) -> Engine:
-        """ 获取一个 Engine 对象。
+        """ 获取一个 Engine 对象，第一次获取时创建。
 
         :param bind_key: 
             详见 :ref:`pyape.db.DBManager.set_bind <pyape.db.DBManager>` 中的说明。
         """
-        return self.__engines.get(bind_key or self.default_bind_key)
+        bind_key = bind_key or self.default_bind_key
+        engine = self.__engines.get(bind_key)
+        if engine is not None or bind_key not in self.__uris:
+            return engine
+        with self.__engine_lock:
+            engine = self.__engines.get(bind_key)
+            if engine is None:
+                engine = self.__set_engine(bind_key)
+        return engine
+
+    def get_uri(self, bind_key: str = None) -> str:
+        """ 获取 bind_key 对应的主库地址，bind_key 不存在时返回 None。"""
+        uri = self.__uris.get(bind_key or self.default_bind_key)
+        return None if uri is None else uri[0]
+
+    def get_bind_key_for(self, mapper=None, clause=None):
+        """ 根据 Model 或者语句中的表查找 bind_key。
+
+        :return: (是否找到, bind_key)
+        """
+        tables = []
+        if mapper is not None:
+            tables.append(sa_inspect(mapper).local_table)
+        if clause is not None:
+            tables.extend(find_tables(clause, include_crud=True))
+        for table in tables:
+            # 使用 __bind_key__ 定义的 bind_key 优先
+            if 'bind_key' in table.info:
+                return True, table.info['bind_key']
+            if table.metadata in self.__metadata_keys:
+                return True, self.__metadata_keys[table.metadata]
+        return False, None
+
+    def get_engine_for(self, mapper=None, clause=None) -> Engine:
+        """ 根据 Model 或者语句中的表获取 Engine，找不到时返回 None。"""
+        found, bind_key = self.get_bind_key_for(mapper, clause)
+        if not found:
+            return None
+        return self.get_engine(bind_key)
+
+    def get_replica_set(self, bind_key: str = None) -> ReplicaSet:
+        """ 获取 bind_key 对应的 ReplicaSet，没有配置副本时返回 None。"""
+        return self.__replica_sets.get(self.get_engine(bind_key))
+
+    def replica_set_for(self, engine: Engine) -> ReplicaSet:
+        """ 获取主库 Engine 对应的 ReplicaSet。"""
+        return self.__replica_sets.get(engine)
+
+    def dispose_engines(self, close: bool = True) -> None:
+        """ 释放所有已经创建的 Engine 的连接池。
+
+        :param close: 为 False 时不关闭连接，仅丢弃。用于 fork 之后的子进程，
+            此时连接与父进程共享，关闭会影响父进程。
+        """
+        for engine in list(self.__engines.values()):
+            engine.dispose(close=close)
+            replica_set = self.__replica_sets.get(engine)
+            if replica_set is not None:
+                for replica in replica_set.replicas:
+                    replica.dispose(close=close)
+
+    def pool_stats(self) -> dict:
+        """ 获取已经创建的 Engine 的连接池统计，见 ``PoolStats.snapshot`` 。
+
+        :return: bind_key 为键的 dict，有副本时包含 replicas 列表。
+        """
+        stats = {}
+        for bind_key, engine in list(self.__engines.items()):
+            item = self.__pool_stats[engine].snapshot()
+            replica_set = self.__replica_sets.get(engine)
+            if replica_set is not None:
+                item['replicas'] = [self.__pool_stats[replica].snapshot() for replica in replica_set.replicas]
+            stats[bind_key] = item
+        return stats
+
+    def warmup(self, connections: int = None, bind_keys: Iterable = None) -> dict:
+        """ 并行地为每个连接池预先建立连接，避免 worker 启动后的第一批请求等待建立连接。
+
+        :param connections: 每个连接池建立的连接数，默认使用 ENGINE_OPTIONS 中的 warmup。
+            不超过 pool_size，NullPool 等不保存连接的连接池不预热。
+        :param bind_keys: 需要预热的 bind_key，默认为全部。
+        :return: bind_key 为键，成功建立的连接数为值。
+        """
+        bind_keys = list(self.__uris) if bind_keys is None else list(bind_keys)
+        jobs = []
+        for bind_key in bind_keys:
+            count = connections
+            if count is None:
+                count = self.engine_options(bind_key).get('warmup', 0)
+            if not count:
+                continue
+            engine = self.get_engine(bind_key)
+            replica_set = self.__replica_sets.get(engine)
+            for pool_engine in [engine] + (replica_set.replicas if replica_set else []):
+                size = getattr(pool_engine.pool, 'size', None)
+                if size is not None:
+                    jobs.extend([(bind_key, pool_engine)] * min(count, size()))
+        result = {}
+        if not jobs:
+            return result
+        self.__warmup_args = (connections, bind_keys)
+        conns = []
+        with ThreadPoolExecutor(min(len(jobs), 32)) as executor:
+            futures = [(bind_key, executor.submit(engine.connect)) for bind_key, engine in jobs]
+            for bind_key, future in futures:
+                try:
+                    conns.append(future.result())
+                    result[bind_key] = result.get(bind_key, 0) + 1
+                except Exception as e:
+                    warnings.warn(f'DBManager.warmup {bind_key} error: {e!s}')
+        # 同时持有所有连接之后再归还，连接池中才会有足够数量的不同连接
+        for conn in conns:
+            conn.close()
+        return result
+
+    def after_fork(self) -> None:
+        """ 在 fork 出的子进程中调用，丢弃从父进程继承的连接。
+        如果父进程中预热过连接池，在后台线程中重新预热。
+        """
+        # fork 时其他线程可能持有锁
+        self.__engine_lock = Lock()
+        self.dispose_engines(close=False)
+        if self.__warmup_args is not None:
+            Thread(target=self.warmup, args=self.__warmup_args, daemon=True).start()
 
     def create_new_session(self) -> Session:
         """ 创建一个 Session 对象。 """
@@ -397,6 +1463,228 @@ class DBManager(object):
         return scoped_session(self.Session_Factory)
 
 
+class WriteBuffer(object):
+    """ 合并高频的单行写入，由后台线程批量写入数据库。适用于登录记录、操作日志等允许延迟写入的表。
+
+    每个 worker 一个缓冲区。攒够 max_rows 行或者第一行进入缓冲区 interval 秒之后，
+    后台线程使用多行 INSERT 写入。worker 退出时写入剩余的行。
+    进程崩溃时缓冲区中的数据会丢失。
+
+    某些行违反约束（例如主键重复）时，将这一组行二分后重试，只丢弃出错的行并写入日志。
+
+    :param sql: ``SQLAlchemy`` 实例。
+    :param max_rows: 攒够这个行数立即写入。
+    :param interval: 第一行进入缓冲区之后最多等待的秒数。
+    :param max_queue: 队列中最多保存的行数。
+    :param block_timeout: 队列已满时写入方最多等待的秒数，超时则丢弃这一行。None 代表一直等待。
+    :param logger: 日志对象，默认为 ``pyape.sql`` 。
+    """
+
+    # 队列中的控制消息
+    _STOP = object()
+
+    def __init__(
+        self,
+        sql: 'SQLAlchemy',
+        max_rows: int = 500,
+        interval: float = 0.2,
+        max_queue: int = 10000,
+        block_timeout: float = 1.0,
+        logger: logging.Logger = None,
+    ) -> None:
+        self.sql = sql
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_queue = max_queue
+        self.block_timeout = block_timeout
+        self.logger = logger or logging.getLogger('pyape.sql')
+        self.__reset()
+        atexit.register(self.close)
+        uwsgiproxy.register_atexit(self.close)
+        register_after_fork(self, 'after_fork')
+
+    def __reset(self) -> None:
+        self._queue = queue.Queue(self.max_queue)
+        self._thread = None
+        self._closed = False
+        self.__lock = Lock()
+        self.__stats_lock = Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.flush_seconds = 0.0
+        self.flush_max = 0.0
+        self.latency_seconds = 0.0
+        self.latency_max = 0.0
+
+    def after_fork(self) -> None:
+        """ 在 fork 出的子进程中丢弃从父进程继承的队列，后台线程不会被 fork 复制。"""
+        self.__reset()
+
+    def __start(self) -> None:
+        with self.__lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='pyape-write-buffer', daemon=True)
+                self._thread.start()
+
+    def put(self, Model, row: dict) -> bool:
+        """ 将一行放入缓冲区。
+
+        :param Model: Model class 或者 Table。
+        :return: 队列已满且等待超时时丢弃这一行，返回 False。
+        """
+        if self._closed:
+            # 已经关闭，直接写入
+            self._flush([(Model, row, time.perf_counter())])
+            return True
+        if self._thread is None:
+            self.__start()
+        try:
+            self._queue.put((Model, row, time.perf_counter()), timeout=self.block_timeout)
+        except queue.Full:
+            with self.__stats_lock:
+                self.dropped += 1
+            return False
+        with self.__stats_lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self) -> None:
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.perf_counter())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self._STOP:
+                self._flush(batch)
+                return
+            if isinstance(item, Event):
+                # flush() 要求立即写入
+                self._flush(batch)
+                batch, deadline = [], None
+                item.set()
+                continue
+            if item is not None:
+                if not batch:
+                    deadline = time.perf_counter() + self.interval
+                batch.append(item)
+                if len(batch) < self.max_rows:
+                    continue
+            self._flush(batch)
+            batch, deadline = [], None
+
+    def _insert(self, table: Table, engine: Engine, items: list) -> list:
+        """ 写入一组行，返回写入成功的行。
+
+        违反约束时将这一组行二分后分别重试，只有出错的行会被丢弃。
+        其他错误（例如连接失败）时整组丢弃。
+        """
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(table), [row for row, _ in items])
+            return items
+        except (IntegrityError, DataError) as e:
+            if len(items) == 1:
+                self.logger.error(
+                    'WriteBuffer insert %s error, drop row %s: %s',
+                    table.name,
+                    SQLInstrument.param_shape(items[0][0], False),
+                    e.orig,
+                )
+                return []
+        except Exception:
+            self.logger.exception('WriteBuffer insert %s error, drop %s rows', table.name, len(items))
+            return []
+        half = len(items) // 2
+        return self._insert(table, engine, items[:half]) + self._insert(table, engine, items[half:])
+
+    def _flush(self, batch: list) -> None:
+        if not batch:
+            return
+        start = time.perf_counter()
+        # 同一个表中键相同的行才能使用同一个 executemany
+        groups: dict = {}
+        for Model, row, queued_at in batch:
+            groups.setdefault((Model, tuple(sorted(row))), []).append((row, queued_at))
+        written = failed = 0
+        latency_total = latency_max = 0.0
+        for (Model, _), items in groups.items():
+            try:
+                table, engine = self.sql._table_and_engine(Model)
+            except Exception:
+                self.logger.exception('WriteBuffer flush %r error, drop %s rows', Model, len(items))
+                failed += len(items)
+                continue
+            inserted = self._insert(table, engine, items)
+            now = time.perf_counter()
+            written += len(inserted)
+            failed += len(items) - len(inserted)
+            for _, queued_at in inserted:
+                latency_total += now - queued_at
+                latency_max = max(latency_max, now - queued_at)
+        seconds = time.perf_counter() - start
+        with self.__stats_lock:
+            self.flushes += 1
+            self.flushed_rows += written
+            self.failed_rows += failed
+            self.flush_seconds += seconds
+            self.flush_max = max(self.flush_max, seconds)
+            self.latency_seconds += latency_total
+            self.latency_max = max(self.latency_max, latency_max)
+
+    def flush(self, timeout: float = None) -> bool:
+        """ 立即写入缓冲区中的所有行，返回是否在 timeout 秒内完成。"""
+        if self._thread is None or not self._thread.is_alive():
+            batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._flush([item for item in batch if item is not self._STOP])
+            return True
+        done = Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10) -> None:
+        """ 停止后台线程并写入剩余的行。worker 退出时自动调用。
+        gunicorn 中也可以在 worker_exit 钩子中调用 ``gdb.write_buffer.close()`` 。
+        """
+        if self._closed:
+            return
+        self._closed = True
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(self._STOP)
+            thread.join(timeout)
+            if thread.is_alive():
+                self.logger.error('WriteBuffer close timeout, %s rows may be lost.', self._queue.qsize())
+                return
+        self.flush()
+
+    def stats(self) -> dict:
+        """ 返回写入的统计数据。"""
+        with self.__stats_lock:
+            return {
+                'queued': self._queue.qsize(),
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'failed_rows': self.failed_rows,
+                'flush_avg_ms': round(self.flush_seconds / self.flushes * 1000, 3) if self.flushes else 0.0,
+                'flush_max_ms': round(self.flush_max * 1000, 3),
+                'latency_avg_ms': round(self.latency_seconds / self.flushed_rows * 1000, 3) if self.flushed_rows else 0.0,
+                'latency_max_ms': round(self.latency_max * 1000, 3),
+            }
+
+
 class SQLAlchemy(object):
     """ 创建一个用 sqlalchemy 管理数据库的对象。
     封装常用的高级功能，例如 table 和 query 操作。
@@ -422,20 +1710,47 @@ class SQLAlchemy(object):
         ENGINE_OPTIONS: dict = None,
         is_scoped: bool = True,
         in_flask: bool = False,
+        WRITE_BUFFER: dict = None,
         **kwargs: dict,
     ) -> None:
 
         if dbm is None:
             dbm = DBManager(URI, ENGINE_OPTIONS, **kwargs)
         self.dbm = dbm
+        self.write_buffer_options = WRITE_BUFFER or {}
+        self.__write_buffer = None
+        self.__write_buffer_lock = Lock()
         self.in_flask = in_flask
         # 若 in_flask 为真，则 is_scoped 一定为真
         self.is_scoped = True if in_flask else is_scoped
         if self.is_scoped:
             self.Session = self.dbm.create_scoped_session(self.in_flask)
+            register_after_fork(self, 'after_fork')
         else:
             self.Session = self.dbm.Session_Factory
 
+    def after_fork(self) -> None:
+        """ 在 fork 出的子进程中丢弃从父进程继承的 Session，不关闭它们持有的连接。"""
+        self.Session = self.dbm.create_scoped_session(self.in_flask)
+
+    @property
+    def write_buffer(self) -> WriteBuffer:
+        """ 第一次使用时根据 WRITE_BUFFER 配置创建的 ``WriteBuffer`` 。"""
+        if self.__write_buffer is None:
+            with self.__write_buffer_lock:
+                if self.__write_buffer is None:
+                    self.__write_buffer = WriteBuffer(self, **self.write_buffer_options)
+        return self.__write_buffer
+
+    def buffered_insert(self, Model, row: dict) -> bool:
+        """ 将一行放入写入缓冲区，由后台线程与其他行合并为多行 INSERT 写入，见 ``WriteBuffer`` 。
+
+        :param Model: Model class 或者 Table，使用其所在的 bind_key 对应的数据库。
+        :param row: 一行数据。
+        :return: 缓冲区已满且等待超时时丢弃这一行，返回 False。
+        """
+        return self.write_buffer.put(Model, row)
+
     def Model(self, bind_key: str = None):
         """ 获取对应的 Model Factory class。
 
@@ -508,29 +1823,106 @@ class SQLAlchemy(object):
         """
         engine = self.engine(bind_key)
         metadata = self.metadata(bind_key)
-        if table_names:
-            tables = [metadata.tables[tn] for tn in table_names]
-            metadata.drop_all(bind=engine, tables=tables, checkfirst=True)
-        else:
-            metadata.drop_all(bind=engine, checkfirst=True)
+        with engine.begin() as conn:
+            if table_names:
+                tables = [metadata.tables[tn] for tn in table_names]
+                metadata.drop_all(bind=conn, tables=tables, checkfirst=True)
+            else:
+                metadata.drop_all(bind=conn, checkfirst=True)
+            # 表已经与哈希值不符，下次 create_all 需要检查所有表
+            if sa_inspect(conn).has_table(_schema_table.name):
+                conn.execute(delete(_schema_table).where(_schema_table.c.bind_key == (bind_key or '')))
 
     def recreate_table(self, *table_names: str, bind_key: str = None) -> None:
         """ 重建 table，支持单个或者多个名称。"""
         self.drop_tables(table_names=table_names, bind_key=bind_key)
         self.create_tables(table_names=table_names, bind_key=bind_key)
 
-    def create_all(self) -> None:
-        """ 创建所有数据库中的所有表。
+    def _stored_fingerprint(self, engine: Engine, bind_key: str = None) -> str:
+        """ 读取数据库中保存的 bind_key 的 schema 哈希值，没有保存时返回 None。"""
+        with engine.connect() as conn:
+            try:
+                return conn.execute(
+                    select(_schema_table.c.fingerprint).where(_schema_table.c.bind_key == (bind_key or ''))
+                ).scalar()
+            except DBAPIError:
+                # 哈希值表不存在
+                conn.rollback()
+                return None
+
+    def _create_bind(self, bind_key: str, fingerprint: bool) -> bool:
+        """ 创建一个数据库中的所有表，哈希值未变化时跳过。
+
+        :return: 是否执行了创建。
         """
+        engine = self.engine(bind_key)
+        metadata = self.metadata(bind_key)
+        if not fingerprint:
+            metadata.create_all(bind=engine, checkfirst=True)
+            return True
+        value = schema_fingerprint(metadata, engine.dialect)
+        if self._stored_fingerprint(engine, bind_key) == value:
+            return False
+        self._create_schema_table(engine)
+        with engine.begin() as conn:
+            metadata.create_all(bind=conn, checkfirst=True)
+            conn.execute(delete(_schema_table).where(_schema_table.c.bind_key == (bind_key or '')))
+            conn.execute(insert(_schema_table).values(
+                bind_key=bind_key or '', fingerprint=value, updatetime=int(time.time())
+            ))
+        return True
+
+    def _create_schema_table(self, engine: Engine) -> None:
+        """ 创建哈希值表，旧版本中以 id 为主键的表会被重建。
+        使用同一个数据库的 bind_key 由 ``create_all`` 依次创建，这里不需要处理并发。
+        """
+        with engine.begin() as conn:
+            inspector = sa_inspect(conn)
+            if inspector.has_table(_schema_table.name):
+                columns = {c['name'] for c in inspector.get_columns(_schema_table.name)}
+                if 'bind_key' in columns:
+                    return
+                _schema_table.drop(conn)
+            _schema_table.create(conn)
+
+    def _create_binds(self, bind_keys: list, fingerprint: bool) -> dict:
+        """ 依次创建使用同一个数据库的 bind_key。"""
+        return {bind_key: self._create_bind(bind_key, fingerprint) for bind_key in bind_keys}
+
+    def create_all(self, fingerprint: bool = True, max_workers: int = 8) -> dict:
+        """ 创建所有数据库中的所有表，多个数据库同时创建，使用同一个数据库的 bind_key 依次创建。
+
+        每个数据库中的 ``pyape_schema`` 表按 bind_key 保存了 metadata 的 DDL 哈希值，
+        哈希值未变化时不再逐个检查表是否存在。在 ORM 之外修改了表结构时，
+        使用 ``fingerprint=False`` 强制检查。
+
+        :param fingerprint: 是否使用哈希值跳过未变化的数据库。
+        :param max_workers: 最多同时创建的数据库数量。
+        :return: bind_key 为键，是否执行了创建为值。
+        """
+        # 同一个数据库中的哈希值表是共享的，按数据库地址分组
+        databases: dict = {}
         for bind_key in self.dbm.bind_keys:
-            metadata = self.metadata(bind_key)
-            metadata.create_all(bind=self.engine(bind_key), checkfirst=True)
+            databases.setdefault(str(self.engine(bind_key).url), []).append(bind_key)
+        if len(databases) <= 1:
+            result = {}
+            for bind_keys in databases.values():
+                result.update(self._create_binds(bind_keys, fingerprint))
+            return result
+        with ThreadPoolExecutor(min(max_workers, len(databases))) as executor:
+            futures = [
+                executor.submit(self._create_binds, bind_keys, fingerprint)
+                for bind_keys in databases.values()
+            ]
+            result = {}
+            for future in futures:
+                result.update(future.result())
+            return result
 
     def drop_all(self) -> None:
         """ 删除所有数据库中的所有表。"""
         for bind_key in self.dbm.bind_keys:
-            metadata = self.metadata(bind_key)
-            metadata.drop_all(bind=self.engine(bind_key), checkfirst=True)
+            self.drop_tables(bind_key=bind_key)
 
     def get_table(self, name: str, bind_key: str = None) -> Table:
         """ 获取一个 Table。
@@ -540,3 +1932,257 @@ class SQLAlchemy(object):
             详见 :ref:`pyape.db.DBManager.set_bind <pyape.db.DBManager>` 中的说明。
         """
         return self.metadata(bind_key).tables[name]
+
+    def _table_and_engine(self, Model, bind_key: str = None) -> tuple:
+        """ 获取 Model 或 Table 对应的 Table 和主库 Engine。"""
+        if isinstance(Model, Table):
+            table = Model
+            if bind_key is None:
+                bind_key = table.info.get('bind_key')
+        else:
+            table = Model.__table__
+            if bind_key is None:
+                bind_key = getattr(Model, 'bind_key', None)
+        return table, self.engine(bind_key)
+
+    @staticmethod
+    def _chunks(rows: Iterable[dict], chunk_size: int):
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    @staticmethod
+    def _bulk_report(count: int, start: float) -> dict:
+        seconds = time.perf_counter() - start
+        return {
+            'rows': count,
+            'seconds': seconds,
+            'rows_per_second': count / seconds if seconds > 0 else 0.0,
+        }
+
+    def bulk_insert(
+        self, Model, rows: Iterable[dict], chunk_size: int = 1000, bind_key: str = None
+    ) -> dict:
+        """ 批量插入，每个 chunk 使用一次 executemany，SQLAlchemy 会将其编译为多行 INSERT。
+        所有数据在同一个事务中写入。
+
+        :param Model: Model class 或者 Table，使用其所在的 bind_key 对应的数据库。
+        :param rows: 每行一个 dict，可以是生成器。
+        :param chunk_size: 每次 executemany 的行数。
+        :param bind_key: 不提供则使用 Model 的 bind_key。
+        :return: 包含 rows/seconds/rows_per_second 的 dict。
+        """
+        table, engine = self._table_and_engine(Model, bind_key)
+        start = time.perf_counter()
+        count = 0
+        stmt = insert(table)
+        with engine.begin() as conn:
+            for chunk in self._chunks(rows, chunk_size):
+                conn.execute(stmt, chunk)
+                count += len(chunk)
+        return self._bulk_report(count, start)
+
+    @staticmethod
+    def _upsert_stmt(dialect: str, table: Table, conflict_keys: list[str], update_cols: list[str]):
+        if dialect in ('mysql', 'mariadb'):
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+            stmt = mysql_insert(table)
+            if not update_cols:
+                # INSERT IGNORE 会忽略所有的错误（例如 NOT NULL 和外键），只应忽略重复键，
+                # 使用将一列赋值为自身的 ON DUPLICATE KEY UPDATE 代替
+                key = (conflict_keys or [c.name for c in table.primary_key])[0]
+                return stmt.on_duplicate_key_update({key: table.c[key]})
+            return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_cols})
+        if dialect in ('sqlite', 'postgresql'):
+            if dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+
+            stmt = dialect_insert(table)
+            if not update_cols:
+                return stmt.on_conflict_do_nothing(index_elements=conflict_keys)
+            return stmt.on_conflict_do_update(
+                index_elements=conflict_keys,
+                set_={c: stmt.excluded[c] for c in update_cols},
+            )
+        raise NotImplementedError(f'bulk_upsert does not support {dialect}!')
+
+    def bulk_upsert(
+        self,
+        Model,
+        rows: Iterable[dict],
+        conflict_keys: list[str],
+        update_cols: list[str] = None,
+        chunk_size: int = 1000,
+        bind_key: str = None,
+    ) -> dict:
+        """ 批量插入或更新。MySQL 使用 ``INSERT ... ON DUPLICATE KEY UPDATE`` ，
+        SQLite 和 PostgreSQL 使用 ``INSERT ... ON CONFLICT DO UPDATE`` 。
+        所有数据在同一个事务中写入。
+
+        :param conflict_keys: 判断冲突的唯一键列名。MySQL 使用表上所有的唯一索引判断，忽略这个参数。
+        :param update_cols: 冲突时更新的列名，不提供则更新第一行中除 conflict_keys 之外的所有列。
+        :return: 包含 rows/seconds/rows_per_second 的 dict。
+        """
+        table, engine = self._table_and_engine(Model, bind_key)
+        start = time.perf_counter()
+        count = 0
+        stmt = None
+        with engine.begin() as conn:
+            for chunk in self._chunks(rows, chunk_size):
+                if stmt is None:
+                    if update_cols is None:
+                        update_cols = [c for c in chunk[0] if c not in conflict_keys]
+                    stmt = self._upsert_stmt(engine.dialect.name, table, conflict_keys, update_cols)
+                conn.execute(stmt, chunk)
+                count += len(chunk)
+        return self._bulk_report(count, start)
+
+    def stream(
+        self,
+        stmt,
+        batch_size: int = 1000,
+        bind_key: str = None,
+        partitions: bool = False,
+        scalars: bool = False,
+    ):
+        """ 使用服务端游标逐批读取查询结果，内存占用与结果总数无关。
+        MySQL(pymysql) 使用 SSCursor，PostgreSQL 使用命名游标。
+
+        使用独立的 Session，生成器结束或被关闭时释放连接。
+
+        :param stmt: select 语句。
+        :param batch_size: 每次从数据库读取的行数。
+        :param bind_key: 不提供则根据 stmt 中的 Model 选择数据库。
+        :param partitions: 为 True 时每次返回一个包含最多 batch_size 行的 list，否则逐行返回。
+        :param scalars: 为 True 时返回每行的第一列，适用于 ``select(Model)`` 。
+        """
+        bind_arguments = None
+        if bind_key is not None:
+            bind_arguments = {'bind': self.engine(bind_key)}
+        with self.dbm.create_new_session() as session:
+            result = session.execute(
+                stmt,
+                execution_options={'stream_results': True, 'yield_per': batch_size},
+                bind_arguments=bind_arguments,
+            )
+            if scalars:
+                result = result.scalars()
+            if partitions:
+                # Session 使用弱引用保存 ORM 对象，处理过的对象会被回收
+                yield from result.partitions(batch_size)
+            else:
+                yield from result
+
+    def export_csv(
+        self,
+        stmt,
+        fileobj,
+        batch_size: int = 1000,
+        bind_key: str = None,
+        header: bool = True,
+    ) -> int:
+        """ 将查询结果以 CSV 格式流式写入文件，返回写入的行数。
+
+        :param stmt: select 语句，应选择具体的列而非 Model。
+        :param fileobj: 以文本模式打开的文件对象。
+        """
+        writer = csv.writer(fileobj)
+        count = 0
+        for partition in self.stream(stmt, batch_size, bind_key, partitions=True):
+            if header and count == 0:
+                writer.writerow(partition[0]._fields)
+            writer.writerows(partition)
+            count += len(partition)
+        return count
+
+
+class RegionalShards(object):
+    """ 按 r 分表的路由。每个 regional 拥有一个表，表所在的数据库由它的 bind_key 决定。
+
+    ``table(r)`` 返回 r 对应的 Model，``fan_out`` 在所有 regional 上并行执行查询并合并结果。
+    在 Flask 中使用 ``PyapeDB.get_regional_shards`` 创建。
+
+    :param sql: ``SQLAlchemy`` 实例。
+    :param tables: r 为键，Model 为值的 dict。
+    :param max_workers: 并行查询的最大线程数。
+    """
+
+    def __init__(self, sql: 'SQLAlchemy', tables: dict, max_workers: int = 16) -> None:
+        self.sql = sql
+        self.tables = tables
+        self.max_workers = max_workers
+
+    @property
+    def rids(self) -> list:
+        return list(self.tables.keys())
+
+    def table(self, r: int):
+        """ 获取 r 对应的 Model。"""
+        Cls = self.tables.get(r)
+        if Cls is None:
+            raise ValueError(f'RegionalShards: No regional {r}')
+        return Cls
+
+    def bind_key(self, r: int) -> str:
+        """ 获取 r 对应的 Model 所在的 bind_key。"""
+        _, bind_key = self.sql.dbm.get_bind_key_for(self.table(r))
+        return bind_key
+
+    def _run_bind(self, query_builder, rs: list, scalars: bool) -> list:
+        rows = []
+        # 同一个数据库中的 regional 共用一个 Session，即一个连接
+        with self.sql.dbm.create_new_session() as session:
+            for r in rs:
+                result = session.execute(query_builder(self.table(r), r))
+                rows.extend(result.scalars() if scalars else result)
+        return rows
+
+    def fan_out(
+        self,
+        query_builder,
+        rs: Iterable[int] = None,
+        key=None,
+        reverse: bool = False,
+        limit: int = None,
+        scalars: bool = False,
+    ) -> list:
+        """ 在多个 regional 上执行查询，合并结果。
+
+        每个 bind_key 使用线程池中的一个线程和一个连接，不同数据库上的查询同时执行，
+        总耗时取决于最慢的数据库。同一个数据库中的 regional 依次查询。
+
+        :param query_builder: ``query_builder(Model, r)`` 返回这个 regional 的 select 语句。
+            需要 limit 时，语句本身也应该排序并 limit，以减少每个 regional 返回的行。
+        :param rs: 需要查询的 r 列表，默认为所有 regional。
+        :param key: 合并后排序使用的函数，与 ``sorted`` 的 key 参数相同。不提供则不排序。
+        :param reverse: 倒序排序。
+        :param limit: 合并排序后最多返回的数量。
+        :param scalars: 返回每行的第一列，适用于 ``select(Model)`` 。
+        :return: 合并后的行列表。
+        """
+        rs = self.rids if rs is None else list(rs)
+        groups: dict = {}
+        for r in rs:
+            groups.setdefault(self.bind_key(r), []).append(r)
+        if len(groups) <= 1:
+            results = [self._run_bind(query_builder, group, scalars) for group in groups.values()]
+        else:
+            with ThreadPoolExecutor(min(self.max_workers, len(groups))) as executor:
+                futures = [
+                    executor.submit(self._run_bind, query_builder, group, scalars)
+                    for group in groups.values()
+                ]
+                # 任何一个数据库出错都直接抛出
+                results = [future.result() for future in futures]
+        rows = [row for result in results for row in result]
+        if key is not None:
+            rows.sort(key=key, reverse=reverse)
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
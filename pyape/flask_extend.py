@@ -4,10 +4,12 @@ pyape.flask_extend
 
 对 Flask 框架进行扩展。
 """
+import warnings
 from typing import Callable, Any
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from collections.abc import Sequence
 from datetime import datetime
-from decimal import Decimal
 
 import flask
 from flask import Flask, Response, request
@@ -18,7 +20,9 @@ from sqlalchemy.engine import Row, RowMapping, Result
 from redis.client import Redis
 
 from pyape.config import GlobalConfig, Dicto, RegionalConfig
-from pyape.db import SQLAlchemy, DBManager
+from pyape.db import SQLAlchemy, DBManager, RegionalShards
+from pyape.serializer import serialize_rows, result_types
+from pyape.util.func import register_after_fork
 
 
 class PyapeSecureCookieSessionInterface(SecureCookieSessionInterface):
@@ -168,18 +172,55 @@ class PyapeDB(SQLAlchemy):
         self._app = app
         self._gconf = app._gconf
 
+        sql_write_buffer = self._gconf.getcfg('SQLALCHEMY', 'WRITE_BUFFER')
         # 支持从一个已有的 dbinst 对象中共享 dbm 对象。用于项目中有多套 SQLAlchemy 的情况。
         if isinstance(dbinst, SQLAlchemy):
-            super().__init__(dbm=dbinst.dbm, is_scoped=True, in_flask=True)
+            super().__init__(
+                dbm=dbinst.dbm, is_scoped=True, in_flask=True, WRITE_BUFFER=sql_write_buffer
+            )
         elif isinstance(dbinst, DBManager):
-            super().__init__(dbm=dbinst, is_scoped=True, in_flask=True)
+            super().__init__(
+                dbm=dbinst, is_scoped=True, in_flask=True, WRITE_BUFFER=sql_write_buffer
+            )
         else:
             sql_uri = self._gconf.getcfg('SQLALCHEMY', 'URI')
             sql_options = self._gconf.getcfg('SQLALCHEMY', 'ENGINE_OPTIONS')
+            sql_replica = self._gconf.getcfg('SQLALCHEMY', 'REPLICA')
+            sql_instrument = self._gconf.getcfg('SQLALCHEMY', 'INSTRUMENT')
+            if isinstance(sql_instrument, dict):
+                sql_instrument = dict(sql_instrument, logger=app.logger)
             super().__init__(
-                URI=sql_uri, ENGINE_OPTIONS=sql_options, is_scoped=True, in_flask=True
+                URI=sql_uri,
+                ENGINE_OPTIONS=sql_options,
+                REPLICA=sql_replica,
+                INSTRUMENT=sql_instrument,
+                is_scoped=True,
+                in_flask=True,
+                WRITE_BUFFER=sql_write_buffer,
             )
         self._app.logger.info(f'self.Session {self.Session}')
+        # 按照 ENGINE_OPTIONS 中的 warmup 预先建立连接
+        warmed = self.dbm.warmup()
+        if warmed:
+            self._app.logger.info(f'PyapeDB.warmup {warmed}')
+
+        instrument = self.dbm.instrument
+        if instrument is not None:
+
+            @app.before_request
+            def start_sql_stats():
+                instrument.start()
+
+            @app.after_request
+            def finish_sql_stats(response):
+                stats = instrument.finish()
+                if stats is not None and stats.count:
+                    app.logger.info(
+                        'SQL %s %s: %s', request.method, request.path, stats.summary()
+                    )
+                    if app.debug:
+                        response.headers['X-Pyape-SQL'] = stats.summary()
+                return response
 
         @app.teardown_appcontext
         def shutdown_session(response_or_exc):
@@ -277,11 +318,25 @@ class PyapeDB(SQLAlchemy):
         if Cls is None:
             # 可能存在更新了 regional 之后，没有更新 tables 的情况，这里要更新一次。
             # 每个进程都需要更新，但每次调用可能仅发生在其中一个进程。因此必须在每次调用的时候都检测更新。
-            self.build_regional_tables(name, build_table_method, self._gconf)
-            return self.__regional_table_cls.get(name)
+            self.build_regional_tables(name, build_table_method, rconfig)
+            return self.__regional_table_cls.get(name).get(r)
         # logger.info('get_regional_table %s', Cls)
         return Cls
 
+    def get_regional_shards(
+        self, name: str, build_table_method, rconfig: RegionalConfig, max_workers: int = 16
+    ) -> RegionalShards:
+        """根据 regionals 的配置创建多个表，返回按 r 路由这些表的 ``RegionalShards``。
+
+        :param name: 表的名称前缀。
+        :param build_table_method: 创建表的方法，接受两个参数，动态创建一个 Table Class。
+        :param rconfig: ``RegionalConfig`` 的实例。
+        :param max_workers: ``fan_out`` 并行查询的最大线程数。
+        """
+        self.build_regional_tables(name, build_table_method, rconfig)
+        # 共享同一个 dict，之后调用 build_regional_tables 增加的表同样可以路由
+        return RegionalShards(self, self.__regional_table_cls[name], max_workers)
+
     def result2dict(
         self,
         result: dict | RowMapping | Row,
@@ -297,27 +352,10 @@ class PyapeDB(SQLAlchemy):
         :param replaceobj_key_only: 仅包含可替换的键。
         :return: 转换成功的 dict。
         """
-        result_dict = {}
-        for key in keys:
-            value = (
-                result.get(key) if isinstance(result, dict) else getattr(result, key)
-            )
-            if isinstance(value, datetime):
-                value = value.isoformat()
-            elif isinstance(value, Decimal):
-                value = int(value)
-            newkey = key
-            if replaceobj:
-                # 仅使用 replaceobj 中提供的键名
-                # 这样在找不到键名的时候，newkey 的值为 None
-                if replaceobj_key_only:
-                    newkey = replaceobj.get(key, None)
-                # 找不到对应键名，就使用原始键名
-                else:
-                    newkey = replaceobj.get(key, key)
-            if newkey:
-                result_dict[newkey] = value
-        return result_dict
+        access = 'get' if isinstance(result, dict) else 'attr'
+        return serialize_rows(
+            [result], keys, replaceobj, replaceobj_key_only, access=access
+        )[0]
 
     def to_response_data(
         self,
@@ -336,6 +374,11 @@ class PyapeDB(SQLAlchemy):
         if result is None:
             return {}
         if isinstance(result, list):
+            if replaceobj is not None and result and isinstance(result[0], Row):
+                # 同一个查询得到的 Row 键名相同，使用同一个转换函数
+                fields = result[0]._fields
+                if all(isinstance(item, Row) and item._fields == fields for item in result):
+                    return serialize_rows(result, fields, replaceobj, replaceobj_key_only)
             return [
                 self.to_response_data(item, replaceobj, replaceobj_key_only)
                 for item in result
@@ -349,16 +392,19 @@ class PyapeDB(SQLAlchemy):
         elif isinstance(result, Result):
             if replaceobj is None:
                 return [item._asdict() for item in result.all()]
-            return [
-                self.result2dict(item, item._fields, replaceobj, replaceobj_key_only)
-                for item in result.all()
-            ]
+            return serialize_rows(
+                result.all(),
+                result.keys(),
+                replaceobj,
+                replaceobj_key_only,
+                types=result_types(result),
+            )
         elif isinstance(result, Row):
             if replaceobj is None:
                 return result._asdict()
-            return self.result2dict(
-                result, result._fields, replaceobj, replaceobj_key_only
-            )
+            return serialize_rows(
+                [result], result._fields, replaceobj, replaceobj_key_only
+            )[0]
         return result
 
 
@@ -411,6 +457,7 @@ class PyapeRedis:
             self._gconf = gconf
             self._rconf = gconf.regional
             self.init_redis()
+        register_after_fork(self, 'after_fork')
 
     def init_app(self, app: PyapeFlask, **kwargs):
         """初始化 redis 连接，并将  REDIS 写入 Flask 的 extensions 对象。"""
@@ -428,6 +475,7 @@ class PyapeRedis:
         )
         self._client = Redis.from_url(self._uri, **self.provider_kwargs)
         self._update_binds()
+        self.warmup()
 
     def _update_binds(self):
         self._uri_binds = self._gconf.getcfg(self.config_binds)
@@ -438,6 +486,46 @@ class PyapeRedis:
                     bind_uri, **self.provider_kwargs
                 )
 
+    def warmup(self, connections: int = None) -> dict:
+        """并行地为每个 redis 连接池预先建立连接。
+
+        :param connections: 每个连接池建立的连接数，默认使用配置中的 ``[REDIS] WARMUP`` 。
+        :return: bind_key 为键，成功建立的连接数为值。
+        """
+        if connections is None:
+            connections = self._gconf.getcfg(self.config_prefix, 'WARMUP', default_value=0)
+        result = {}
+        if not connections:
+            return result
+        jobs = []
+        for bind_key, client in self._client_binds.items():
+            pool = client.connection_pool
+            count = min(connections, pool.max_connections)
+            jobs.extend([(bind_key, pool)] * count)
+        conns = []
+        with ThreadPoolExecutor(min(len(jobs), 32)) as executor:
+            # get_connection 会建立连接并检查连接是否可用
+            futures = [(bind_key, pool, executor.submit(pool.get_connection)) for bind_key, pool in jobs]
+            for bind_key, pool, future in futures:
+                try:
+                    conns.append((pool, future.result()))
+                    result[bind_key] = result.get(bind_key, 0) + 1
+                except Exception as e:
+                    warnings.warn(f'PyapeRedis.warmup {bind_key} error: {e!s}')
+        # 同时持有所有连接之后再归还，连接池中才会有足够数量的不同连接
+        for pool, conn in conns:
+            pool.release(conn)
+        return result
+
+    def after_fork(self):
+        """在 fork 出的子进程中丢弃从父进程继承的 redis 连接，不关闭它们。
+        配置了 ``WARMUP`` 时在后台线程中重新预热。
+        """
+        for client in self._client_binds.values():
+            client.connection_pool.reset()
+        if self._gconf.getcfg(self.config_prefix, 'WARMUP'):
+            Thread(target=self.warmup, daemon=True).start()
+
     def get_uri(self, bind_key: str = None, miss_default: bool = False) -> str:
         """获取一个 redis uri 地址。
 
@@ -0,0 +1,152 @@
+"""
+pyape.serializer
+~~~~~~~~~~~~~~~~~~~
+
+将查询结果的行转换为 dict，用于 ``PyapeDB.to_response_data`` 和 ``PyapeDB.result2dict`` 。
+
+根据列的类型和键名，以及 replaceobj/replaceobj_key_only 的设置，为每种组合生成一个专用的转换函数并缓存。
+转换函数直接构建 dict，不需要逐个值查找替换键名。
+
+根据列的 SQLAlchemy 类型决定转换方式。类型能够证明值不会是 datetime 或 Decimal 时不做转换，
+类型未知时同时检查 datetime 和 Decimal。
+"""
+import functools
+from datetime import datetime
+from decimal import Decimal
+from collections.abc import Sequence
+
+from sqlalchemy.engine import Result
+from sqlalchemy.types import DateTime, Numeric, Float, String, Boolean, Date, Time, LargeBinary
+
+
+PLAIN = 'plain'
+DATETIME = 'datetime'
+DECIMAL = 'decimal'
+ANY = 'any'
+
+# 值一定不是 datetime 或 Decimal 的类型
+PLAIN_TYPES = (String, Boolean, Date, Time, LargeBinary)
+
+
+def _datetime(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _decimal(value):
+    return int(value) if isinstance(value, Decimal) else value
+
+
+def _any(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value)
+    return value
+
+
+_CONVERTERS = {DATETIME: '_datetime', DECIMAL: '_decimal', ANY: '_any'}
+
+
+def kind_of_type(sa_type) -> str:
+    """ 根据 SQLAlchemy 类型判断列的转换方式。"""
+    if isinstance(sa_type, DateTime):
+        return DATETIME
+    if isinstance(sa_type, (Numeric, Float)):
+        # asdecimal 为 False 时 SQLAlchemy 会将 Decimal 转换为 float
+        return DECIMAL if sa_type.asdecimal else PLAIN
+    if isinstance(sa_type, PLAIN_TYPES):
+        return PLAIN
+    # Integer 等类型的列仍可能返回 Decimal，例如 MySQL 中的 SUM
+    return ANY
+
+
+def result_types(result: Result) -> list:
+    """ 获取 Core 查询结果中每一列的 SQLAlchemy 类型，无法获取时返回 None。"""
+    try:
+        columns = result.context.compiled.statement.selected_columns
+    except AttributeError:
+        return None
+    if len(columns) != len(result.keys()):
+        return None
+    return [column.type for column in columns]
+
+
+def column_kinds(keys: Sequence[str], types: list = None) -> tuple:
+    """ 获取每一列的转换方式，没有提供类型时所有列都使用 ANY。
+
+    :param types: 每一列的 SQLAlchemy 类型。
+    """
+    if types is None:
+        return (ANY,) * len(keys)
+    return tuple(kind_of_type(t) for t in types)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_serializer(
+    keys: tuple,
+    kinds: tuple,
+    replaceobj: tuple = None,
+    replaceobj_key_only: bool = False,
+    access: str = 'index',
+):
+    """ 生成将一行转换为 dict 的函数。
+
+    :param keys: 列的键名。
+    :param kinds: 每一列的转换方式，见 ``column_kinds`` 。
+    :param replaceobj: 替换键名，使用 ``tuple(replaceobj.items())`` 以便缓存。
+    :param replaceobj_key_only: 仅保留 replaceobj 中的键。
+    :param access: 取值的方式，index 使用下标，get 使用 dict.get，attr 使用 getattr。
+    """
+    replace = dict(replaceobj) if replaceobj else None
+    items = []
+    for i, (key, kind) in enumerate(zip(keys, kinds)):
+        newkey = key
+        if replace:
+            newkey = replace.get(key) if replaceobj_key_only else replace.get(key, key)
+        if not newkey:
+            continue
+        if access == 'index':
+            expr = f'row[{i}]'
+        elif access == 'get':
+            expr = f'row.get({key!r})'
+        else:
+            expr = f'getattr(row, {key!r})'
+        converter = _CONVERTERS.get(kind)
+        if converter is not None:
+            expr = f'{converter}({expr})'
+        items.append(f'{newkey!r}: {expr}')
+    source = 'def serialize(row):\n    return {' + ', '.join(items) + '}\n'
+    namespace = {'_datetime': _datetime, '_decimal': _decimal, '_any': _any}
+    exec(compile(source, '<pyape.serializer>', 'exec'), namespace)
+    return namespace['serialize']
+
+
+def serialize_rows(
+    rows: Sequence,
+    keys: Sequence[str],
+    replaceobj: dict = None,
+    replaceobj_key_only: bool = False,
+    types: list = None,
+    access: str = 'index',
+) -> list[dict]:
+    """ 将一批键相同的行转换为 dict 列表。
+
+    与 ``PyapeDB.result2dict`` 的规则相同：datetime 转换为 isoformat，Decimal 转换为 int，
+    提供 replaceobj 时替换键名。
+
+    :param rows: 行列表。
+    :param keys: 列的键名。
+    :param types: 每一列的 SQLAlchemy 类型，见 ``result_types`` 。
+    """
+    if not rows:
+        return []
+    keys = tuple(keys)
+    kinds = column_kinds(keys, types)
+    serialize = compile_serializer(
+        keys,
+        kinds,
+        tuple(replaceobj.items()) if replaceobj else None,
+        replaceobj_key_only,
+        access,
+    )
+    return list(map(serialize, rows))
@@ -0,0 +1,314 @@
+"""
+pyape.shm
+~~~~~~~~~~~~~~~~~~~
+
+基于 mmap 文件的跨进程哈希表，同一台主机上的所有 worker 共享。
+为 gunicorn 等没有 uwsgi cache 的部署提供进程间缓存。
+
+布局：文件头之后是固定数量、固定大小的槽位。
+键的哈希值决定它的起始槽位，只在之后 ``probe`` 个槽位中查找和写入。
+
+- 读取不加锁，使用每个槽位的 seqlock 检测读取期间的写入，发生写入则重试。
+- 写入使用覆盖探测窗口的 fcntl 字节范围锁在进程之间互斥，进程内使用线程锁。
+- 窗口已满时使用 CLOCK 算法淘汰：读取命中时设置引用位，淘汰时跳过并清除引用位。
+"""
+import os
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+MAGIC = b'PYAPESHM'
+VERSION = 1
+
+# magic, version, slots, slot_size
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+
+# seq, used, ref, key_len, value_len, key_hash, expire_at
+SLOT_HEADER = struct.Struct('<IBBHIQd')
+SLOT_HEADER_SIZE = 32
+SEQ = struct.Struct('<I')
+# 引用位在槽位中的偏移，读取命中时直接写入这个字节
+REF_OFFSET = 5
+
+
+def key_hash(key: bytes) -> int:
+    """ 计算跨进程稳定的哈希值，不能使用会随机化的内置 hash。"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class SharedHashTable(object):
+    """ 保存在 mmap 文件中的定长哈希表。键和值都是 bytes。
+
+    :param fpath: mmap 文件路径，所有 worker 必须使用同一个文件。
+    :param slots: 槽位数量。
+    :param slot_size: 每个槽位的字节数，键和值的总长度不能超过 ``slot_size - 32``。
+    :param probe: 每个键最多探测的槽位数量。
+    """
+
+    fpath: Path = None
+    slots: int = 4096
+    slot_size: int = 1024
+    probe: int = 8
+    max_retries: int = 16
+    """ 读取时遇到写入冲突的最大重试次数，超过则视为未命中。"""
+
+    def __init__(
+        self, fpath: Path, slots: int = 4096, slot_size: int = 1024, probe: int = 8
+    ):
+        if slot_size <= SLOT_HEADER_SIZE or slot_size % 8 != 0:
+            raise ValueError('SharedHashTable slot_size must be a multiple of 8 and larger than 32!')
+        if probe < 1 or probe > slots:
+            raise ValueError('SharedHashTable probe must be between 1 and slots!')
+        self.fpath = Path(fpath)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.probe = probe
+        self.size = HEADER_SIZE + slots * slot_size
+        self.evictions = 0
+        self.__thread_lock = threading.Lock()
+        self.__fd = os.open(self.fpath, os.O_RDWR | os.O_CREAT, 0o644)
+        self.__init_file()
+        self.__mm = mmap.mmap(self.__fd, self.size, mmap.MAP_SHARED)
+
+    @property
+    def payload_size(self) -> int:
+        """ 每个槽位可保存的键和值的总字节数。"""
+        return self.slot_size - SLOT_HEADER_SIZE
+
+    def __lock(self, start: int, length: int = 1, exclusive: bool = True) -> None:
+        if fcntl is not None:
+            fcntl.lockf(
+                self.__fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, length, start
+            )
+
+    def __unlock(self, start: int, length: int = 1) -> None:
+        if fcntl is not None:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN, length, start)
+
+    def __init_file(self) -> None:
+        """ 创建或者校验 mmap 文件。
+
+        其他 worker 可能正在使用已有的文件，截断它会导致这些进程访问 mmap 时崩溃（SIGBUS），
+        因此配置与已有的文件不同时抛出异常，应该使用新的文件路径。
+        """
+        # 使用文件的第一个字节作为初始化锁
+        self.__lock(0)
+        try:
+            header = os.pread(self.__fd, HEADER.size, 0)
+            expected = HEADER.pack(MAGIC, VERSION, self.slots, self.slot_size)
+            file_size = os.fstat(self.__fd).st_size
+            if header == expected and file_size == self.size:
+                return
+            # 新文件，或者上一次初始化在写入文件头之前中断
+            if file_size == 0 or (file_size == self.size and not header.strip(b'\0')):
+                os.ftruncate(self.__fd, self.size)
+                os.pwrite(self.__fd, expected, 0)
+                return
+            raise ValueError(
+                f'{self.fpath.as_posix()} does not match slots={self.slots} slot_size={self.slot_size}, '
+                'use a new file or remove it after all workers are stopped!'
+            )
+        finally:
+            self.__unlock(0)
+
+    def _home(self, h: int) -> int:
+        # 探测窗口不回绕，便于用一段连续的字节范围锁住整个窗口
+        return h % (self.slots - self.probe + 1)
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + index * self.slot_size
+
+    def _read_slot(self, index: int, key: bytes, h: int):
+        """ 使用 seqlock 读取一个槽位。
+
+        :return: (状态, value, 过期时间)，状态为 hit/miss/expired/retry
+        """
+        mm = self.__mm
+        offset = self._offset(index)
+        seq1, used, ref, key_len, value_len, slot_hash, expire_at = \
+            SLOT_HEADER.unpack_from(mm, offset)
+        if seq1 & 1:
+            return 'retry', None, 0
+        if not used or slot_hash != h or key_len != len(key):
+            # 未命中同样需要确认读取的是一个完整的槽位
+            if SEQ.unpack_from(mm, offset)[0] != seq1:
+                return 'retry', None, 0
+            return 'miss', None, 0
+        start = offset + SLOT_HEADER_SIZE
+        slot_key = mm[start:start + key_len]
+        value = mm[start + key_len:start + key_len + value_len]
+        if SEQ.unpack_from(mm, offset)[0] != seq1:
+            return 'retry', None, 0
+        if slot_key != key:
+            return 'miss', None, 0
+        if expire_at and expire_at <= time.time():
+            return 'expired', None, 0
+        if not ref:
+            mm[offset + REF_OFFSET] = 1
+        return 'hit', value, expire_at
+
+    def get(self, key: bytes) -> bytes:
+        """ 获取一个值，不存在或已过期返回 None。"""
+        return self.get_with_expire(key)[0]
+
+    def get_with_expire(self, key: bytes) -> tuple:
+        """ 获取一个值和它的过期时间戳。
+
+        :return: (value, 过期时间)，过期时间为 0 代表永不过期，不存在时 value 为 None。
+        """
+        h = key_hash(key)
+        home = self._home(h)
+        for _ in range(self.max_retries):
+            retry = False
+            for index in range(home, home + self.probe):
+                state, value, expire_at = self._read_slot(index, key, h)
+                if state == 'hit':
+                    return value, expire_at
+                if state == 'expired':
+                    return None, 0
+                if state == 'retry':
+                    retry = True
+                    break
+            if not retry:
+                return None, 0
+        return None, 0
+
+    def _write_slot(
+        self, index: int, key: bytes = None, h: int = 0, value: bytes = None, ttl: float = None
+    ) -> None:
+        """ 在持有写锁的情况下写入一个槽位。key 为 None 代表清空槽位。"""
+        mm = self.__mm
+        offset = self._offset(index)
+        seq = SEQ.unpack_from(mm, offset)[0]
+        # 奇数代表正在写入
+        SEQ.pack_into(mm, offset, (seq + 1) & 0xFFFFFFFF)
+        if key is None:
+            SLOT_HEADER.pack_into(mm, offset, (seq + 1) & 0xFFFFFFFF, 0, 0, 0, 0, 0, 0.0)
+        else:
+            start = offset + SLOT_HEADER_SIZE
+            mm[start:start + len(key)] = key
+            mm[start + len(key):start + len(key) + len(value)] = value
+            expire_at = time.time() + ttl if ttl else 0.0
+            SLOT_HEADER.pack_into(
+                mm, offset, (seq + 1) & 0xFFFFFFFF, 1, 1, len(key), len(value), h, expire_at
+            )
+        SEQ.pack_into(mm, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def _find(self, home: int, key: bytes, h: int) -> int:
+        """ 在持有写锁的情况下查找键所在的槽位，不存在返回 None。不会修改任何槽位。"""
+        mm = self.__mm
+        for index in range(home, home + self.probe):
+            offset = self._offset(index)
+            _, used, _, key_len, _, slot_hash, _ = SLOT_HEADER.unpack_from(mm, offset)
+            if used and slot_hash == h and key_len == len(key):
+                start = offset + SLOT_HEADER_SIZE
+                if mm[start:start + key_len] == key:
+                    return index
+        return None
+
+    def _find_for_write(self, home: int, key: bytes, h: int) -> tuple:
+        """ 在窗口中查找写入位置。
+
+        :return: (槽位序号, 是否为已存在的键)
+        """
+        index = self._find(home, key, h)
+        if index is not None:
+            return index, True
+        mm = self.__mm
+        now = time.time()
+        for index in range(home, home + self.probe):
+            _, used, _, _, _, _, expire_at = SLOT_HEADER.unpack_from(mm, self._offset(index))
+            if not used or (expire_at and expire_at <= now):
+                return index, False
+        # CLOCK：跳过并清除引用位，淘汰第一个没有引用位的槽位
+        for _ in range(2):
+            for index in range(home, home + self.probe):
+                offset = self._offset(index)
+                if mm[offset + REF_OFFSET]:
+                    mm[offset + REF_OFFSET] = 0
+                else:
+                    self.evictions += 1
+                    return index, False
+        return home, False
+
+    def set(self, key: bytes, value: bytes, ttl: float = None) -> bool:
+        """ 写入一个值。键和值的总长度超过 ``payload_size`` 时不写入，返回 False。
+
+        :param ttl: 过期秒数，None 或 0 代表永不过期。
+        """
+        if len(key) + len(value) > self.payload_size:
+            # 旧值不再有效，需要删除
+            self.delete(key)
+            return False
+        h = key_hash(key)
+        home = self._home(h)
+        with self.__thread_lock:
+            self.__lock(self._offset(home), self.probe * self.slot_size)
+            try:
+                index, _ = self._find_for_write(home, key, h)
+                self._write_slot(index, key, h, value, ttl)
+            finally:
+                self.__unlock(self._offset(home), self.probe * self.slot_size)
+        return True
+
+    def delete(self, key: bytes) -> bool:
+        """ 删除一个值，返回该键是否存在。"""
+        h = key_hash(key)
+        home = self._home(h)
+        with self.__thread_lock:
+            self.__lock(self._offset(home), self.probe * self.slot_size)
+            try:
+                index = self._find(home, key, h)
+                if index is not None:
+                    self._write_slot(index)
+                return index is not None
+            finally:
+                self.__unlock(self._offset(home), self.probe * self.slot_size)
+
+    def delete_prefix(self, prefix: bytes) -> int:
+        """ 删除所有以 prefix 开头的键，需要扫描所有槽位，返回删除的数量。"""
+        mm = self.__mm
+        count = 0
+        with self.__thread_lock:
+            self.__lock(HEADER_SIZE, self.slots * self.slot_size)
+            try:
+                for index in range(self.slots):
+                    offset = self._offset(index)
+                    _, used, _, key_len, _, _, _ = SLOT_HEADER.unpack_from(mm, offset)
+                    if not used or key_len < len(prefix):
+                        continue
+                    start = offset + SLOT_HEADER_SIZE
+                    if mm[start:start + len(prefix)] == prefix:
+                        self._write_slot(index)
+                        count += 1
+            finally:
+                self.__unlock(HEADER_SIZE, self.slots * self.slot_size)
+        return count
+
+    def clear(self) -> None:
+        """ 清空所有槽位。"""
+        with self.__thread_lock:
+            self.__lock(HEADER_SIZE, self.slots * self.slot_size)
+            try:
+                for index in range(self.slots):
+                    if self.__mm[self._offset(index) + 4]:
+                        self._write_slot(index)
+            finally:
+                self.__unlock(HEADER_SIZE, self.slots * self.slot_size)
+
+    def close(self) -> None:
+        self.__mm.close()
+        os.close(self.__fd)
+
+    def __str__(self) -> str:
+        return f'{self.__class__.__name__} {self.fpath.as_posix()} slots: {self.slots} slot_size: {self.slot_size}'
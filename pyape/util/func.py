@@ -9,8 +9,10 @@ pyape.util.func
 
 from typing import Union
 from datetime import datetime, timedelta, date, time as time2
+import os
 import re
 import json
+import weakref
 
 
 _simple_class = [int, float, str, bool, dict, list, datetime]
@@ -229,3 +231,18 @@ def vername2code(vername) -> int:
     except Exception as e:
         return -1
 
+
+def register_after_fork(obj, method_name: str) -> None:
+    """ 在 fork 出的子进程中调用 obj 的方法，用于丢弃从父进程继承的连接。
+    仅保存 obj 的弱引用，obj 被回收后不再调用。
+    """
+    if not hasattr(os, 'register_at_fork'):
+        return
+    ref = weakref.ref(obj)
+
+    def after_in_child():
+        target = ref()
+        if target is not None:
+            getattr(target, method_name)()
+
+    os.register_at_fork(after_in_child=after_in_child)
@@ -25,9 +25,10 @@ def cache_get(key):
     return None
 
 
-def cache_set(key, value):
+def cache_set(key, value, expires=0):
+    """ :param expires: 过期秒数，0 代表永不过期。"""
     if in_uwsgi:
-        return uwsgi.cache_set(key, value)
+        return uwsgi.cache_set(key, value, expires)
     return None
 
 
@@ -37,15 +38,29 @@ def cache_del(key):
     return None
 
 
+def cache_keys():
+    """ 返回所有的键名，uwsgi 版本不支持时返回 None。"""
+    if in_uwsgi and hasattr(uwsgi, 'cache_keys'):
+        return uwsgi.cache_keys()
+    return None
+
+
+def cache_clear():
+    if in_uwsgi:
+        return uwsgi.cache_clear()
+    return None
+
+
 def cache_exists(key):
     if in_uwsgi:
         return uwsgi.cache_exists(key)
     return None
 
 
-def cache_update(key, value):
+def cache_update(key, value, expires=0):
+    """ :param expires: 过期秒数，0 代表永不过期。"""
     if in_uwsgi:
-        return uwsgi.cache_update(key, value)
+        return uwsgi.cache_update(key, value, expires)
     return None
 
 
@@ -58,6 +73,25 @@ def mule_msg(msg, mule_id=1):
     return None
 
 
+def register_atexit(func):
+    """ 在 uwsgi worker 退出时调用 func，保留之前设置的 uwsgi.atexit。
+    不在 uwsgi 中时返回 False，此时应使用 Python 的 atexit 模块。
+    """
+    if not in_uwsgi:
+        return False
+    previous = getattr(uwsgi, 'atexit', None)
+
+    def chained():
+        try:
+            func()
+        finally:
+            if previous is not None:
+                previous()
+
+    uwsgi.atexit = chained
+    return True
+
+
 def worker_id():
     if in_uwsgi:
         return uwsgi.worker_id()
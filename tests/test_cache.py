@@ -0,0 +1,364 @@
+import json
+import time
+from pathlib import Path
+
+import pytest
+
+from pyape.cache import FileCache, GlobalCache
+
+
+@pytest.fixture(params=['.toml', '.json', '.pickle'])
+def cache_file(tmp_path: Path, request) -> Path:
+    return tmp_path.joinpath(f'cache{request.param}')
+
+
+def test_file_cache_set_get(cache_file: Path):
+    gcache = GlobalCache.from_config('file', fpath=cache_file)
+    gcache.setg('a', {'b': 1}, r=1)
+    assert gcache.getg('a', r=1) == {'b': 1}
+    assert gcache.getg('a', r=2) is None
+
+
+def test_file_cache_reload_on_change(cache_file: Path):
+    # 模拟两个 worker 使用同一个缓存文件
+    fc1 = FileCache(cache_file)
+    fc2 = FileCache(cache_file)
+    fc1['a'] = 1
+    assert fc2['a'] == 1
+    fc2['b'] = 2
+    assert fc1['a'] == 1 and fc1['b'] == 2
+
+
+def test_file_cache_atomic_write(cache_file: Path):
+    fc = FileCache(cache_file)
+    for i in range(10):
+        fc[f'k{i}'] = i
+    # 写入使用临时文件 + rename，不应残留临时文件
+    names = sorted(p.name for p in cache_file.parent.iterdir())
+    assert names == sorted([cache_file.name, f'{cache_file.name}.lock'])
+    assert FileCache(cache_file)['k9'] == 9
+
+
+def test_file_cache_keeps_mode(cache_file: Path):
+    import os
+    from pyape.cache import DEFAULT_FILE_MODE
+    fc = FileCache(cache_file)
+    fc['a'] = 1
+    assert cache_file.stat().st_mode & 0o777 == DEFAULT_FILE_MODE
+    os.chmod(cache_file, 0o640)
+    fc['b'] = 2
+    assert cache_file.stat().st_mode & 0o777 == 0o640
+
+
+def test_local_cache_lru_and_ttl(monkeypatch):
+    from pyape.cache import LocalCache
+    lc = LocalCache(maxsize=2, ttl=10)
+    lc.set('a', 1)
+    lc.set('b', 2)
+    assert lc.get('a') == 1
+    # b 是最久未使用的键，会被淘汰
+    lc.set('c', 3)
+    assert lc.get('b') is None
+    assert lc.get('c') == 3
+    stats = lc.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 1 and stats['evictions'] == 1
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert lc.get('a') is None
+
+
+def test_global_cache_local_invalidate():
+    gcache = GlobalCache.from_config('dict', local={'maxsize': 10, 'ttl': 0})
+    gcache.setg('a', 1)
+    assert gcache.getg('a') == 1
+    assert gcache.getg('a') == 1
+    assert gcache.local_stats()['hits'] == 1
+    # 模拟其他 worker 直接修改二级缓存后发出的失效消息
+    gcache.cache[gcache.keyname(0, 'a')] = 2
+    gcache._handle_invalidate({'data': json.dumps({'s': 'other', 'k': ['0_a']})})
+    assert gcache.getg('a') == 2
+    gcache.delg('a')
+    assert gcache.getg('a') is None
+
+
+def test_local_cache_respects_ttl(cache_file: Path, monkeypatch):
+    # 两个 worker 使用同一个缓存文件，一级缓存的保存时间不能超过键的剩余过期时间
+    writer = GlobalCache.from_config('file', fpath=cache_file, local={'maxsize': 10, 'ttl': 60})
+    reader = GlobalCache.from_config('file', fpath=cache_file, local={'maxsize': 10, 'ttl': 60})
+    writer.setg('a', 1, ttl=10)
+    writer.setg('b', 2)
+    for gcache in (writer, reader):
+        assert gcache.getg('a') == 1 and gcache.getg('b') == 2
+        assert gcache.mgetg(['a', 'b']) == {'a': 1, 'b': 2}
+        assert gcache.local_stats()['size'] == 2
+
+    now, mnow = time.time(), time.monotonic()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    monkeypatch.setattr(time, 'monotonic', lambda: mnow + 11)
+    for gcache in (writer, reader):
+        assert gcache.getg('a') is None
+        assert gcache.mgetg(['a', 'b']) == {'a': None, 'b': 2}
+
+
+def test_dict_cache_ttl(monkeypatch):
+    gcache = GlobalCache.from_config('dict')
+    gcache.setg('a', 1, ttl=10)
+    gcache.msetg({'b': 2, 'c': 3}, ttl=10)
+    gcache.setg('d', 4)
+    assert gcache.getg('a') == 1 and gcache.getg('b') == 2
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert gcache.getg('a') is None
+    assert gcache.cache.sweep(force=True) == 2
+    assert gcache.getg('d') == 4
+
+
+def test_file_cache_ttl(cache_file: Path, monkeypatch):
+    gcache = GlobalCache.from_config('file', fpath=cache_file)
+    gcache.setg('a', 1, ttl=10)
+    gcache.setg('b', 2)
+    assert gcache.getg('a') == 1
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert gcache.getg('a') is None
+    # 写入时清理过期的键
+    gcache.setg('c', 3)
+    c = gcache.cache.get_cache()
+    assert '0_a' not in c and '@expires' not in c
+    assert gcache.getg('b') == 2
+
+
+def test_mgetg(cache_file: Path):
+    for gcache in (
+        GlobalCache.from_config('dict'),
+        GlobalCache.from_config('file', fpath=cache_file),
+        GlobalCache.from_config('dict', local={'maxsize': 10}),
+    ):
+        gcache.msetg({'a': 1, 'b': 2}, r=1)
+        assert gcache.mgetg(['a', 'b', 'c'], r=1) == {'a': 1, 'b': 2, 'c': None}
+        # 第二次读取命中一级缓存
+        assert gcache.mgetg(['a', 'c'], r=1) == {'a': 1, 'c': None}
+
+
+@pytest.mark.parametrize('codec', ['pickle', 'json'])
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_value_serializer(codec, compression):
+    from pyape.cache import ValueSerializer
+    vs = ValueSerializer(codec, compression=compression, threshold=64)
+    small = {'a': 1}
+    large = {'items': [{'name': f'item{i}', 'value': i} for i in range(100)]}
+    for value in (small, large):
+        raw = vs.dumps(value)
+        assert vs.loads(raw) == value
+    if compression:
+        assert len(vs.dumps(large)) < len(ValueSerializer(codec).dumps(large))
+
+
+def test_value_serializer_mixed_formats():
+    import pickle
+    from pyape.cache import ValueSerializer
+    value = {'a': [1, 2, 3]}
+    vs = ValueSerializer('json', compression='zlib', threshold=0)
+    # 可以读取旧的 pickle 值，以及其他配置写入的值
+    assert vs.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) == value
+    assert vs.loads(ValueSerializer('pickle').dumps(value)) == value
+    assert ValueSerializer('pickle').loads(vs.dumps(value)) == value
+
+
+def test_codec_is_abstract():
+    from pyape.cache import Codec
+
+    class HalfCodec(Codec):
+        def dumps(self, value):
+            return b''
+
+    # 没有实现全部方法的编解码器不能实例化
+    with pytest.raises(TypeError):
+        HalfCodec()
+
+
+def test_cache_is_abstract():
+    from pyape.cache import Cache
+
+    class NoDeleteCache(Cache):
+        def __getitem__(self, name):
+            return None
+
+        def set(self, name, value, ttl=None):
+            pass
+
+    # 未实现 delete/delete_prefix 的后端在创建时报错，而不是在第一次删除时
+    with pytest.raises(TypeError):
+        NoDeleteCache('test')
+
+
+def test_shm_cache(tmp_path: Path):
+    fpath = tmp_path.joinpath('cache.shm')
+    gcache = GlobalCache.from_config('shm', fpath=fpath, shm={'slots': 64, 'slot_size': 128})
+    # 模拟另一个 worker 打开同一个文件
+    other = GlobalCache.from_config('shm', fpath=fpath, shm={'slots': 64, 'slot_size': 128})
+    gcache.setg('a', {'b': 1})
+    assert other.getg('a') == {'b': 1}
+    other.setg('a', [1, 2])
+    assert gcache.getg('a') == [1, 2]
+    other.delg('a')
+    assert gcache.getg('a') is None
+    # 超出槽位大小的值不会被缓存
+    with pytest.warns(UserWarning):
+        gcache.setg('large', 'x' * 200)
+    assert gcache.getg('large') is None
+
+
+def test_shared_hash_table_eviction(tmp_path: Path, monkeypatch):
+    from pyape.shm import SharedHashTable
+    table = SharedHashTable(tmp_path.joinpath('t.shm'), slots=8, slot_size=64, probe=8)
+    for i in range(20):
+        assert table.set(f'k{i}'.encode(), str(i).encode())
+    found = [i for i in range(20) if table.get(f'k{i}'.encode()) is not None]
+    assert len(found) == 8 and table.evictions == 12
+    assert table.get(b'k19') == b'19'
+
+    table.set(b'ttl', b'1', ttl=10)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert table.get(b'ttl') is None
+
+
+def test_shared_hash_table_delete_and_mismatch(tmp_path: Path):
+    from pyape.shm import SharedHashTable
+    fpath = tmp_path.joinpath('t.shm')
+    table = SharedHashTable(fpath, slots=8, slot_size=64, probe=8)
+    for i in range(8):
+        table.set(f'k{i}'.encode(), str(i).encode())
+    # 窗口已满时删除不存在的键不会淘汰其他键
+    assert not table.delete(b'missing')
+    assert table.evictions == 0
+    assert all(table.get(f'k{i}'.encode()) == str(i).encode() for i in range(8))
+    assert table.delete(b'k0') and table.get(b'k0') is None
+
+    # 配置不同时不能截断其他 worker 正在使用的文件
+    with pytest.raises(ValueError):
+        SharedHashTable(fpath, slots=16, slot_size=64, probe=8)
+    assert table.get(b'k1') == b'1'
+    assert SharedHashTable(fpath, slots=8, slot_size=64, probe=8).get(b'k1') == b'1'
+
+
+def test_get_or_set_single_flight():
+    import threading
+    gcache = GlobalCache.from_config('dict')
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'v'
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(gcache.get_or_set('a', loader)))
+        for _ in range(10)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ['v'] * 10 and len(calls) == 1
+    assert gcache.get_or_set('none', lambda: None) is None
+
+
+def test_file_key_lock_threads(tmp_path: Path):
+    import threading
+    from pyape.cache import FileKeyLock
+    lock = FileKeyLock(tmp_path.joinpath('cache.klock'))
+    token = lock.acquire('a')
+    assert token is not None
+    # fcntl 锁属于进程，同一进程的其他线程也不能获取
+    results = []
+    thread = threading.Thread(target=lambda: results.append(lock.acquire('a')))
+    thread.start()
+    thread.join()
+    assert results == [None]
+    lock.release(token)
+    token = lock.acquire('a')
+    assert token is not None
+    lock.release(token)
+
+
+def test_get_or_set_early_refresh(monkeypatch):
+    gcache = GlobalCache.from_config('dict')
+    values = iter(['v1', 'v2'])
+    loader = lambda: next(values)
+    assert gcache.get_or_set('a', loader, ttl=100, early_refresh=1) == 'v1'
+    assert gcache.get_or_set('a', loader, ttl=100, early_refresh=1) == 'v1'
+    # 接近过期时由当前调用者提前刷新
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 100)
+    assert gcache.get_or_set('a', loader, ttl=100, early_refresh=1) == 'v2'
+
+
+def test_delete_and_clear_regional(tmp_path: Path):
+    for gcache in (
+        GlobalCache.from_config('dict', local={}),
+        GlobalCache.from_config('file', fpath=tmp_path.joinpath('cache.json')),
+        GlobalCache.from_config('shm', fpath=tmp_path.joinpath('cache.shm')),
+    ):
+        gcache.msetg({'a': 1, 'b': 2, 'vo_c': 3, 'vo_d': 4}, r=1)
+        gcache.msetg({'a': 1}, r=11)
+        gcache.delg('a', r=1)
+        assert gcache.getg('a', r=1) is None
+        assert gcache.clear_prefix('vo_', r=1) == 2
+        assert gcache.mgetg(['b', 'vo_c'], r=1) == {'b': 2, 'vo_c': None}
+        assert gcache.clear_regional(1) == 1
+        assert gcache.getg('b', r=1) is None
+        # r=11 的键不受 r=1 的影响
+        assert gcache.getg('a', r=11) == 1
+
+
+def test_cache_stats(tmp_path: Path):
+    stats_cfg = {'dir': tmp_path.joinpath('stats'), 'flush_interval': 0}
+    gcache = GlobalCache.from_config('shm', fpath=tmp_path.joinpath('cache.shm'), stats=stats_cfg)
+    gcache.setg('a', 'value', r=1)
+    gcache.getg('a', r=1)
+    gcache.getg('b', r=1)
+    gcache.mgetg(['a', 'b'], r=2)
+    gcache.delg('a', r=1)
+    s = gcache.stats()
+    r1 = s['regionals']['1']
+    assert (r1['hits'], r1['misses'], r1['sets'], r1['deletes']) == (1, 1, 1, 1)
+    assert r1['bytes_written'] > 0 and r1['bytes_read'] == r1['bytes_written']
+    assert s['regionals']['2']['misses'] == 2
+    assert s['latency']['get']['count'] == 2
+    # 另一个 worker 的快照参与汇总
+    other = dict(s, worker='other:1')
+    gcache.cache_stats.store.save('other:1', other)
+    agg = gcache.stats(aggregate=True)
+    assert agg['regionals']['1']['hits'] == 2
+    assert agg['regionals']['1']['hit_ratio'] == 0.5
+    assert ('1_a', 2) in agg['hot_keys']
+
+    # 超过 stale 秒没有更新的快照被删除，退出时删除自己的快照
+    stats_dir = tmp_path.joinpath('stats')
+    gcache.cache_stats.store.save('dead:2', dict(other, worker='dead:2', updated=time.time() - 1000))
+    assert 'dead:2' not in gcache.stats(aggregate=True)['workers']
+    assert sorted(p.name for p in stats_dir.iterdir()) == sorted(['other:1.json', f'{gcache.cache_stats.worker}.json'])
+    gcache.cache_stats.close()
+    assert [p.name for p in stats_dir.iterdir()] == ['other:1.json']
+
+
+def test_cache_stats_background_flush(tmp_path: Path, cache_file: Path):
+    stats_dir = tmp_path.joinpath('stats')
+    gcache = GlobalCache.from_config('file', fpath=cache_file, stats={'dir': stats_dir, 'flush_interval': 0.05})
+    gcache.setg('a', 'value')
+    # 其他 worker 修改文件后重新载入，计入读取的字节数
+    FileCache(cache_file)['0_b'] = 1
+    assert gcache.getg('b') == 1
+    assert gcache.stats()['regionals']['0']['bytes_read'] > 0
+    deadline = time.time() + 5
+    while not any(stats_dir.glob('*.json')) and time.time() < deadline:
+        time.sleep(0.01)
+    assert [p.name for p in stats_dir.glob('*.json')] == [f'{gcache.cache_stats.worker}.json']
+    gcache.cache_stats.close()
+    assert not any(stats_dir.iterdir())
@@ -1,4 +1,5 @@
-from sqlalchemy import inspect, Integer, Column, select, insert
+import pytest
+from sqlalchemy import inspect, Integer, Column, select, insert, func, text
 from sqlalchemy.orm import Session
 from pyape.config import GlobalConfig
 from pyape.db import DBManager, SQLAlchemy
@@ -20,3 +21,471 @@ def test_build_db(global_config: GlobalConfig):
     
     print(s.get(A, 3).id)
     print(s.scalars(select(A).order_by(A.id.desc())).first().id)
+
+
+def test_replica_routing(tmp_path):
+    URI = {
+        'main': {
+            'primary': f'sqlite:///{tmp_path.as_posix()}/primary.sqlite',
+            'replicas': [f'sqlite:///{tmp_path.as_posix()}/replica.sqlite'],
+        }
+    }
+    sql = SQLAlchemy(URI=URI, is_scoped=False)
+
+    class B(sql.Model('main')):
+        __tablename__ = 'b'
+        id = Column(Integer, primary_key=True)
+
+    sql.create_all()
+    replica_set = sql.dbm.get_replica_set('main')
+    replica = replica_set.replicas[0]
+    B.metadata.create_all(replica)
+    with replica.begin() as conn:
+        conn.execute(insert(B.__table__).values(id=2))
+
+    s = sql.session()
+    # 只读查询使用副本
+    assert s.scalars(select(B.id)).all() == [2]
+    s.add(B(id=1))
+    s.commit()
+    # 提交之后读取自己的写入
+    assert s.scalars(select(B.id)).all() == [1]
+    s.close()
+    assert sql.session().scalars(select(B.id)).all() == [2]
+
+    # 文本 SQL 在主库执行，之后的读取也使用主库
+    s = sql.session()
+    s.execute(text('UPDATE b SET id = 3 WHERE id = 1'), bind_arguments={'mapper': B})
+    assert s.scalars(select(B.id)).all() == [3]
+    s.commit()
+    s.close()
+
+    # 副本不可用时使用主库
+    replica_set.mark_down(replica)
+    assert sql.session().scalars(select(B.id)).all() == [3]
+
+
+def test_cached_total_key_ignores_replicas(tmp_path):
+    from pyape.cache import GlobalCache
+    from pyape.db import CachedTotal
+
+    URI = {
+        'main': {
+            'primary': f'sqlite:///{tmp_path.as_posix()}/primary.sqlite',
+            'replicas': [f'sqlite:///{tmp_path.as_posix()}/replica{i}.sqlite' for i in range(2)],
+        }
+    }
+    sql = SQLAlchemy(URI=URI, is_scoped=False)
+
+    class B(sql.Model('main')):
+        __tablename__ = 'b'
+        id = Column(Integer, primary_key=True)
+
+    cached = CachedTotal(GlobalCache.from_config('dict'))
+    s = sql.session()
+    qry = s.query(B)
+    # 键名使用主库地址，与选择的副本无关，也不推进副本的轮询
+    first = s.get_bind(clause=qry.statement)
+    keys = {cached.keyname(qry) for _ in range(3)}
+    assert len(keys) == 1
+    assert s.get_bind(clause=qry.statement) is not first
+
+
+def test_bulk_insert_and_upsert(tmp_path):
+    sql = SQLAlchemy(URI={'main': f'sqlite:///{tmp_path.as_posix()}/bulk.sqlite'}, is_scoped=False)
+
+    class C(sql.Model('main')):
+        __tablename__ = 'c'
+        id = Column(Integer, primary_key=True)
+        value = Column(Integer)
+
+    sql.create_all()
+    report = sql.bulk_insert(C, ({'id': i, 'value': i} for i in range(2500)), chunk_size=1000)
+    assert report['rows'] == 2500 and report['rows_per_second'] > 0
+    report = sql.bulk_upsert(C, [{'id': i, 'value': -i} for i in range(2400, 2600)], ['id'])
+    assert report['rows'] == 200
+    s = sql.session()
+    assert s.scalar(select(C.value).where(C.id == 2450)) == -2450
+    assert s.scalar(select(C.value).where(C.id == 2300)) == 2300
+    assert len(s.scalars(select(C.id)).all()) == 2600
+
+
+def test_upsert_stmt_do_nothing():
+    from sqlalchemy.dialects import mysql
+
+    sql = SQLAlchemy(URI='sqlite://', is_scoped=False)
+
+    class E(sql.Model()):
+        __tablename__ = 'e'
+        id = Column(Integer, primary_key=True)
+        value = Column(Integer, nullable=False)
+
+    # 只忽略重复键，不能使用会忽略所有错误的 INSERT IGNORE
+    stmt = str(SQLAlchemy._upsert_stmt('mysql', E.__table__, ['id'], []).compile(dialect=mysql.dialect()))
+    assert 'IGNORE' not in stmt and stmt.endswith('ON DUPLICATE KEY UPDATE id = e.id')
+
+
+def test_stream(tmp_path):
+    import io
+
+    sql = SQLAlchemy(URI={'main': f'sqlite:///{tmp_path.as_posix()}/stream.sqlite'}, is_scoped=False)
+
+    class D(sql.Model('main')):
+        __tablename__ = 'd'
+        id = Column(Integer, primary_key=True)
+        value = Column(Integer)
+
+    sql.create_all()
+    sql.bulk_insert(D, ({'id': i, 'value': i * 2} for i in range(250)))
+    partitions = list(sql.stream(select(D).order_by(D.id), 100, partitions=True, scalars=True))
+    assert [len(p) for p in partitions] == [100, 100, 50]
+    assert partitions[-1][-1].value == 498
+    assert sum(1 for _ in sql.stream(select(D.id, D.value), 100, bind_key='main')) == 250
+
+    buf = io.StringIO()
+    assert sql.export_csv(select(D.id, D.value).order_by(D.id), buf, 100) == 250
+    lines = buf.getvalue().splitlines()
+    assert lines[0] == 'id,value' and lines[2] == '1,2' and len(lines) == 251
+
+
+def test_sqlite_profile(tmp_path):
+    URI = f'sqlite:///{tmp_path.as_posix()}/profile.sqlite'
+    sql = SQLAlchemy(URI=URI, ENGINE_OPTIONS={'sqlite': {'synchronous': 'OFF'}}, is_scoped=False)
+    engine = sql.engine()
+    assert engine.pool.__class__.__name__ == 'QueuePool'
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.exec_driver_sql('PRAGMA synchronous').scalar() == 0
+        assert conn.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+    # 不提供 sqlite 配置时保持原来的行为
+    sql = SQLAlchemy(URI=URI, is_scoped=False)
+    assert sql.engine().pool.__class__.__name__ == 'NullPool'
+
+
+def test_sql_instrument(tmp_path, caplog):
+    URI = f'sqlite:///{tmp_path.as_posix()}/instrument.sqlite'
+    sql = SQLAlchemy(
+        URI=URI, INSTRUMENT={'slow_threshold': 0, 'n_plus_one': 3, 'explain': True}, is_scoped=False
+    )
+
+    class F(sql.Model()):
+        __tablename__ = 'f'
+        id = Column(Integer, primary_key=True)
+
+    sql.create_all()
+    sql.bulk_insert(F, [{'id': i} for i in range(5)])
+    instrument = sql.dbm.instrument
+    stats = instrument.start()
+    s = sql.session()
+    with caplog.at_level('WARNING', logger='pyape.sql'):
+        for i in range(4):
+            s.get(F, i)
+    assert instrument.finish() is stats
+    assert stats.count == 4 and stats.seconds > 0 and len(stats.slowest) == 4
+    assert len(stats.shapes) == 1
+    messages = [r.getMessage() for r in caplog.records]
+    assert sum('N+1' in m for m in messages) == 1
+    assert any('Slow query' in m and 'plan:' in m and '(int)' in m for m in messages)
+    # 未开始统计时不记录
+    s.get(F, 5)
+    assert instrument.current is None
+
+
+def test_lazy_engine_and_after_fork(tmp_path):
+    URI = {
+        'a': f'sqlite:///{tmp_path.as_posix()}/a.sqlite',
+        'b': f'sqlite:///{tmp_path.as_posix()}/b.sqlite',
+    }
+    sql = SQLAlchemy(URI=URI, ENGINE_OPTIONS={'sqlite': {}})
+
+    class G(sql.Model('b')):
+        __tablename__ = 'g'
+        id = Column(Integer, primary_key=True)
+
+    # 未使用的 bind 不创建 engine
+    assert sql.dbm._DBManager__engines == {}
+    sql.create_tables(bind_key='b')
+    s = sql.session()
+    s.add(G(id=1))
+    s.commit()
+    assert list(sql.dbm._DBManager__engines) == ['b']
+    assert sql.engine('b').pool.checkedin() == 1
+
+    old_session = sql.Session
+    sql.dbm.after_fork()
+    sql.after_fork()
+    assert sql.Session is not old_session
+    assert sql.engine('b').pool.checkedin() == 0
+    assert sql.session().scalars(select(G.id)).all() == [1]
+
+
+def test_async_session(tmp_path):
+    import asyncio
+    pytest.importorskip('aiosqlite')
+    from pyape.asyncdb import AsyncSQLAlchemy
+
+    sql = SQLAlchemy(URI={
+        'a': f'sqlite:///{(tmp_path / "a.sqlite").as_posix()}',
+        'b': f'sqlite:///{(tmp_path / "b.sqlite").as_posix()}',
+    })
+    asql = AsyncSQLAlchemy(sql)
+
+    class A(sql.Model('a')):
+        __tablename__ = 'a'
+        id = Column(Integer, primary_key=True)
+
+    class B(sql.Model('b')):
+        __tablename__ = 'b'
+        id = Column(Integer, primary_key=True)
+
+    async def task(i):
+        s = asql.async_session()
+        # 同一个 task 中得到同一个 Session
+        assert s is asql.async_session()
+        s.add_all([A(id=i), B(id=i * 10)])
+        await s.commit()
+        await asql.remove()
+        return s
+
+    async def main():
+        await asql.create_all()
+        sessions = await asyncio.gather(*(task(i) for i in range(1, 4)))
+        assert len(set(map(id, sessions))) == 3
+        s = asql.async_session()
+        assert (await s.scalars(select(A.id).order_by(A.id))).all() == [1, 2, 3]
+        assert (await s.scalars(select(B.id).order_by(B.id))).all() == [10, 20, 30]
+        await asql.remove()
+        await asql.dispose()
+
+    asyncio.run(main())
+    # 数据写入了各自的数据库，同步 Session 可以读到
+    assert sql.session().scalar(select(B.id).where(B.id == 20)) == 20
+    assert asql.engine('a').url.drivername == 'sqlite+aiosqlite'
+
+
+def test_regional_shards_fan_out(tmp_path):
+    import threading
+    from pyape.db import RegionalShards
+
+    URI = {
+        'a': f'sqlite:///{tmp_path.as_posix()}/a.sqlite',
+        'b': f'sqlite:///{tmp_path.as_posix()}/b.sqlite',
+    }
+    sql = SQLAlchemy(URI=URI)
+    tables = {}
+    for r, bind_key in ((1001, 'a'), (1002, 'a'), (2001, 'b')):
+        tables[r] = type(f'score{r}', (sql.Model(bind_key),), dict(
+            __tablename__=f'score{r}',
+            id=Column(Integer, primary_key=True),
+            score=Column(Integer, nullable=False),
+        ))
+    sql.create_all()
+    s = sql.session()
+    for r, Cls in tables.items():
+        s.add_all(Cls(id=i, score=r + i) for i in range(5))
+    s.commit()
+
+    shards = RegionalShards(sql, tables)
+    assert shards.table(2001) is tables[2001] and shards.bind_key(2001) == 'b'
+
+    # 两个数据库同时查询才能通过 barrier
+    barrier = threading.Barrier(2, timeout=5)
+
+    def top_scores(Cls, r):
+        if r in (1001, 2001):
+            barrier.wait()
+        return select(Cls.score).order_by(Cls.score.desc()).limit(2)
+
+    rows = shards.fan_out(top_scores, key=lambda row: row.score, reverse=True, limit=3)
+    assert [row.score for row in rows] == [2005, 2004, 1006]
+    objs = shards.fan_out(lambda Cls, r: select(Cls).where(Cls.id == 0), rs=[1001, 1002], scalars=True)
+    assert sorted(obj.score for obj in objs) == [1001, 1002]
+    with pytest.raises(ValueError):
+        shards.table(3001)
+
+
+def test_pool_warmup_and_stats(tmp_path):
+    URI = {
+        'a': f'sqlite:///{tmp_path.as_posix()}/a.sqlite',
+        'b': f'sqlite:///{tmp_path.as_posix()}/b.sqlite',
+    }
+    # 与 bind_key 同名的参数只用于这个数据库
+    sql = SQLAlchemy(URI=URI, ENGINE_OPTIONS={
+        'sqlite': {},
+        'pool_pre_ping': True,
+        'a': {'warmup': 3, 'pool_size': 2},
+    })
+    assert sql.dbm.engine_options('a') == {'sqlite': {}, 'pool_pre_ping': True, 'warmup': 3, 'pool_size': 2}
+    assert sql.dbm.engine_options('b') == {'sqlite': {}, 'pool_pre_ping': True}
+
+    # warmup 不超过 pool_size，没有配置 warmup 的数据库不预热
+    assert sql.dbm.warmup() == {'a': 2}
+    assert list(sql.dbm.pool_stats()) == ['a']
+    stats = sql.dbm.pool_stats()['a']
+    assert (stats['pool'], stats['size'], stats['checked_in'], stats['checked_out']) == ('QueuePool', 2, 2, 0)
+    assert stats['connects'] == 2 and stats['checkouts'] == 2
+
+    with sql.engine('a').connect() as conn:
+        conn.exec_driver_sql('select 1')
+        stats = sql.dbm.pool_stats()['a']
+        assert stats['checked_out'] == 1 and stats['connects'] == 2
+        conn.invalidate()
+    stats = sql.dbm.pool_stats()['a']
+    assert stats['invalidations'] == 1 and stats['checked_out'] == 0
+    assert stats['wait_max_ms'] >= stats['wait_avg_ms'] > 0
+    assert sql.dbm.warmup(1, ['b']) == {'b': 1}
+
+
+def test_create_all_fingerprint(tmp_path):
+    from sqlalchemy import event
+    from pyape.db import schema_fingerprint
+
+    URI = {
+        'a': f'sqlite:///{tmp_path.as_posix()}/a.sqlite',
+        'b': f'sqlite:///{tmp_path.as_posix()}/b.sqlite',
+    }
+    sql = SQLAlchemy(URI=URI)
+
+    class H(sql.Model('a')):
+        __tablename__ = 'h'
+        id = Column(Integer, primary_key=True)
+
+    class I(sql.Model('b')):
+        __tablename__ = 'i'
+        id = Column(Integer, primary_key=True)
+
+    assert sql.create_all() == {'a': True, 'b': True}
+    statements = []
+    event.listen(sql.engine('a'), 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    # 未变化时只读取哈希值，不检查表
+    assert sql.create_all() == {'a': False, 'b': False}
+    assert len(statements) == 1 and 'pyape_schema' in statements[0]
+
+    # metadata 变化后重新创建
+    before = schema_fingerprint(sql.metadata('b'), sql.engine('b').dialect)
+
+    class J(sql.Model('b')):
+        __tablename__ = 'j'
+        id = Column(Integer, primary_key=True)
+
+    assert schema_fingerprint(sql.metadata('b'), sql.engine('b').dialect) != before
+    assert sql.create_all() == {'a': False, 'b': True}
+    assert inspect(sql.engine('b')).has_table('j')
+
+    # 删除表之后哈希值失效
+    sql.drop_tables(['h'], bind_key='a')
+    assert sql.create_all() == {'a': True, 'b': False}
+    assert inspect(sql.engine('a')).has_table('h')
+    assert sql.create_all(fingerprint=False) == {'a': True, 'b': True}
+
+
+def test_create_all_fingerprint_shared_database(tmp_path):
+    # 两个 bind_key 使用同一个数据库，各自保存哈希值
+    uri = f'sqlite:///{tmp_path.as_posix()}/shared.sqlite'
+    sql = SQLAlchemy(URI={'a': uri, 'b': uri})
+
+    class H(sql.Model('a')):
+        __tablename__ = 'h'
+        id = Column(Integer, primary_key=True)
+
+    class I(sql.Model('b')):
+        __tablename__ = 'i'
+        id = Column(Integer, primary_key=True)
+
+    assert sql.create_all() == {'a': True, 'b': True}
+    assert sql.create_all() == {'a': False, 'b': False}
+    with sql.engine('a').connect() as conn:
+        assert conn.execute(text('SELECT bind_key FROM pyape_schema ORDER BY bind_key')).scalars().all() == ['a', 'b']
+    sql.drop_tables(['h'], bind_key='a')
+    assert sql.create_all() == {'a': True, 'b': False}
+
+    # 旧版本以 id 为主键的哈希值表会被重建
+    with sql.engine('a').begin() as conn:
+        conn.execute(text('DROP TABLE pyape_schema'))
+        conn.execute(text('CREATE TABLE pyape_schema (id INTEGER PRIMARY KEY, fingerprint VARCHAR(64), updatetime INTEGER)'))
+    assert sql.create_all() == {'a': True, 'b': True}
+    assert sql.create_all() == {'a': False, 'b': False}
+
+
+def test_write_buffer(tmp_path):
+    import time
+    import threading
+    from sqlalchemy import event
+
+    sql = SQLAlchemy(
+        URI=f'sqlite:///{tmp_path.as_posix()}/log.sqlite',
+        WRITE_BUFFER={'max_rows': 10, 'interval': 0.05, 'max_queue': 20, 'block_timeout': 0.01},
+    )
+
+    class Log(sql.Model()):
+        __tablename__ = 'log'
+        id = Column(Integer, primary_key=True)
+        action = Column(Integer, nullable=False)
+
+    sql.create_all()
+    inserts = []
+    event.listen(
+        sql.engine(), 'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statement.startswith('INSERT') and inserts.append(statement),
+    )
+    count = lambda: sql.session().scalar(select(func.count()).select_from(Log))
+
+    # 攒够 max_rows 立即写入，一次多行 INSERT
+    for i in range(10):
+        assert sql.buffered_insert(Log, {'action': i})
+    assert sql.write_buffer.flush(5)
+    assert count() == 10 and len(inserts) == 1
+
+    # 不足 max_rows 时 interval 之后写入
+    sql.buffered_insert(Log, {'action': 100})
+    sql.buffered_insert(Log.__table__, {'id': 1000, 'action': 101})
+    deadline = time.time() + 5
+    while sql.write_buffer.stats()['flushed_rows'] < 12 and time.time() < deadline:
+        time.sleep(0.01)
+    assert count() == 12
+
+    # 写入阻塞时，队列满了之后丢弃
+    lock = threading.Lock()
+    lock.acquire()
+    event.listen(sql.engine(), 'before_cursor_execute', lambda *args: lock.acquire(timeout=5) and lock.release())
+    results = [sql.buffered_insert(Log, {'action': i}) for i in range(40)]
+    lock.release()
+    assert not all(results)
+    stats = sql.write_buffer.stats()
+    assert stats['dropped'] == results.count(False)
+    sql.write_buffer.close()
+    stats = sql.write_buffer.stats()
+    assert stats['queued'] == 0 and stats['failed_rows'] == 0
+    assert count() == 12 + results.count(True) == stats['flushed_rows']
+    assert stats['latency_max_ms'] >= stats['latency_avg_ms'] > 0
+    # 关闭之后直接写入
+    sql.buffered_insert(Log, {'action': 1})
+    assert count() == 13 + results.count(True)
+
+
+def test_write_buffer_bad_rows(tmp_path, caplog):
+    sql = SQLAlchemy(
+        URI=f'sqlite:///{tmp_path.as_posix()}/log.sqlite',
+        WRITE_BUFFER={'max_rows': 100, 'interval': 10},
+    )
+
+    class Log(sql.Model()):
+        __tablename__ = 'log'
+        id = Column(Integer, primary_key=True)
+        action = Column(Integer, nullable=False)
+
+    sql.create_all()
+    sql.buffered_insert(Log, {'id': 1, 'action': 0})
+    sql.write_buffer.flush(5)
+    # 同一组中的主键重复和 NOT NULL 错误只丢弃出错的行
+    for i in range(2, 12):
+        sql.buffered_insert(Log, {'id': i, 'action': i})
+    sql.buffered_insert(Log, {'id': 1, 'action': 1})
+    sql.buffered_insert(Log, {'id': 100, 'action': None})
+    with caplog.at_level('ERROR', logger='pyape.sql'):
+        assert sql.write_buffer.flush(5)
+    stats = sql.write_buffer.stats()
+    assert stats['flushed_rows'] == 11 and stats['failed_rows'] == 2
+    assert sql.session().scalar(select(func.count()).select_from(Log)) == 11
+    assert len([r for r in caplog.records if 'drop row' in r.getMessage()]) == 2
+    sql.write_buffer.close()
@@ -0,0 +1,211 @@
+import pytest
+from sqlalchemy import Column, Integer, create_engine
+from sqlalchemy.orm import Session, declarative_base
+
+from pyape.db import KeysetPagination
+
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    status = Column(Integer, nullable=False)
+    index = Column(Integer, nullable=False)
+    createtime = Column(Integer, nullable=False)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as s:
+        # 排序列存在大量重复值，依靠主键保证顺序唯一
+        s.add_all(
+            Item(id=i, status=i % 2, index=i % 3, createtime=i // 4) for i in range(1, 38)
+        )
+        s.commit()
+        yield s
+
+
+def test_keyset_pagination(session: Session):
+    qry = session.query(Item).order_by(Item.status, Item.index, Item.createtime.desc())
+    expected = [item.id for item in qry.order_by(Item.id).all()]
+
+    ids = []
+    pages = []
+    pagi = KeysetPagination.paginate(qry, None, 10)
+    assert not pagi.has_prev
+    while True:
+        pages.append(pagi)
+        ids.extend(item.id for item in pagi.items)
+        if not pagi.has_next:
+            break
+        pagi = KeysetPagination.paginate(qry, pagi.next_cursor, 10)
+    assert ids == expected
+    assert [len(p.items) for p in pages] == [10, 10, 10, 7]
+
+    # 从最后一页向前翻页
+    for page in reversed(pages[:-1]):
+        pagi = KeysetPagination.paginate(qry, pagi.prev_cursor, 10)
+        assert [item.id for item in pagi.items] == [item.id for item in page.items]
+    assert not pagi.has_prev and pagi.has_next
+
+
+def test_keyset_pagination_renamed_column():
+    # 属性名称与列名不同
+    class Ranked(Base):
+        __tablename__ = 'ranked'
+        rid = Column('ranked_id', Integer, primary_key=True)
+        rank = Column('rank_value', Integer, nullable=False)
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine, tables=[Ranked.__table__])
+    with Session(engine) as s:
+        s.add_all(Ranked(rid=i, rank=i % 4) for i in range(1, 16))
+        s.commit()
+        qry = s.query(Ranked).order_by(Ranked.rank.desc())
+        expected = [r.rid for r in qry.order_by(Ranked.rid).all()]
+        ids = []
+        pagi = KeysetPagination.paginate(qry, None, 4)
+        while True:
+            ids.extend(r.rid for r in pagi.items)
+            if not pagi.has_next:
+                break
+            pagi = KeysetPagination.paginate(qry, pagi.next_cursor, 4)
+        assert ids == expected
+        assert [r.rid for r in KeysetPagination.paginate(qry, pagi.prev_cursor, 4).items] == expected[8:12]
+
+
+def test_keyset_pagination_invalid_cursor(session: Session):
+    qry = session.query(Item).order_by(Item.id)
+    with pytest.raises(ValueError):
+        KeysetPagination.paginate(qry, 'not-a-cursor', 10)
+
+
+def test_pagination_total_strategy(session: Session):
+    from pyape.cache import GlobalCache
+    from pyape.db import Pagination, CachedTotal, EstimatedTotal
+
+    qry = session.query(Item).order_by(Item.id)
+    pagi = Pagination.paginate(qry, 2, 10)
+    assert (pagi.total, pagi.pages, pagi.has_next) == (37, 4, True)
+    # 最后一页不需要查询总数
+    pagi = Pagination.paginate(qry, 4, 10, total_strategy=lambda q: 0)
+    assert (pagi.total, pagi.has_next, len(pagi.items)) == (37, False, 7)
+    # 不精确的总数不影响 has_next
+    pagi = Pagination.paginate(qry, 2, 10, total_strategy=lambda q: 5)
+    assert pagi.has_next and pagi.total == 21
+
+    gcache = GlobalCache.from_config('dict')
+    cached = CachedTotal(gcache, ttl=60)
+    assert Pagination.paginate(qry, 1, 10, total_strategy=cached).total == 37
+    session.add(Item(id=100, status=0, index=0, createtime=0))
+    session.commit()
+    assert Pagination.paginate(qry, 1, 10, total_strategy=cached).total == 37
+    # 不同的筛选条件使用不同的缓存
+    assert cached(qry.filter(Item.status == 1)) == 19
+    # sqlite 不支持估算，使用 COUNT
+    assert EstimatedTotal()(qry) == 38
+    assert EstimatedTotal.estimable_table(qry) is Item.__table__
+    assert EstimatedTotal.estimable_table(qry.filter(Item.status == 1)) is None
+
+
+def test_cached_total_per_database(tmp_path):
+    from pyape.cache import GlobalCache
+    from pyape.db import CachedTotal
+
+    cached = CachedTotal(GlobalCache.from_config('dict'), ttl=60)
+    totals = []
+    for name, count in (('a', 3), ('b', 5)):
+        engine = create_engine(f'sqlite:///{tmp_path.as_posix()}/{name}.sqlite')
+        Base.metadata.create_all(engine)
+        with Session(engine) as s:
+            s.add_all(Item(id=i, status=0, index=0, createtime=0) for i in range(count))
+            s.commit()
+            # 相同的查询在不同的数据库中使用不同的缓存
+            totals.append(cached(s.query(Item)))
+    assert totals == [3, 5]
+
+
+def test_pagination_window_total(session: Session):
+    from sqlalchemy import event
+    from pyape.db import Pagination, WindowTotal
+
+    statements = []
+    event.listen(
+        session.get_bind(), 'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    qry = session.query(Item).order_by(Item.id)
+    pagi = Pagination.paginate(qry, 2, 10, total_strategy=WindowTotal())
+    assert [item.id for item in pagi.items] == list(range(11, 21))
+    assert (pagi.total, pagi.pages, pagi.has_next) == (37, 4, True)
+    assert len(statements) == 1 and 'OVER' in statements[0]
+    # 超出最后一页时回退到 COUNT
+    pagi = Pagination.paginate(qry, 10, 10, total_strategy=WindowTotal())
+    assert (pagi.items, pagi.total) == ([], 37)
+
+
+def test_supports_window_functions(tmp_path):
+    from types import SimpleNamespace
+    from pyape.db import WindowTotal, supports_window_functions
+
+    def dialect(name, version, is_mariadb=False):
+        return SimpleNamespace(name=name, server_version_info=version, is_mariadb=is_mariadb)
+
+    assert supports_window_functions(dialect('mysql', (8, 0, 36)))
+    assert not supports_window_functions(dialect('mysql', (5, 7, 44)))
+    # 使用 mysql:// 连接的 MariaDB
+    assert supports_window_functions(dialect('mysql', (10, 6, 12), True))
+    assert not supports_window_functions(dialect('mysql', (10, 1, 48), True))
+    assert supports_window_functions(dialect('mariadb', (10, 2, 0), True))
+    assert not supports_window_functions(dialect('mysql', None))
+
+    # 尚未连接过的 Engine 没有版本信息，第一页就应该使用查询的连接获取
+    uri = f'sqlite:///{tmp_path.as_posix()}/item.sqlite'
+    Base.metadata.create_all(create_engine(uri))
+    fresh = create_engine(uri)
+    assert fresh.dialect.server_version_info is None
+    with Session(fresh) as s:
+        qry = s.query(Item).order_by(Item.id)
+        assert WindowTotal().usable(qry)
+        assert fresh.dialect.server_version_info is not None
+
+
+def test_statement_template(session: Session):
+    from sqlalchemy import bindparam, select
+    from pyape.cache import GlobalCache
+    from pyape.db import Pagination, CachedTotal, WindowTotal, statement_template
+
+    calls = []
+
+    @statement_template
+    def clauses(item_cls, has_index: bool):
+        calls.append(has_index)
+        cause = [item_cls.status == bindparam('status')]
+        if has_index:
+            cause.append(item_cls.index == bindparam('index'))
+        return tuple(cause)
+
+    @statement_template
+    def by_id(item_cls):
+        return select(item_cls).where(item_cls.id == bindparam('id'))
+
+    assert clauses(Item, False) is clauses(Item, False)
+    assert by_id(Item) is by_id(Item)
+    assert session.scalars(by_id(Item), {'id': 3}).first().id == 3
+
+    qry = session.query(Item).filter(*clauses(Item, True)).order_by(Item.id)
+    assert calls == [False, True]
+    # 模板中的参数在 COUNT、分页和缓存键中都有效
+    for status, index, total in ((1, 0, 6), (0, 2, 6), (1, 1, 7)):
+        q = qry.params(status=status, index=index)
+        assert Pagination.paginate(q, 1, 4).total == total
+        assert Pagination.paginate(q, 1, 4, total_strategy=WindowTotal()).total == total
+        assert all(item.status == status and item.index == index for item in q.all())
+    cached = CachedTotal(GlobalCache.from_config('dict'))
+    assert cached(qry.params(status=1, index=0)) == 6
+    assert cached(qry.params(status=1, index=1)) == 7
+    assert KeysetPagination.paginate(qry.params(status=1, index=1), None, 5).items[0].id == 1
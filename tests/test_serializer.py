@@ -0,0 +1,98 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import Column, Integer, VARCHAR, DateTime, Numeric, Float, Date, create_engine, select, func, text
+from sqlalchemy.orm import declarative_base
+
+from pyape.serializer import serialize_rows, result_types, column_kinds, compile_serializer
+
+
+Base = declarative_base()
+
+
+class Order(Base):
+    __tablename__ = 'orders'
+    id = Column(Integer, primary_key=True)
+    name = Column(VARCHAR(20))
+    price = Column(Numeric(10, 2))
+    createtime = Column(DateTime)
+
+
+def legacy_result2dict(result, keys, replaceobj=None, replaceobj_key_only=False):
+    """ 改为编译转换函数之前的实现，用于比较结果。"""
+    result_dict = {}
+    for key in keys:
+        value = result.get(key) if isinstance(result, dict) else getattr(result, key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Decimal):
+            value = int(value)
+        newkey = key
+        if replaceobj:
+            newkey = replaceobj.get(key, None) if replaceobj_key_only else replaceobj.get(key, key)
+        if newkey:
+            result_dict[newkey] = value
+    return result_dict
+
+
+def make_engine():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(Order.__table__.insert(), [
+            dict(id=i, name=None if i == 1 else f'o{i}', price=Decimal(f'{i}.50'),
+                 createtime=None if i == 1 else datetime(2024, 1, i, 8, 30))
+            for i in range(1, 6)
+        ])
+    return engine
+
+
+def test_serialize_rows_matches_legacy():
+    engine = make_engine()
+    stmt = select(Order.id, Order.name, Order.price, Order.createtime, func.count().label('c')).group_by(Order.id)
+    for replaceobj, key_only in (
+        (None, False),
+        ({'name': 'title', 'createtime': 'ctime'}, False),
+        ({'name': 'title', 'price': 'p'}, True),
+    ):
+        with engine.connect() as conn:
+            result = conn.execute(stmt)
+            types = result_types(result)
+            rows = result.all()
+        expected = [legacy_result2dict(row, row._fields, replaceobj, key_only) for row in rows]
+        assert serialize_rows(rows, rows[0]._fields, replaceobj, key_only, types=types) == expected
+        assert serialize_rows(rows, rows[0]._fields, replaceobj, key_only) == expected
+        dicts = [row._asdict() for row in rows]
+        assert serialize_rows(dicts, rows[0]._fields, replaceobj, key_only, access='get') == expected
+    assert serialize_rows([], ('id',)) == []
+
+
+def test_column_kinds_and_cache():
+    rows = [(1, None, None, date(2024, 1, 1)), (2, datetime(2024, 1, 1), Decimal('1.5'), None)]
+    keys = ('id', 'ctime', 'price', 'day')
+    assert column_kinds(keys) == ('any',) * 4
+    assert column_kinds(keys, types=[Integer(), DateTime(), Numeric(), Date()]) == \
+        ('any', 'datetime', 'decimal', 'plain')
+    assert column_kinds(('name', 'rate'), types=[VARCHAR(20), Float()]) == ('plain', 'plain')
+    # date 不是 datetime，与之前的实现相同，不转换
+    assert serialize_rows(rows, keys)[0] == {'id': 1, 'ctime': None, 'price': None, 'day': date(2024, 1, 1)}
+    serialize_rows(rows, keys, {'ctime': 'createtime'})
+    info = compile_serializer.cache_info()
+    serialize_rows(rows[::-1], keys, {'ctime': 'createtime'})
+    assert compile_serializer.cache_info().hits == info.hits + 1
+
+    # text() 查询没有列类型
+    engine = make_engine()
+    with engine.connect() as conn:
+        result = conn.execute(text('SELECT id, name FROM orders'))
+        assert result_types(result) is None
+
+
+def test_untyped_columns_always_convert():
+    # 前面大量的 NULL 或者 int 值不影响后面的 datetime 和 Decimal
+    rows = [(None, None)] * 150 + [(1, 2), (datetime(2024, 1, 1), Decimal('3'))]
+    result = serialize_rows(rows, ('a', 'b'), {'a': 'x'})
+    assert result[0] == {'x': None, 'b': None}
+    assert result[-1] == {'x': '2024-01-01T00:00:00', 'b': 3}
+    dicts = [{'a': a, 'b': b} for a, b in rows]
+    assert serialize_rows(dicts, ('a', 'b'), access='get')[-1] == {'a': '2024-01-01T00:00:00', 'b': 3}